@@ -4,39 +4,86 @@
 """
 
 import os
+import asyncio
+import threading
+import time
 import uuid
-import base64
 import shutil
 import json
+import re
 import hashlib
 import secrets
 import string
 from pathlib import Path
 from typing import Optional, Dict, List
 from datetime import datetime
+from contextlib import asynccontextmanager
+from functools import partial
 
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Header, Request, Response
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse, HTMLResponse, FileResponse
+from fastapi.responses import JSONResponse, HTMLResponse, FileResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import uvicorn
 from dotenv import load_dotenv
 
-from google import genai
-from google.genai import types
-from google.cloud import storage
+from gemini_router import build_router_from_env
+from scheduler import scheduler
+import region_edit
+import composer
+import retention
+import session_index
+import timelapse
+import zip_export
+import session_watch
+import catalog
+import jsonlog
+import generation_profiles
+import context_cache
+import tiered_cache
+import output_encoding
+import starter_stock
 
 # 載入環境變數
 load_dotenv()
 
+# 啟動模式：
+#   lazy       - google.genai / google.cloud.storage 與各 client 延遲到第一次使用才載入
+#   background - 服務啟動後在背景 thread 預熱（預設）
+#   eager      - import 時就預熱（舊行為）
+STARTUP_MODE = os.getenv("STARTUP_MODE", "background").lower()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """服務啟動/結束時的處理"""
+    if STARTUP_MODE == "background":
+        threading.Thread(target=warmup, name="warmup", daemon=True).start()
+    if RETENTION_ENABLED:
+        retention_manager.start()
+    if STARTER_STOCK_ENABLED:
+        starter_stock_pool.start()
+    yield
+    await starter_stock_pool.stop()
+    retention_manager.stop()
+    if _similarity_index is not None:
+        _similarity_index.stop()
+    timelapse_renderer.shutdown()
+    context_cache.manager.shutdown()
+
+
 # 初始化 FastAPI
 app = FastAPI(
     title="Nano Banana API",
     description="圖像編輯與生成 API，使用 Google Gemini 2.5 Flash",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
+# request id + 結構化 request log
+app.add_middleware(jsonlog.RequestLogMiddleware)
+
 # CORS 設定（如果需要從網頁前端呼叫）
 app.add_middleware(
     CORSMiddleware,
@@ -52,41 +99,268 @@ INPUT_DIR = BASE_DIR / "input"
 RESULT_DIR = BASE_DIR / "result"
 STATIC_DIR = BASE_DIR / "static"
 SESSIONS_DIR = BASE_DIR / "sessions"
+CACHE_DIR = BASE_DIR / "cache"
 INPUT_DIR.mkdir(exist_ok=True)
 RESULT_DIR.mkdir(exist_ok=True)
 STATIC_DIR.mkdir(exist_ok=True)
 SESSIONS_DIR.mkdir(exist_ok=True)
 
+# 生成結果的輸出格式 (OUTPUT_FORMAT / OUTPUT_QUALITY)
+output_encoder = output_encoding.encoder_from_env()
+
+# 家具目錄 (sprite atlas + JSON 索引)
+furniture_catalog = catalog.FurnitureCatalog(STATIC_DIR / "img", CACHE_DIR / "catalog")
+
+# 縮時動畫 (process pool 產生，依 history 版本快取)
+timelapse_renderer = timelapse.TimelapseRenderer(
+    CACHE_DIR / "timelapse",
+    max_workers=int(os.getenv("TIMELAPSE_WORKERS", "1")),
+    max_frame_bytes=int(float(os.getenv("TIMELAPSE_FRAME_CACHE_MB", "512")) * 1024 * 1024)
+)
+
+# Session 索引 (SQLite)
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_]+$")
+sessions_db = session_index.SessionIndex(SESSIONS_DIR / session_index.INDEX_FILENAME)
+
+
+def on_retention_delete(policy: str, name: str):
+    """保留政策刪除檔案時，同步移除 session 索引 / 相似度索引"""
+    if policy == "sessions":
+        sessions_db.remove(Path(name).stem)
+    elif policy == "result" and SIMILARITY_ENABLED:
+        get_similarity_index().remove(Path(name).name)
+
+
+# 保留政策與背景清理 (input/result/sessions)
+RETENTION_ENABLED = os.getenv("RETENTION_ENABLED", "true").lower() == "true"
+retention_manager = retention.RetentionManager(
+    retention.policies_from_env(INPUT_DIR, RESULT_DIR, SESSIONS_DIR),
+    interval=float(os.getenv("RETENTION_INTERVAL_SECONDS", "60")),
+    lock_path=BASE_DIR / ".retention.lock",
+    on_delete=on_retention_delete,
+    # 尚未取用的預先生成庫存還沒有被 session 引用，也不能刪
+    protect=lambda policy, name: (STARTER_STOCK_ENABLED and policy == "result"
+                                  and Path(name).name in starter_stock_pool.held_names()),
+    # sweeper 只在一個 worker 執行，其他 worker 新增的引用經由 session 索引傳給它
+    reference_log=sessions_db if RETENTION_ENABLED else None
+)
+
+# 管理端 API 的 token（未設定時管理端 API 停用）
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
 # Session storage (in-memory for simplicity, could use database)
 sessions: Dict[str, Dict] = {}
 
 # 掛載靜態檔案目錄
-app.mount("/images", StaticFiles(directory=str(RESULT_DIR)), name="images")
+class ResultFiles(StaticFiles):
+    """本地結果圖片：檔名唯一、內容不變，加上長期快取"""
+
+    async def get_response(self, path: str, scope):
+        response = await super().get_response(path, scope)
+        if response.status_code in (200, 304):
+            response.headers["Cache-Control"] = output_encoding.RESULT_CACHE_CONTROL
+        return response
+
+
+app.mount("/images", ResultFiles(directory=str(RESULT_DIR)), name="images")
 app.mount("/static", StaticFiles(directory=str(STATIC_DIR), html=True), name="static")
 
 # 讀取環境變數
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-if not GOOGLE_API_KEY:
+if not GOOGLE_API_KEY and not os.getenv("GOOGLE_API_KEYS") and not os.getenv("VERTEX_PROJECTS") \
+        and os.getenv("GEMINI_BACKEND", "").lower() != "stub":
     raise ValueError("請設定 GOOGLE_API_KEY 環境變數")
 
+# Gemini 路由器（多 key / 多專案負載平衡）
+gemini_router = build_router_from_env(GOOGLE_API_KEY)
+
 # GCP Storage 設定
 GCS_BUCKET_NAME = os.getenv("GCS_BUCKET_NAME", "team-bubu")
 USE_GCS = os.getenv("USE_GCS", "false").lower() == "true"  # 預設為 false (本地儲存)
 
-# 初始化 GCS client
-storage_client = None
-if USE_GCS:
-    try:
-        storage_client = storage.Client()
-        print(f"✅ GCS enabled: using bucket {GCS_BUCKET_NAME}")
-    except Exception as e:
-        print(f"⚠️  GCS initialization failed: {e}")
-        print("Falling back to local storage")
-        USE_GCS = False
-else:
+# GCS client 延遲建立（第一次使用或 warmup 時）
+_storage_client = None
+_storage_lock = threading.Lock()
+if not USE_GCS:
     print("📁 Using local storage")
 
 
+def get_storage_client():
+    """
+    取得 GCS client，第一次呼叫時才載入 google.cloud.storage 並建立 client
+    建立失敗時改用本地儲存
+
+    Returns:
+        storage.Client 或 None（未啟用 GCS）
+    """
+    global _storage_client, USE_GCS
+    if not USE_GCS:
+        return None
+    if _storage_client is None:
+        with _storage_lock:
+            if _storage_client is None and USE_GCS:
+                try:
+                    from google.cloud import storage
+                    _storage_client = storage.Client()
+                    print(f"✅ GCS enabled: using bucket {GCS_BUCKET_NAME}")
+                except Exception as e:
+                    print(f"⚠️  GCS initialization failed: {e}")
+                    print("Falling back to local storage")
+                    USE_GCS = False
+    return _storage_client
+
+
+def _gcs_session_blob(session_id: str):
+    """session JSON 的 GCS blob（含 metadata），先找分片路徑，再找舊的平面路徑"""
+    bucket = get_storage_client().bucket(GCS_BUCKET_NAME)
+    for key in (f"json/{session_index.session_relpath(session_id)}", f"json/{session_id}.json"):
+        blob = bucket.get_blob(key)
+        if blob is not None:
+            return blob
+    return None
+
+
+def _session_generation(session_id: str, blob) -> int:
+    """
+    寫入前置條件用的 generation
+    只有舊的平面路徑時，分片路徑（寫入的位置）還不存在，前置條件是 0
+    """
+    if blob.name != f"json/{session_index.session_relpath(session_id)}":
+        return 0
+    return blob.generation
+
+
+def _fetch_gcs_session(session_id: str):
+    blob = _gcs_session_blob(session_id)
+    if blob is None:
+        return None
+    return blob.download_as_bytes(), _session_generation(session_id, blob)
+
+
+def _stat_gcs_session(session_id: str) -> Optional[int]:
+    blob = _gcs_session_blob(session_id)
+    return _session_generation(session_id, blob) if blob is not None else None
+
+
+def _fetch_gcs_result(name: str):
+    # 本地備份還在時不需要下載
+    local_path = RESULT_DIR / name
+    if local_path.exists():
+        return local_path.read_bytes(), None
+    blob = get_storage_client().bucket(GCS_BUCKET_NAME).get_blob(f"result/{name}")
+    if blob is None:
+        return None
+    return blob.download_as_bytes(), blob.generation
+
+
+# GCS 讀取快取（記憶體 LRU -> 本地磁碟 -> GCS），USE_GCS 時使用
+# session JSON 以 generation 驗證；結果圖片檔名唯一，不需要驗證
+GCS_CACHE_MEMORY_MB = int(os.getenv("GCS_CACHE_MEMORY_MB", "64"))
+GCS_CACHE_DISK_MB = int(os.getenv("GCS_CACHE_DISK_MB", "512"))
+session_cache = tiered_cache.TieredCache(
+    "sessions",
+    CACHE_DIR / "gcs" / "json",
+    fetch=_fetch_gcs_session,
+    stat=_stat_gcs_session,
+    memory_max_bytes=GCS_CACHE_MEMORY_MB * 1024 * 1024 // 8,
+    disk_max_bytes=GCS_CACHE_DISK_MB * 1024 * 1024 // 8,
+    fresh_seconds=float(os.getenv("GCS_CACHE_FRESH_SECONDS", "10")),
+    negative_ttl=float(os.getenv("GCS_CACHE_NEGATIVE_TTL", "10")),
+)
+result_cache = tiered_cache.TieredCache(
+    "results",
+    CACHE_DIR / "gcs" / "result",
+    fetch=_fetch_gcs_result,
+    memory_max_bytes=GCS_CACHE_MEMORY_MB * 1024 * 1024,
+    disk_max_bytes=GCS_CACHE_DISK_MB * 1024 * 1024,
+    negative_ttl=float(os.getenv("GCS_CACHE_NEGATIVE_TTL", "10")),
+)
+
+
+# 相似度索引延遲建立（NumPy 在第一次使用時才載入）
+SIMILARITY_ENABLED = os.getenv("SIMILARITY_ENABLED", "true").lower() == "true"
+_similarity_index = None
+_similarity_lock = threading.Lock()
+
+
+def get_similarity_index():
+    """
+    取得相似度索引，第一次呼叫時載入 similarity (NumPy) 並啟動背景 worker
+
+    Returns:
+        similarity.SimilarityIndex
+    """
+    global _similarity_index
+    if _similarity_index is None:
+        with _similarity_lock:
+            if _similarity_index is None:
+                import similarity
+                index = similarity.SimilarityIndex(CACHE_DIR / "similarity")
+                index.start()
+                _similarity_index = index
+    return _similarity_index
+
+
+_warmup_lock = threading.Lock()
+_warmup_result: Optional[dict] = None
+
+
+def warmup() -> dict:
+    """
+    預熱：載入重量級模組、建立 Gemini / GCS client 並建立連線
+    只會執行一次，之後直接回傳第一次的耗時
+
+    Returns:
+        dict: 各步驟耗時 (ms)
+    """
+    global _warmup_result
+    with _warmup_lock:
+        if _warmup_result is not None:
+            return _warmup_result
+
+        timings = {}
+        started = time.perf_counter()
+
+        def mark(name: str, since: float) -> float:
+            now = time.perf_counter()
+            timings[name] = round((now - since) * 1000, 1)
+            return now
+
+        step = started
+        from google.genai import types  # noqa: F401
+        step = mark("import_genai_ms", step)
+
+        gemini_router.warm()
+        step = mark("gemini_clients_ms", step)
+
+        client = get_storage_client()
+        if client is not None:
+            try:
+                # 一次輕量請求，讓連線池先完成 TLS 握手
+                client.bucket(GCS_BUCKET_NAME).get_blob("json/.warmup")
+            except Exception as e:
+                print(f"⚠️  GCS warmup request failed: {e}")
+        step = mark("gcs_client_ms", step)
+
+        try:
+            furniture_catalog.load()
+        except Exception as e:
+            print(f"⚠️  Furniture catalog build failed: {e}")
+        mark("catalog_ms", step)
+
+        timings["total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        _warmup_result = timings
+        print(f"🔥 Warmup done in {timings['total_ms']} ms")
+        return timings
+
+
+# 批次編輯一次最多幾個項目
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "8"))
+
+# 起始場景（可在批次編輯中直接引用，不需上傳）
+STARTER_SCENES = ["space", "moon", "mars", "ship"]
+
+
 class ImageEditRequest(BaseModel):
     """圖像編輯請求"""
     prompt: str
@@ -135,20 +409,24 @@ def upload_to_gcs(file_data: bytes, filename: str, folder: str = "result") -> st
     Returns:
         str: 公開 URL
     """
+    storage_client = get_storage_client()
     if not USE_GCS or not storage_client:
         raise Exception("GCS not enabled")
     
     bucket = storage_client.bucket(GCS_BUCKET_NAME)
     blob = bucket.blob(f"{folder}/{filename}")
     
-    # 設定 content type
-    content_type = "image/jpeg"
-    if filename.endswith(".png"):
-        content_type = "image/png"
-    elif filename.endswith(".json"):
-        content_type = "application/json"
+    # 設定 content type（副檔名由 output_encoding 依實際格式決定）
+    content_type = output_encoding.content_type_for(filename, "image/jpeg")
+    if folder == "result":
+        blob.cache_control = output_encoding.RESULT_CACHE_CONTROL
     
-    blob.upload_from_string(file_data, content_type=content_type)
+    with jsonlog.stage("gcs_upload"):
+        blob.upload_from_string(file_data, content_type=content_type)
+    jsonlog.log("gcs_save", object=f"{folder}/{filename}", bytes=len(file_data))
+    if folder == "result":
+        # 下一次編輯通常以這張圖為底圖（本地已有備份，只放記憶體層）
+        result_cache.put(filename, file_data, blob.generation, disk=False)
     
     # 返回公開 URL
     return f"https://storage.googleapis.com/{GCS_BUCKET_NAME}/{folder}/{filename}"
@@ -161,7 +439,14 @@ def save_file(file_data: bytes, filename: str, folder: str = "result") -> str:
     Returns:
         str: 檔案的公開 URL
     """
-    if USE_GCS:
+    if folder == "result" and SIMILARITY_ENABLED:
+        # 背景計算相似度特徵（不影響回應時間）
+        try:
+            get_similarity_index().submit(filename, file_data)
+        except Exception as e:
+            jsonlog.log("similarity_unavailable", str(e), severity="WARNING")
+
+    if USE_GCS and get_storage_client():
         # 上傳到 GCS
         return upload_to_gcs(file_data, filename, folder)
     else:
@@ -178,88 +463,275 @@ def save_file(file_data: bytes, filename: str, folder: str = "result") -> str:
         file_path = folder_path / filename
         with open(file_path, "wb") as f:
             f.write(file_data)
+        retention_manager.track("sessions" if folder == "json" else folder, file_path)
         
         base_url = os.getenv("BASE_URL", "http://localhost:8000")
         return f"{base_url}/images/{filename}"
 
 
+def result_url(filename: str) -> str:
+    """結果圖片的公開 URL（與 save_file 回傳的格式相同）"""
+    if USE_GCS:
+        return f"https://storage.googleapis.com/{GCS_BUCKET_NAME}/result/{filename}"
+    base_url = os.getenv("BASE_URL", "http://localhost:8000")
+    return f"{base_url}/images/{filename}"
+
+
+def session_file_path(session_id: str) -> Path:
+    """session JSON 的本地分片路徑"""
+    return SESSIONS_DIR / session_index.session_relpath(session_id)
+
+
 def load_session_json(session_id: str) -> Optional[dict]:
     """
     載入 session JSON (從 GCS 或本地)
+    先找分片路徑，再找舊的平面路徑
     """
+    if not SESSION_ID_PATTERN.match(session_id or ""):
+        return None
+
     filename = f"{session_id}.json"
     
+    storage_client = get_storage_client()
     if USE_GCS and storage_client:
         try:
-            bucket = storage_client.bucket(GCS_BUCKET_NAME)
-            blob = bucket.blob(f"json/{filename}")
-            if blob.exists():
-                data = blob.download_as_string()
+            # 記憶體 -> 本地磁碟快取（generation 驗證）-> GCS
+            data = session_cache.get(session_id)
+            if data is not None:
                 return json.loads(data)
         except Exception as e:
-            print(f"Error loading from GCS: {e}")
+            jsonlog.log("gcs_load_failed", str(e), severity="ERROR", session_id=session_id)
     
     # Fallback to local
-    session_file = SESSIONS_DIR / filename
-    if session_file.exists():
-        with open(session_file, "r") as f:
-            return json.load(f)
+    for session_file in (session_file_path(session_id), SESSIONS_DIR / filename):
+        if session_file.exists():
+            with open(session_file, "r") as f:
+                return json.load(f)
     
     return None
 
 
-def save_session_json(session_id: str, data: dict):
+class SessionConflict(Exception):
+    """session JSON 在讀取之後被其他 worker / instance 改寫（GCS generation 不符）"""
+
+
+# read-modify-write 遇到衝突時重試的次數
+SESSION_UPDATE_RETRIES = 5
+
+
+def load_session_for_update(session_id: str):
+    """
+    載入要改寫的 session JSON（read-modify-write 用）
+
+    不使用快取 fresh 時間內的副本，一定先向 GCS 比對 generation；
+    回傳的 generation 作為 save_session_json 的 if_generation_match，
+    期間有其他 worker / instance 寫入時儲存會失敗（SessionConflict），由呼叫端重新讀取
+
+    Returns:
+        Tuple[Optional[dict], Optional[int]]: (session 資料, generation)；
+        GCS 上不存在時 generation 為 0，未使用 GCS 時為 None（不檢查）
     """
-    儲存 session JSON (到 GCS 或本地)
+    if not SESSION_ID_PATTERN.match(session_id or ""):
+        return None, None
+
+    storage_client = get_storage_client()
+    if USE_GCS and storage_client:
+        try:
+            versioned = session_cache.get_versioned(session_id, revalidate=True)
+        except Exception as e:
+            jsonlog.log("gcs_load_failed", str(e), severity="ERROR", session_id=session_id)
+        else:
+            if versioned is not None:
+                return json.loads(versioned[0]), versioned[1]
+            # GCS 上還沒有：可能只有本地備份（例如先前寫入 GCS 失敗）
+            return load_session_json(session_id), 0
+
+    return load_session_json(session_id), None
+
+
+def save_session_json(session_id: str, data: dict, if_generation_match: Optional[int] = None):
     """
-    filename = f"{session_id}.json"
+    儲存 session JSON (到 GCS 或本地)，寫入分片路徑並更新 session 索引
+
+    Args:
+        session_id: Session ID
+        data: session 資料
+        if_generation_match: GCS 物件目前的 generation（由 load_session_for_update 取得），
+                             不符時不寫入並 raise SessionConflict；None 時不檢查
+
+    Raises:
+        SessionConflict: GCS 上的 session 在讀取之後已被改寫
+    """
+    if not SESSION_ID_PATTERN.match(session_id or ""):
+        raise ValueError(f"Invalid session id: {session_id}")
+
+    relpath = session_index.session_relpath(session_id)
     json_data = json.dumps(data, indent=2, ensure_ascii=False).encode("utf-8")
+    location = "local"
     
     # 儲存到 GCS
+    storage_client = get_storage_client()
     if USE_GCS and storage_client:
         try:
             bucket = storage_client.bucket(GCS_BUCKET_NAME)
-            blob = bucket.blob(f"json/{filename}")
-            blob.upload_from_string(json_data, content_type="application/json")
-            print(f"✅ Session {session_id} saved to GCS")
+            blob = bucket.blob(f"json/{relpath}")
+            with jsonlog.stage("gcs_session_save"):
+                if if_generation_match is None:
+                    blob.upload_from_string(json_data, content_type="application/json")
+                else:
+                    blob.upload_from_string(
+                        json_data, content_type="application/json", if_generation_match=if_generation_match
+                    )
+            location = "gcs"
+            jsonlog.log("gcs_save", object=f"json/{relpath}", bytes=len(json_data), session_id=session_id)
+            session_cache.put(session_id, json_data, blob.generation)
         except Exception as e:
-            print(f"Error saving to GCS: {e}")
+            session_cache.invalidate(session_id)
+            if getattr(e, "code", None) == 412:
+                # PreconditionFailed：其他 worker / instance 已經寫入
+                raise SessionConflict(session_id) from e
+            jsonlog.log("gcs_save_failed", str(e), severity="ERROR", session_id=session_id)
     
     # 同時儲存到本地作為備份
-    session_file = SESSIONS_DIR / filename
+    session_file = session_file_path(session_id)
+    session_file.parent.mkdir(exist_ok=True)
     with open(session_file, "wb") as f:
         f.write(json_data)
+    retention_manager.track("sessions", session_file)
+
+    # 舊的平面路徑已由分片路徑取代
+    legacy_file = SESSIONS_DIR / f"{session_id}.json"
+    if legacy_file.exists():
+        legacy_file.unlink()
+
+    try:
+        sessions_db.upsert(session_id, data, location, relpath)
+    except Exception as e:
+        jsonlog.log("session_index_failed", str(e), severity="WARNING", session_id=session_id)
+
+
+def read_session(session_id: str) -> Optional[dict]:
+    """取得 session（記憶體優先，其次 GCS / 本地）"""
+    return sessions.get(session_id) or load_session_json(session_id)
+
+
+# 即時更新：long-poll / SSE 的等待與合併讀取
+session_watcher = session_watch.SessionWatcher(read_session)
+
+# long-poll / SSE 的等待上限（秒）
+WATCH_MAX_WAIT = 30
+SSE_KEEPALIVE = 15
 
 
 def update_session_history(session_id: str, image_url: str):
     """
     更新 session 的 history 記錄
+
+    讀取最新版本後以 generation 前置條件寫入，其他 worker 同時寫入時重新讀取再套用，
+    不會蓋掉對方加入的 history
+
+    Raises:
+        SessionConflict: 重試 SESSION_UPDATE_RETRIES 次仍然衝突
     """
-    # 載入現有 session
-    session_data = load_session_json(session_id)
-    
-    if not session_data:
-        # 建立新的 session
-        session_data = {
-            "id": session_id,
-            "created_at": datetime.now().isoformat(),
-            "history": []
-        }
-    
-    # 加入新的結果 URL
-    if "history" not in session_data:
-        session_data["history"] = []
-    
-    session_data["history"].append(image_url)
-    session_data["updated_at"] = datetime.now().isoformat()
-    
-    # 儲存
-    save_session_json(session_id, session_data)
+    retention_manager.add_references([image_url])
+    for attempt in range(SESSION_UPDATE_RETRIES):
+        # 載入現有 session（略過讀取快取的 fresh 時間）
+        session_data, generation = load_session_for_update(session_id)
+
+        if not session_data:
+            # 建立新的 session
+            session_data = {
+                "id": session_id,
+                "created_at": datetime.now().isoformat(),
+                "history": []
+            }
+
+        # 加入新的結果 URL
+        if "history" not in session_data:
+            session_data["history"] = []
+
+        session_data["history"].append(image_url)
+        session_data["updated_at"] = datetime.now().isoformat()
+
+        # 儲存
+        try:
+            with jsonlog.stage("session_history"):
+                save_session_json(session_id, session_data, if_generation_match=generation)
+            break
+        except SessionConflict:
+            jsonlog.log("session_conflict", severity="WARNING", session_id=session_id, attempt=attempt + 1)
+    else:
+        raise SessionConflict(session_id)
+
+    if session_id in sessions:
+        sessions[session_id] = session_data
+    session_watcher.publish(session_id, session_data)
     
-    print(f"💾 Session {session_id}: {len(session_data['history'])} images")
+    jsonlog.log("session_history", session_id=session_id, images=len(session_data["history"]))
+
+
+def resolve_image_path(ref: str) -> Optional[Path]:
+    """
+    把 history 中的圖片 URL 轉成伺服器上的本地檔案
+    支援起始場景 (/static/img/...)、本地結果 (/images/...) 與 GCS 結果 URL
+    GCS 結果在本地沒有備份時會先下載
+
+    Returns:
+        Optional[Path]: 本地路徑，找不到時回傳 None
+    """
+    if not ref:
+        return None
+    name = Path(ref.split("?", 1)[0]).name
+    if not name:
+        return None
+
+    if "/static/img/" in ref:
+        path = STATIC_DIR / "img" / name
+    elif "/images/" in ref or f"/{GCS_BUCKET_NAME}/result/" in ref:
+        path = RESULT_DIR / name
+    else:
+        return None
+
+    if path.exists():
+        return path
+
+    # 本地沒有備份時使用磁碟快取（不在快取中才從 GCS 下載）
+    if _is_gcs_result(ref):
+        try:
+            return result_cache.get_path(name)
+        except Exception as e:
+            jsonlog.log("gcs_load_failed", str(e), severity="ERROR", object=f"result/{name}")
+
+    return None
+
+
+def _is_gcs_result(ref: str) -> bool:
+    return bool(USE_GCS and get_storage_client() and f"/{GCS_BUCKET_NAME}/result/" in ref)
+
+
+def resolve_image_reference(ref: str) -> Optional[bytes]:
+    """
+    把 history 中的圖片 URL 轉成伺服器上的圖片資料
+    GCS 結果依序從記憶體、本地備份、磁碟快取、GCS 讀取
+
+    Returns:
+        Optional[bytes]: 圖片資料，找不到時回傳 None
+    """
+    if ref and _is_gcs_result(ref):
+        name = Path(ref.split("?", 1)[0]).name
+        try:
+            return result_cache.get(name)
+        except Exception as e:
+            jsonlog.log("gcs_load_failed", str(e), severity="ERROR", object=f"result/{name}")
+            return None
+    path = resolve_image_path(ref)
+    return path.read_bytes() if path else None
 
 
-def generate_nano_banana(image_path: str, user_prompt: str, session_id: str = None, base_url: str = "http://localhost:8000") -> dict:
+def generate_nano_banana(image_path: str, user_prompt: str, session_id: str = None,
+                         base_url: str = "http://localhost:8000", image_bytes: Optional[bytes] = None,
+                         postprocess=None, profile: Optional[str] = None,
+                         context_session: Optional[str] = None) -> dict:
     """
     使用 Gemini 2.5 Flash 處理圖像
 
@@ -267,10 +739,20 @@ def generate_nano_banana(image_path: str, user_prompt: str, session_id: str = No
         image_path: 本地圖像路徑
         user_prompt: 使用者的編輯指令
         base_url: 服務的基礎 URL
+        image_bytes: 直接送給模型的圖片（例如 region mode 裁出的區域），有值時取代 image_path 的內容
+        postprocess: 儲存前對每張生成圖片做的處理 (bytes -> bytes)
+        profile: 生成設定檔名稱（draft / final / classic），None 時使用預設
+        context_session: 輸入圖就是這個 session 的底圖（未加工）時傳入，
+                         可使用 session 的 context cache（只送文字）
 
     Returns:
         dict: 包含狀態和結果圖像 URL 的字典
     """
+    from google.genai import types
+
+    generation = generation_profiles.resolve_profile(profile)
+    gemini_started = None
+    image_urls = []
     try:
         # 檢查檔案是否存在
         if not os.path.exists(image_path):
@@ -279,20 +761,26 @@ def generate_nano_banana(image_path: str, user_prompt: str, session_id: str = No
                 "message": f"圖片不存在: {image_path}"
             }
 
-        # 讀取並轉換圖片為 Base64
-        with open(image_path, "rb") as image_file:
-            encoded_string = base64.b64encode(image_file.read()).decode("utf-8")
-
-        # 初始化 Gemini 客戶端
-        client = genai.Client(
-            vertexai=False,
-            api_key=GOOGLE_API_KEY
+        # 讀取圖片
+        if image_bytes is None:
+            with open(image_path, "rb") as image_file:
+                image_bytes = image_file.read()
+
+        # 依設定檔縮小輸入圖、決定輸出比例
+        raw_bytes = image_bytes
+        image_bytes, mime_type, aspect_ratio = generation_profiles.prepare_input(image_bytes, generation)
+        context = context_cache.manager.context(
+            context_session,
+            raw_bytes,
+            build=lambda data: generation_profiles.prepare_input(data, generation)[:2],
+            variant=generation.name,
+            prompt=user_prompt
         )
 
         # 準備圖片和提示
         image_part = types.Part.from_bytes(
-            data=base64.b64decode(encoded_string),
-            mime_type="image/jpeg",
+            data=image_bytes,
+            mime_type=mime_type,
         )
 
         contents = [
@@ -304,24 +792,28 @@ def generate_nano_banana(image_path: str, user_prompt: str, session_id: str = No
 
         # 設定生成參數
         config = types.GenerateContentConfig(
-            temperature=1,
-            top_p=0.95,
-            max_output_tokens=32768,
-            response_modalities=["TEXT", "IMAGE"],
+            temperature=generation.temperature,
+            top_p=generation.top_p,
+            max_output_tokens=generation.max_output_tokens,
+            response_modalities=list(generation.response_modalities),
             image_config=types.ImageConfig(
-                aspect_ratio="4:3",
+                aspect_ratio=aspect_ratio,
             )
         )
 
-        # 呼叫 Gemini API
-        image_urls = []
+        # 呼叫 Gemini API（經由路由器選擇 backend）
         text_output = []
+        first_image_ms = None
+        usage = None
 
-        for chunk in client.models.generate_content_stream(
-            model="gemini-2.5-flash-image",
+        gemini_started = time.perf_counter()
+        for chunk in gemini_router.generate_content_stream(
             contents=contents,
-            config=config
+            config=config,
+            context=context
         ):
+            usage = generation_profiles.usage_from_chunk(chunk) or usage
+
             # 收集文字輸出
             if getattr(chunk, "text", None):
                 text_output.append(chunk.text)
@@ -331,12 +823,24 @@ def generate_nano_banana(image_path: str, user_prompt: str, session_id: str = No
                 parts = getattr(candidate, "content", None) and candidate.content.parts or []
                 for part in parts:
                     if getattr(part, "inline_data", None):
-                        # 生成唯一檔名
-                        image_filename = f"{uuid.uuid4()}.jpg"
                         image_data = part.inline_data.data
+                        if first_image_ms is None:
+                            first_image_ms = (time.perf_counter() - gemini_started) * 1000
+                            jsonlog.record_stage("gemini_first_image", first_image_ms)
+                        if postprocess:
+                            with jsonlog.stage("postprocess"):
+                                image_data = postprocess(image_data)
+
+                        # 轉成輸出格式，檔名副檔名跟著實際格式
+                        with jsonlog.stage("encode"):
+                            # region mode 貼回的結果保持無損，下一次編輯的未變動區域不會累積失真
+                            encoded = output_encoder.encode(image_data, lossless=postprocess is not None)
+                        image_data = encoded.data
+                        image_filename = f"{uuid.uuid4()}{encoded.extension}"
 
                         # 儲存圖片（GCS 或本地）
-                        image_url = save_file(image_data, image_filename, "result")
+                        with jsonlog.stage("save"):
+                            image_url = save_file(image_data, image_filename, "result")
                         image_urls.append(image_url)
                         
                         # 同時儲存到本地作為備份
@@ -344,25 +848,41 @@ def generate_nano_banana(image_path: str, user_prompt: str, session_id: str = No
                             local_path = RESULT_DIR / image_filename
                             with open(local_path, "wb") as f:
                                 f.write(image_data)
+                            retention_manager.track("result", local_path)
                         
                         # 更新 session history
                         if session_id:
                             update_session_history(session_id, image_url)
+                            # 新結果成為下一次的底圖：在背景更新 context cache
+                            context_cache.manager.advance(session_id, image_data)
 
+        total_ms = (time.perf_counter() - gemini_started) * 1000
+        generation_profiles.profile_metrics.record(
+            generation.name, total_ms, first_image_ms, len(image_urls), usage, error=not image_urls
+        )
+        jsonlog.log("generation", session_id=session_id, profile=generation.name, aspect_ratio=aspect_ratio,
+                    images=len(image_urls), duration_ms=round(total_ms, 1), usage=usage)
         if image_urls:
             return {
                 "status": "success",
                 "image_urls": image_urls,
-                "text": "".join(text_output) if text_output else None
+                "text": "".join(text_output) if text_output else None,
+                "profile": generation.name
             }
         else:
             return {
                 "status": "error",
                 "message": "未生成圖片",
-                "text": "".join(text_output) if text_output else None
+                "text": "".join(text_output) if text_output else None,
+                "profile": generation.name
             }
 
     except Exception as e:
+        if gemini_started is not None:
+            generation_profiles.profile_metrics.record(
+                generation.name, (time.perf_counter() - gemini_started) * 1000, None, len(image_urls), error=True
+            )
+        jsonlog.log("generation_failed", str(e), severity="ERROR", session_id=session_id, profile=generation.name)
         return {
             "status": "error",
             "message": f"處理失敗: {str(e)}"
@@ -411,6 +931,7 @@ async def upload_image(file: UploadFile = File(...)):
         # 儲存檔案
         with open(file_path, "wb") as buffer:
             shutil.copyfileobj(file.file, buffer)
+        retention_manager.track("input", file_path)
 
         return {
             "status": "success",
@@ -424,21 +945,45 @@ async def upload_image(file: UploadFile = File(...)):
         file.file.close()
 
 
+def resolve_generation_profile(profile: Optional[str], session_data: Optional[dict]):
+    """request 指定的設定檔優先，其次是 session 的 generation_profile，最後是預設值"""
+    try:
+        return generation_profiles.resolve_profile(profile, (session_data or {}).get("generation_profile"))
+    except KeyError as e:
+        raise HTTPException(status_code=400, detail=f"Unknown generation profile: {e.args[0]}")
+
+
 @app.post("/api/edit")
 async def edit_image(
-    file: UploadFile = File(...),
     prompt: str = Form(...),
     session_id: str = Form(...),
-    secret: str = Form(...)
+    secret: str = Form(...),
+    file: Optional[UploadFile] = File(None),
+    base_image: Optional[str] = Form(None),
+    base_index: Optional[int] = Form(None),
+    overlay: Optional[UploadFile] = File(None),
+    furniture_placements: Optional[str] = Form(None),
+    regions: Optional[str] = Form(None),
+    profile: Optional[str] = Form(None)
 ):
     """
     上傳圖片並直接編輯
 
+    輸入圖可以是客戶端合成好的整張圖 (file)，或是引用伺服器上已有的底圖
+    (base_image / base_index)，再加上透明疊加層 (overlay) 或家具擺放
+    (furniture_placements)，由伺服器合成，省去重新上傳整張圖。
+
     Args:
-        file: 要編輯的圖片檔案
         prompt: 編輯指令
         session_id: Session ID (必須)
         secret: Session secret (必須)
+        file: 要編輯的圖片檔案（客戶端合成好的整張圖）
+        base_image: 底圖 URL（history 中的結果或起始場景）
+        base_index: 底圖在 session history 中的索引（可為負數，-1 為最新）
+        overlay: 透明疊加層 PNG（只含家具標示）
+        furniture_placements: 家具擺放 JSON，例如 [{"id": "item3", "x": 500, "y": 400, "size": 150}]
+        regions: region mode - 有變動的區域 JSON，例如 [[x, y, w, h], ...]（以合成圖座標表示）
+        profile: 生成設定檔（draft / final / classic），未指定時使用 session 的 generation_profile
 
     Returns:
         dict: 包含編輯結果的字典
@@ -448,32 +993,386 @@ async def edit_image(
         if not verify_session(session_id, secret):
             raise HTTPException(status_code=403, detail="Invalid session or secret")
         
-        print(f"✅ Session verified: {session_id}")
-        # 先上傳圖片
-        file_extension = os.path.splitext(file.filename)[1] or ".jpg"
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        file_path = INPUT_DIR / unique_filename
+        jsonlog.log("session_verified", session_id=session_id)
+
+        session_data = None
+        if profile is None or base_index is not None:
+            session_data = await asyncio.to_thread(read_session, session_id) or {}
+        generation = resolve_generation_profile(profile, session_data)
+
+        # 底圖參照：history 索引優先，其次是 URL
+        if base_index is not None:
+            history = session_data.get("history") or []
+            try:
+                base_image = history[base_index]
+            except IndexError:
+                raise HTTPException(status_code=400, detail="Invalid base_index")
+
+        placements = None
+        if furniture_placements:
+            try:
+                placements = json.loads(furniture_placements)
+            except json.JSONDecodeError:
+                raise HTTPException(status_code=400, detail="Invalid furniture_placements JSON")
+            try:
+                placements = composer.validate_placements(placements)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid furniture_placements")
+
+        region_list = None
+        if regions:
+            try:
+                region_list = json.loads(regions)
+            except json.JSONDecodeError:
+                raise HTTPException(status_code=400, detail="Invalid regions JSON")
+            try:
+                region_edit.parse_regions(region_list)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Invalid regions")
+
+        # 起始場景的第一步：有預先生成的庫存時直接回傳
+        scene = starter_scene(base_image) if STARTER_STOCK_ENABLED and file is None and overlay is None else None
+        if scene is not None:
+            if session_data is None:
+                session_data = await asyncio.to_thread(read_session, session_id) or {}
+            if not session_data.get("history"):
+                stocked = await take_starter_stock(
+                    session_id, scene, prompt, placements, region_list, generation.name
+                )
+                if stocked is not None:
+                    return stocked
+
+        base_bytes = None
+        if base_image:
+            base_bytes = await asyncio.to_thread(resolve_image_reference, base_image)
+
+        if file is not None:
+            # 先上傳圖片
+            file_path = save_upload(file)
+        elif base_bytes is None:
+            if base_image or base_index is not None:
+                raise HTTPException(status_code=404, detail="Base image not found")
+            raise HTTPException(status_code=400, detail="需要 file 或 base_image / base_index")
+        else:
+            file_path = None
 
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        overlay_bytes = await overlay.read() if overlay is not None else None
+        file_path, region, reuse_base = await prepare_edit_input(
+            base_bytes, placements, overlay_bytes, region_list, file_path=file_path
+        )
 
         # 取得當前請求的 base URL
         base_url = os.getenv("BASE_URL", "http://localhost:8000")
 
-        # 處理圖片
-        result = generate_nano_banana(
+        # 處理圖片（經由排程器排隊，互動式優先）
+        result, timing = await scheduler.run(
+            session_id,
+            generate_nano_banana,
             image_path=str(file_path),
             user_prompt=prompt,
             session_id=session_id,
-            base_url=base_url
+            base_url=base_url,
+            image_bytes=region["crop"] if region else None,
+            postprocess=region["blend"] if region else None,
+            profile=generation.name,
+            context_session=session_id if reuse_base and region is None else None,
+            priority="interactive"
         )
+        jsonlog.record_stage("queue_wait", timing["queue_wait_ms"])
+        result["timing"] = timing
+        result["region"] = region["bbox"] if region else None
 
         return result
 
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"編輯失敗: {str(e)}")
     finally:
-        file.file.close()
+        if file is not None:
+            file.file.close()
+        if overlay is not None:
+            overlay.file.close()
+
+
+async def prepare_edit_input(base_bytes: Optional[bytes], placements: Optional[list] = None,
+                             overlay_bytes: Optional[bytes] = None, region_list: Optional[list] = None,
+                             file_path: Optional[Path] = None):
+    """
+    準備送給模型的輸入圖：由底圖 + 家具擺放 / 疊加層合成，並準備 region mode
+
+    Args:
+        base_bytes: 底圖（file_path 為 None 時必須有）
+        placements: 家具擺放
+        overlay_bytes: 透明疊加層
+        region_list: region mode 的變動區域
+        file_path: 客戶端已合成好的輸入圖（有的話不再合成）
+
+    Returns:
+        Tuple[Path, Optional[dict], bool]: (輸入圖路徑, region mode 資料, 輸入圖是否就是底圖)
+    """
+    reuse_base = False
+    if file_path is None:
+        if placements or overlay_bytes:
+            # 由伺服器合成輸入圖
+            with jsonlog.stage("compose"):
+                composed = await asyncio.to_thread(
+                    composer.compose_scene,
+                    base_bytes,
+                    STATIC_DIR / "img",
+                    placements=placements,
+                    overlay_bytes=overlay_bytes
+                )
+        else:
+            # 沒有要合成的東西：直接使用底圖（可以使用 session 的 context cache）
+            composed = base_bytes
+            reuse_base = True
+        file_path = INPUT_DIR / f"{uuid.uuid4()}.png"
+        with open(file_path, "wb") as f:
+            f.write(composed)
+        retention_manager.track("input", file_path)
+
+    # region mode：只送變動區域給模型
+    region = None
+    if region_list and base_bytes is not None:
+        with jsonlog.stage("region_prepare"):
+            region = await asyncio.to_thread(prepare_region_edit, file_path, region_list, base_bytes)
+    return file_path, region, reuse_base
+
+
+def prepare_region_edit(file_path: Path, region_list: list, base_bytes: bytes) -> Optional[dict]:
+    """
+    準備 region mode：從合成圖裁出變動區域，並建立貼回底圖的後處理
+
+    Returns:
+        Optional[dict]: {"crop", "blend", "bbox"}；無法使用 region mode 時回傳 None（改為整張編輯）
+    """
+    composite_bytes = file_path.read_bytes()
+    composite_size = region_edit.image_size(composite_bytes)
+    bbox = region_edit.region_bbox(region_edit.parse_regions(region_list), *composite_size)
+    if bbox is None:
+        return None
+
+    base_bbox = region_edit.scale_bbox(bbox, composite_size, region_edit.image_size(base_bytes))
+
+    def blend(edited_bytes: bytes) -> bytes:
+        # 貼回後保持無損，未變動的區域才會逐像素不變（輸出格式由 output_encoder 決定）
+        return region_edit.blend_region(base_bytes, edited_bytes, base_bbox, format="PNG")
+
+    return {
+        "crop": region_edit.crop_region(composite_bytes, bbox),
+        "blend": blend,
+        "bbox": list(bbox),
+    }
+
+
+def save_upload(file: UploadFile) -> Path:
+    """
+    把上傳檔案存到 INPUT_DIR
+
+    Returns:
+        Path: 儲存後的路徑
+    """
+    file_extension = os.path.splitext(file.filename or "")[1] or ".jpg"
+    file_path = INPUT_DIR / f"{uuid.uuid4()}{file_extension}"
+    with open(file_path, "wb") as buffer:
+        shutil.copyfileobj(file.file, buffer)
+    retention_manager.track("input", file_path)
+    return file_path
+
+
+def starter_scene(ref: Optional[str]) -> Optional[str]:
+    """底圖是起始場景（/static/img/<scene>.png）時回傳場景名稱"""
+    if not ref:
+        return None
+    path = ref.split("?", 1)[0]
+    match = re.search(r"/static/img/([a-z]+)\.png$", path)
+    if match and match.group(1) in STARTER_SCENES:
+        return match.group(1)
+    return None
+
+
+async def produce_starter_stock(recipe: starter_stock.Recipe) -> Optional[str]:
+    """預先生成一張起始場景的第一步（不寫入任何 session，排程為 batch 優先度）"""
+    base_bytes = await asyncio.to_thread((STATIC_DIR / "img" / f"{recipe.scene}.png").read_bytes)
+    file_path, region, _ = await prepare_edit_input(base_bytes, recipe.placements, None, recipe.regions)
+    result, _ = await scheduler.run(
+        "starter-stock",
+        generate_nano_banana,
+        image_path=str(file_path),
+        user_prompt=recipe.prompt,
+        base_url=os.getenv("BASE_URL", "http://localhost:8000"),
+        image_bytes=region["crop"] if region else None,
+        postprocess=region["blend"] if region else None,
+        profile=recipe.profile,
+        priority="batch"
+    )
+    jsonlog.log("starter_stock_produced", scene=recipe.scene, recipe=recipe.key, status=result.get("status"))
+    if result.get("status") == "success":
+        return result["image_urls"][0]
+    return None
+
+
+# 起始場景的預先生成庫存（離峰時補貨）
+STARTER_STOCK_ENABLED = os.getenv("STARTER_STOCK_ENABLED", "false").lower() == "true"
+starter_stock_pool = starter_stock.StarterStock(
+    produce_starter_stock,
+    scheduler.idle,
+    depth=int(os.getenv("STARTER_STOCK_DEPTH", str(starter_stock.DEFAULT_DEPTH))),
+    max_age=float(os.getenv("STARTER_STOCK_MAX_AGE", str(starter_stock.DEFAULT_MAX_AGE))),
+    hourly_budget=int(os.getenv("STARTER_STOCK_HOURLY_BUDGET", str(starter_stock.DEFAULT_HOURLY_BUDGET))),
+    idle_seconds=float(os.getenv("STARTER_STOCK_IDLE_SECONDS", str(starter_stock.IDLE_SECONDS))),
+    # 所有 worker 共用庫存、預算與閒置狀態
+    state_path=BASE_DIR / ".starter_stock.json",
+)
+# 預設配方：每個起始場景 x 每個預設 prompt（與前端 buildPrompt 組出的 prompt 相同）
+for _text in filter(None, (t.strip() for t in os.getenv("STARTER_STOCK_PROMPTS", "make it look realistic").split("|"))):
+    for _scene in STARTER_SCENES:
+        starter_stock_pool.seed(starter_stock.Recipe(
+            scene=_scene,
+            prompt=f"{context_cache.KNOWN_INSTRUCTIONS[0]}{_text} \n",
+            profile=generation_profiles.DEFAULT_PROFILE,
+        ))
+
+
+async def take_starter_stock(session_id: str, scene: str, prompt: str, placements: Optional[list],
+                             region_list: Optional[list], profile: str) -> Optional[dict]:
+    """
+    session 的第一次編輯：從庫存取一張符合的結果並寫入 history
+
+    Returns:
+        Optional[dict]: 與 /api/edit 相同格式的結果；沒有庫存時回傳 None（照常生成）
+    """
+    recipe = await asyncio.to_thread(starter_stock_pool.observe, starter_stock.Recipe(
+        scene=scene,
+        prompt=prompt,
+        placements=starter_stock.canonical_placements(placements),
+        regions=region_list or None,
+        profile=profile,
+    ))
+    item = await asyncio.to_thread(starter_stock_pool.take, recipe)
+    jsonlog.log("starter_stock", session_id=session_id, scene=scene, recipe=recipe.key, hit=item is not None)
+    if item is None:
+        return None
+    await asyncio.to_thread(update_session_history, session_id, item.url)
+    return {
+        "status": "success",
+        "image_urls": [item.url],
+        "text": None,
+        "profile": profile,
+        "timing": {"queue_wait_ms": 0.0, "run_ms": 0.0},
+        "region": None,
+        "stock": {"age_s": round(time.time() - item.created_at, 1)},
+    }
+
+
+# 批次編輯寫入 session history 的背景工作（保留參照，避免被回收）
+batch_history_writers = set()
+
+
+@app.post("/api/edit/batch")
+async def edit_image_batch(
+    session_id: str = Form(...),
+    secret: str = Form(...),
+    prompts: List[str] = Form(...),
+    files: Optional[List[UploadFile]] = File(None),
+    starters: Optional[List[str]] = Form(None),
+    profile: Optional[str] = Form(None)
+):
+    """
+    批次編輯：一張圖 + 多個 prompt，或多張圖 + 一個 prompt
+
+    圖片來源可以是上傳的 files，或 starters（space/moon/mars/ship 起始場景）。
+    所有項目經由排程器併發呼叫 Gemini，結果以 NDJSON 串流，完成一個送出一行；
+    session history 則依項目順序（index）寫入，不受完成順序影響；
+    client 中途斷線時，項目仍會執行完並寫入 history。
+
+    Args:
+        session_id: Session ID (必須)
+        secret: Session secret (必須)
+        prompts: 編輯指令（可多個）
+        files: 要編輯的圖片（可多張）
+        starters: 起始場景名稱（可多個，取代 files）
+        profile: 生成設定檔，未指定時使用 session 的 generation_profile
+
+    Returns:
+        StreamingResponse: application/x-ndjson，每行一個項目結果，最後一行為 {"done": true}
+    """
+    if not verify_session(session_id, secret):
+        raise HTTPException(status_code=403, detail="Invalid session or secret")
+
+    session_data = None if profile else await asyncio.to_thread(read_session, session_id)
+    generation = resolve_generation_profile(profile, session_data)
+
+    files = files or []
+    starters = starters or []
+    for name in starters:
+        if name not in STARTER_SCENES:
+            raise HTTPException(status_code=400, detail=f"Unknown starter: {name}")
+
+    try:
+        image_paths = [save_upload(f) for f in files]
+    finally:
+        for f in files:
+            f.file.close()
+    image_paths += [STATIC_DIR / "img" / f"{name}.png" for name in starters]
+
+    if not image_paths:
+        raise HTTPException(status_code=400, detail="需要至少一張圖片 (files 或 starters)")
+    if len(image_paths) > 1 and len(prompts) > 1:
+        raise HTTPException(status_code=400, detail="多張圖片時只能有一個 prompt")
+
+    if len(image_paths) == 1:
+        items = [(image_paths[0], p) for p in prompts]
+    else:
+        items = [(path, prompts[0]) for path in image_paths]
+
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"批次最多 {BATCH_MAX_ITEMS} 個項目")
+
+    base_url = os.getenv("BASE_URL", "http://localhost:8000")
+
+    async def run_item(index: int, image_path: Path, prompt: str):
+        # session_id 不傳入，history 由 record_history 依順序寫入；
+        # 輸入不是 session 的底圖，也不使用 session 的 context cache
+        result, timing = await scheduler.run(
+            session_id,
+            generate_nano_banana,
+            image_path=str(image_path),
+            user_prompt=prompt,
+            base_url=base_url,
+            profile=generation.name,
+            priority="batch"
+        )
+        result["timing"] = timing
+        return index, prompt, result
+
+    tasks = [asyncio.create_task(run_item(i, path, prompt)) for i, (path, prompt) in enumerate(items)]
+
+    async def record_history():
+        """依 index 順序寫入 session history（與回應串流無關，client 斷線也會寫完）"""
+        for task in tasks:
+            await asyncio.wait([task])
+            if task.cancelled() or task.exception() is not None:
+                continue
+            _, _, result = task.result()
+            for image_url in result.get("image_urls") or []:
+                await asyncio.to_thread(update_session_history, session_id, image_url)
+
+    history_writer = asyncio.create_task(record_history())
+    batch_history_writers.add(history_writer)
+    history_writer.add_done_callback(batch_history_writers.discard)
+
+    async def stream():
+        for task in asyncio.as_completed(tasks):
+            index, prompt, result = await task
+            yield json.dumps({"index": index, "prompt": prompt, **result}, ensure_ascii=False) + "\n"
+
+        # done 之前 history 已寫完；client 斷線時 history_writer 仍繼續
+        await asyncio.shield(history_writer)
+        yield json.dumps({"done": True, "count": len(items)}) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
 
 
 @app.post("/api/edit-from-path")
@@ -495,12 +1394,16 @@ async def edit_from_path(
         # 取得當前請求的 base URL
         base_url = os.getenv("BASE_URL", "http://localhost:8000")
 
-        # 處理圖片
-        result = generate_nano_banana(
+        # 處理圖片（背景/批次等級）
+        result, timing = await scheduler.run(
+            "edit-from-path",
+            generate_nano_banana,
             image_path=file_path,
             user_prompt=prompt,
-            base_url=base_url
+            base_url=base_url,
+            priority="batch"
         )
+        result["timing"] = timing
 
         return result
 
@@ -508,12 +1411,245 @@ async def edit_from_path(
         raise HTTPException(status_code=500, detail=f"編輯失敗: {str(e)}")
 
 
+@app.get("/api/catalog")
+async def get_catalog(request: Request):
+    """
+    家具目錄：所有家具在 sprite atlas 中的位置
+
+    Returns:
+        dict: {"status", "version", "atlas_url", "cell_size", "columns", "width", "height", "items"}
+    """
+    index = await asyncio.to_thread(furniture_catalog.load)
+    etag = f'"{index["version"]}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=60"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    return JSONResponse(
+        {
+            "status": "success",
+            "atlas_url": f"/api/catalog/atlas-{index['version']}.webp",
+            **index
+        },
+        headers=headers
+    )
+
+
+@app.get("/api/catalog/atlas-{version}.webp")
+async def get_catalog_atlas(version: str):
+    """家具 sprite atlas（網址帶版本號，內容不會變動）"""
+    index = await asyncio.to_thread(furniture_catalog.load)
+    if version != index["version"]:
+        raise HTTPException(status_code=404, detail="Unknown catalog version")
+    return FileResponse(
+        str(furniture_catalog.atlas_path(version)),
+        media_type="image/webp",
+        headers={"Cache-Control": "public, max-age=31536000, immutable"}
+    )
+
+
+@app.get("/api/similar")
+async def similar_designs(image: str, k: int = 10):
+    """
+    相似設計（跨 session）
+
+    Args:
+        image: 結果圖片 URL 或檔名
+        k: 回傳數量（最多 50）
+
+    Returns:
+        dict: {"status", "image", "results": [{"name", "url", "similarity", "distance"}]}
+    """
+    if not SIMILARITY_ENABLED:
+        raise HTTPException(status_code=404, detail="Similarity index disabled")
+    k = max(1, min(k, 50))
+    index = await asyncio.to_thread(get_similarity_index)
+    name = Path(image.split("?", 1)[0]).name
+
+    results = await asyncio.to_thread(index.similar, name, k)
+    if results is None:
+        # 尚未索引（例如起始場景），直接計算特徵查詢
+        data = await asyncio.to_thread(resolve_image_reference, image)
+        if data is None:
+            raise HTTPException(status_code=404, detail="Image not found")
+        results = await asyncio.to_thread(index.similar_to_bytes, data, k)
+
+    for result in results:
+        result["url"] = result_url(result["name"])
+    return {
+        "status": "success",
+        "image": image,
+        "results": results
+    }
+
+
+@app.get("/_ah/warmup")
+async def warmup_handler():
+    """App Engine warmup request：預熱模組、client 與連線池"""
+    timings = await asyncio.to_thread(warmup)
+    return {
+        "status": "success",
+        "warmup": timings
+    }
+
+
 @app.get("/health")
 def health_check():
     """健康檢查端點"""
     return {
         "status": "healthy",
-        "api_key_set": bool(GOOGLE_API_KEY)
+        "api_key_set": bool(GOOGLE_API_KEY),
+        "gemini_backends": gemini_router.stats()
+    }
+
+
+@app.get("/api/metrics/scheduler")
+def scheduler_metrics():
+    """排程器指標：排隊數量、排隊等待時間與模型執行時間"""
+    return {
+        "status": "success",
+        "scheduler": scheduler.stats()
+    }
+
+
+@app.get("/api/metrics/watch")
+async def watch_metrics():
+    """long-poll / SSE 觀看者與讀取合併的統計"""
+    return session_watcher.stats()
+
+
+@app.get("/api/metrics/similarity")
+async def similarity_metrics():
+    """相似度索引：圖片數、重複數與背景佇列"""
+    if not SIMILARITY_ENABLED:
+        return {"enabled": False}
+    index = await asyncio.to_thread(get_similarity_index)
+    return await asyncio.to_thread(index.stats)
+
+
+@app.get("/api/profiles")
+async def list_generation_profiles():
+    """可用的生成設定檔"""
+    return {
+        "status": "success",
+        "default": generation_profiles.DEFAULT_PROFILE,
+        "profiles": [p.to_dict() for p in generation_profiles.PROFILES.values()]
+    }
+
+
+@app.get("/api/metrics/profiles")
+async def profile_metrics():
+    """各生成設定檔的延遲 (p50/p95) 與 token 用量"""
+    return generation_profiles.profile_metrics.stats()
+
+
+@app.get("/api/metrics/context-cache")
+async def context_cache_metrics():
+    """session context cache 的命中、建立、更新與失效次數"""
+    return context_cache.manager.stats()
+
+
+@app.get("/api/metrics/gcs-cache")
+async def gcs_cache_metrics():
+    """GCS 讀取快取：各層命中次數、重新驗證、負面快取與來源讀取"""
+    return {
+        "enabled": USE_GCS,
+        "caches": [session_cache.stats(), result_cache.stats()]
+    }
+
+
+@app.get("/api/metrics/encoding")
+async def encoding_metrics():
+    """結果圖片重新編碼：來源格式、編碼前後大小與節省比例"""
+    return output_encoder.stats()
+
+
+@app.get("/api/metrics/stock")
+async def stock_metrics():
+    """起始場景預先生成庫存：命中率、過期丟棄、預算與各配方的庫存"""
+    return {"enabled": STARTER_STOCK_ENABLED, **await asyncio.to_thread(starter_stock_pool.stats)}
+
+
+@app.get("/api/metrics/logging")
+async def logging_metrics():
+    """結構化 log 佇列：已寫入、丟棄與抽樣略過的數量"""
+    return jsonlog.logger.stats()
+
+
+@app.get("/api/metrics/retention")
+def retention_metrics():
+    """保留政策狀態：各目錄檔案數、容量與已清理數量"""
+    return {
+        "status": "success",
+        "retention": retention_manager.stats()
+    }
+
+
+def require_admin(token: Optional[str]):
+    """檢查管理端 token"""
+    if not ADMIN_TOKEN or not token or not secrets.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+
+@app.get("/api/admin/sessions")
+def admin_list_sessions(
+    limit: int = 50,
+    offset: int = 0,
+    order: str = "updated",
+    kind: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+    x_admin_token: Optional[str] = Header(None)
+):
+    """
+    管理端：依時間列出 session（由索引查詢，不掃描檔案）
+
+    Args:
+        limit: 筆數 (最多 500)
+        offset: 略過筆數
+        order: updated / created
+        kind: sess / short
+        since / until: ISO 時間範圍
+    """
+    require_admin(x_admin_token)
+    limit = max(1, min(limit, 500))
+    return {
+        "status": "success",
+        "total": sessions_db.count(kind=kind, since=since, until=until, order=order),
+        "sessions": sessions_db.list(limit=limit, offset=offset, order=order, kind=kind, since=since, until=until)
+    }
+
+
+@app.get("/api/admin/sessions/stats")
+def admin_session_stats(x_admin_token: Optional[str] = Header(None)):
+    """管理端：session 總數、圖片總數與時間範圍"""
+    require_admin(x_admin_token)
+    return {
+        "status": "success",
+        "stats": sessions_db.stats()
+    }
+
+
+@app.get("/api/admin/duplicates")
+def admin_duplicates(
+    kind: Optional[str] = None,
+    limit: int = 100,
+    offset: int = 0,
+    x_admin_token: Optional[str] = Header(None)
+):
+    """
+    管理端：標記為重複的結果圖片（exact = 內容完全相同，near = 幾乎相同），可用來清理儲存空間
+    """
+    require_admin(x_admin_token)
+    if not SIMILARITY_ENABLED:
+        raise HTTPException(status_code=404, detail="Similarity index disabled")
+    rows = get_similarity_index().duplicates(limit=max(1, min(limit, 1000)), offset=max(0, offset), kind=kind)
+    for row in rows:
+        row["url"] = result_url(row["name"])
+        row["duplicate_of_url"] = result_url(row["duplicate_of"])
+    return {
+        "status": "success",
+        "duplicates": rows
     }
 
 
@@ -534,9 +1670,7 @@ async def create_session():
     }
     
     # 儲存到檔案
-    session_file = SESSIONS_DIR / f"{session_id}.json"
-    with open(session_file, "w") as f:
-        json.dump(sessions[session_id], f, indent=2)
+    save_session_json(session_id, sessions[session_id])
     
     return {
         "status": "success",
@@ -574,11 +1708,107 @@ async def get_session(session_id: str):
     raise HTTPException(status_code=404, detail="Session not found")
 
 
+@app.get("/api/session/{session_id}/export.zip")
+async def export_session_zip(session_id: str):
+    """
+    以 ZIP 下載 session 的所有圖片
+
+    ZIP 邊產生邊送出，圖片以 stored 寫入，後面的圖片同時在背景讀取（本地或 GCS）
+
+    Args:
+        session_id: Session ID
+
+    Returns:
+        StreamingResponse: application/zip
+    """
+    session_data = sessions.get(session_id) or await asyncio.to_thread(load_session_json, session_id)
+    if not session_data:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    history = session_data.get("history") or []
+    entries = [
+        (f"{index:03d}-{Path(url.split('?', 1)[0]).name}", partial(resolve_image_reference, url))
+        for index, url in enumerate(history, start=1)
+    ]
+    manifest = json.dumps(session_data, ensure_ascii=False, indent=2).encode("utf-8")
+    entries.append(("session.json", lambda: manifest))
+
+    return StreamingResponse(
+        zip_export.stream_zip(entries, prefetch=int(os.getenv("EXPORT_PREFETCH", "4"))),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{session_id}.zip"'}
+    )
+
+
+@app.get("/api/session/{session_id}/history")
+async def get_session_history(session_id: str, since: Optional[int] = None, wait: float = 0):
+    """
+    增量取得 history（版本 = history 長度）
+
+    Args:
+        session_id: Session ID
+        since: 客戶端目前的版本，只回傳之後新增的圖片；未提供時回傳完整 history
+        wait: long-poll 秒數（最多 30），沒有新圖片時等待更新
+
+    Returns:
+        dict: {"status", "version", "since", "reset", "history"}
+    """
+    wait = max(0.0, min(wait, WATCH_MAX_WAIT))
+    if wait and since is not None:
+        session_data = await session_watcher.wait(session_id, since, wait)
+    else:
+        session_data = await session_watcher.read(session_id)
+    if not session_data:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    return {
+        "status": "success",
+        **session_watch.history_delta(session_data, since)
+    }
+
+
+@app.get("/api/session/{session_id}/events")
+async def session_events(session_id: str, request: Request, since: Optional[int] = None,
+                         last_event_id: Optional[str] = Header(None)):
+    """
+    Server-Sent Events：history 有新圖片時推送 delta
+
+    事件格式: event: history / id: <version> / data: {"version", "since", "reset", "history"}
+    重新連線時以 Last-Event-ID（或 since）接續
+    """
+    if last_event_id and last_event_id.isdigit():
+        since = int(last_event_id)
+    if not await session_watcher.read(session_id):
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    async def stream():
+        current = since
+        with session_watcher.watching(session_id):
+            while not await request.is_disconnected():
+                session_data = await session_watcher.wait(session_id, current, SSE_KEEPALIVE)
+                if session_data is None:
+                    yield "event: error\ndata: {\"detail\": \"Session not found\"}\n\n"
+                    return
+                delta = session_watch.history_delta(session_data, current)
+                if delta["reset"] or delta["history"]:
+                    current = delta["version"]
+                    yield f"id: {current}\nevent: history\ndata: {json.dumps(delta)}\n\n"
+                else:
+                    yield ": keep-alive\n\n"
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @app.post("/api/session/{session_id}/update")
 async def update_session(
     session_id: str,
     history: Optional[List[str]] = Form(None),
-    furniture_placements: Optional[str] = Form(None)
+    furniture_placements: Optional[str] = Form(None),
+    generation_profile: Optional[str] = Form(None)
 ):
     """
     更新 session 資料
@@ -587,39 +1817,54 @@ async def update_session(
         session_id: Session ID
         history: 圖片歷史記錄
         furniture_placements: 家具放置記錄 (JSON string)
+        generation_profile: 這個 session 預設的生成設定檔
         
     Returns:
         dict: 更新結果
     """
-    if session_id not in sessions:
-        # 嘗試從檔案載入
-        session_file = SESSIONS_DIR / f"{session_id}.json"
-        if session_file.exists():
-            with open(session_file, "r") as f:
-                sessions[session_id] = json.load(f)
-        else:
-            raise HTTPException(status_code=404, detail="Session not found")
-    
-    # 更新資料
-    if history:
-        sessions[session_id]["history"] = history
-    
+    placements = None
     if furniture_placements:
         try:
-            sessions[session_id]["furniture_placements"] = json.loads(furniture_placements)
+            placements = json.loads(furniture_placements)
         except json.JSONDecodeError:
             raise HTTPException(status_code=400, detail="Invalid furniture_placements JSON")
-    
-    sessions[session_id]["updated_at"] = datetime.now().isoformat()
-    
-    # 儲存到檔案
-    session_file = SESSIONS_DIR / f"{session_id}.json"
-    with open(session_file, "w") as f:
-        json.dump(sessions[session_id], f, indent=2)
+
+    if generation_profile and generation_profile not in generation_profiles.PROFILES:
+        raise HTTPException(status_code=400, detail=f"Unknown generation profile: {generation_profile}")
+
+    if history:
+        retention_manager.add_references(history)
+
+    for _ in range(SESSION_UPDATE_RETRIES):
+        # 讀取最新版本（其他 worker 可能剛寫入），以 generation 前置條件寫回
+        session_data, generation = load_session_for_update(session_id)
+        if not session_data:
+            raise HTTPException(status_code=404, detail="Session not found")
+
+        # 更新資料
+        if history:
+            session_data["history"] = history
+        if placements:
+            session_data["furniture_placements"] = placements
+        if generation_profile:
+            session_data["generation_profile"] = generation_profile
+        session_data["updated_at"] = datetime.now().isoformat()
+
+        # 儲存到檔案
+        try:
+            save_session_json(session_id, session_data, if_generation_match=generation)
+            break
+        except SessionConflict:
+            jsonlog.log("session_conflict", severity="WARNING", session_id=session_id)
+    else:
+        raise HTTPException(status_code=409, detail="Session was modified concurrently, please retry")
+
+    sessions[session_id] = session_data
+    session_watcher.publish(session_id, session_data)
     
     return {
         "status": "success",
-        "session": sessions[session_id]
+        "session": session_data
     }
 
 
@@ -637,6 +1882,58 @@ async def share_session(session_id: str):
     return FileResponse(str(STATIC_DIR / "share.html"))
 
 
+@app.get("/share/{session_id}/timelapse.{fmt}")
+async def share_timelapse(session_id: str, fmt: str, request: Request):
+    """
+    Session history 的縮時動畫 (gif / webp / mp4)
+
+    以 history 版本快取，history 新增圖片後只需處理新的 frame；
+    回應帶 ETag，內容未變時回傳 304
+
+    Args:
+        session_id: Session ID
+        fmt: gif / webp / mp4
+    """
+    if fmt not in timelapse.FORMATS:
+        raise HTTPException(status_code=404, detail="Unsupported format")
+    if fmt == "mp4" and not timelapse.mp4_available():
+        raise HTTPException(status_code=404, detail="MP4 export is not available on this server")
+
+    session_data = sessions.get(session_id) or await asyncio.to_thread(load_session_json, session_id)
+    history = (session_data or {}).get("history") or []
+    if not history:
+        raise HTTPException(status_code=404, detail="Session not found or no images")
+
+    version = timelapse.history_version(history)
+    etag = f'"{version}"'
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "public, max-age=60",
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    output = timelapse_renderer.cached_path(session_id, version, fmt)
+    if not output.exists():
+        sources = await asyncio.to_thread(lambda: [resolve_image_path(url) for url in history])
+        sources = [path for path in sources if path is not None]
+        if not sources:
+            raise HTTPException(status_code=404, detail="Images not found")
+        output = await timelapse_renderer.render(session_id, version, fmt, sources)
+
+    return FileResponse(
+        str(output),
+        media_type=timelapse.FORMATS[fmt],
+        headers=headers,
+        filename=f"{session_id}-timelapse.{fmt}",
+        content_disposition_type="inline"
+    )
+
+
+if STARTUP_MODE == "eager":
+    warmup()
+
+
 if __name__ == "__main__":
     # 本地開發用
     uvicorn.run(
@@ -0,0 +1,182 @@
+"""
+家具目錄 - 自動搜尋家具圖片並產生 sprite atlas
+
+- 搜尋 static/img/item*.png（依編號排序），記錄原始尺寸與 alpha 範圍
+- 每個家具裁掉透明邊緣後縮放到固定大小的格子，排成一張 WebP atlas
+- JSON 索引記錄每個家具在 atlas 中的位置；版本號由檔名、大小與修改時間決定，
+  圖片有變動時才重新產生，atlas URL 帶版本號可以長期快取
+- 家具面板只需要讀取索引與一張 atlas，不需要逐一下載原始圖片
+"""
+
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+from pathlib import Path
+from typing import List, Optional
+
+from PIL import Image
+
+ITEM_GLOB = "item*.png"
+# atlas 格子大小（面板顯示 80px，2x 解析度）
+CELL_SIZE = 160
+CELL_PADDING = 2
+ATLAS_QUALITY = 85
+INDEX_FORMAT = 1
+# 重新檢查家具圖片是否變動的間隔（秒）
+CHECK_INTERVAL = 30
+
+_NUMBER = re.compile(r"(\d+)")
+
+
+def _natural_key(path: Path):
+    return [int(part) if part.isdigit() else part for part in _NUMBER.split(path.stem)]
+
+
+def discover_items(item_dir: Path) -> List[Path]:
+    """家具圖片列表（item1, item2, ..., item10 的順序）"""
+    return sorted(item_dir.glob(ITEM_GLOB), key=_natural_key)
+
+
+def catalog_version(paths: List[Path], cell_size: int = CELL_SIZE) -> str:
+    """由檔名、大小、修改時間與 atlas 參數計算版本號"""
+    digest = hashlib.sha1(f"{INDEX_FORMAT}:{cell_size}:{CELL_PADDING}:{ATLAS_QUALITY}".encode("utf-8"))
+    for path in paths:
+        stat = path.stat()
+        digest.update(f"\n{path.name}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+    return digest.hexdigest()[:12]
+
+
+def _alpha_bbox(img: Image.Image):
+    """不透明範圍；沒有 alpha 或全透明時回傳整張圖"""
+    if img.mode in ("RGBA", "LA") or "transparency" in img.info:
+        bbox = img.convert("RGBA").getchannel("A").getbbox()
+        if bbox:
+            return bbox
+    return (0, 0, img.width, img.height)
+
+
+def build_atlas(paths: List[Path], atlas_path: Path, cell_size: int = CELL_SIZE) -> dict:
+    """
+    產生 atlas 圖片並回傳索引
+
+    Args:
+        paths: 家具圖片
+        atlas_path: 輸出的 WebP 路徑
+        cell_size: 格子大小
+
+    Returns:
+        dict: {"cell_size", "columns", "width", "height", "items": [...]}
+    """
+    columns = max(1, math.ceil(math.sqrt(len(paths))))
+    rows = max(1, math.ceil(len(paths) / columns))
+    atlas = Image.new("RGBA", (columns * cell_size, rows * cell_size), (0, 0, 0, 0))
+    inner = cell_size - CELL_PADDING * 2
+
+    items = []
+    for position, path in enumerate(paths):
+        with Image.open(path) as source:
+            width, height = source.size
+            bbox = _alpha_bbox(source)
+            sprite = source.convert("RGBA").crop(bbox)
+        sprite.thumbnail((inner, inner), Image.Resampling.LANCZOS)
+
+        col, row = position % columns, position // columns
+        x = col * cell_size + (cell_size - sprite.width) // 2
+        y = row * cell_size + (cell_size - sprite.height) // 2
+        atlas.alpha_composite(sprite, (x, y))
+
+        items.append({
+            "id": path.stem,
+            "src": f"/static/img/{path.name}",
+            "width": width,
+            "height": height,
+            "bbox": list(bbox),
+            "x": col * cell_size,
+            "y": row * cell_size,
+        })
+
+    tmp = atlas_path.with_name(f"{atlas_path.name}.{os.getpid()}.tmp")
+    atlas.save(tmp, format="WEBP", quality=ATLAS_QUALITY, method=6)
+    os.replace(tmp, atlas_path)
+
+    return {
+        "cell_size": cell_size,
+        "columns": columns,
+        "width": atlas.width,
+        "height": atlas.height,
+        "items": items,
+    }
+
+
+class FurnitureCatalog:
+    """
+    家具目錄（atlas 與索引快取在 cache_dir，以版本號命名）
+
+    Args:
+        item_dir: 家具圖片目錄 (static/img)
+        cache_dir: atlas 與索引輸出目錄
+        cell_size: atlas 格子大小
+    """
+
+    def __init__(self, item_dir: Path, cache_dir: Path, cell_size: int = CELL_SIZE):
+        self.item_dir = item_dir
+        self.cache_dir = cache_dir
+        self.cell_size = cell_size
+        self._lock = threading.Lock()
+        self._index: Optional[dict] = None
+        self._checked_at = 0.0
+
+    def atlas_path(self, version: str) -> Path:
+        return self.cache_dir / f"atlas-{version}.webp"
+
+    def _index_path(self, version: str) -> Path:
+        return self.cache_dir / f"index-{version}.json"
+
+    def load(self) -> dict:
+        """
+        取得目錄索引；家具圖片有變動（版本號不同）時重新產生
+
+        Returns:
+            dict: {"version", "count", "cell_size", "columns", "width", "height", "items"}
+        """
+        index = self._index
+        if index is not None and time.monotonic() - self._checked_at < CHECK_INTERVAL:
+            return index
+
+        paths = discover_items(self.item_dir)
+        version = catalog_version(paths, self.cell_size)
+        self._checked_at = time.monotonic()
+        if index is not None and index["version"] == version:
+            return index
+
+        with self._lock:
+            if self._index is not None and self._index["version"] == version:
+                return self._index
+
+            index_path = self._index_path(version)
+            if index_path.exists() and self.atlas_path(version).exists():
+                with open(index_path, "r") as f:
+                    index = json.load(f)
+            else:
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                index = build_atlas(paths, self.atlas_path(version), self.cell_size)
+                index = {"version": version, "count": len(paths), **index}
+                tmp = index_path.with_name(f"{index_path.name}.{os.getpid()}.tmp")
+                with open(tmp, "w") as f:
+                    json.dump(index, f)
+                os.replace(tmp, index_path)
+                self._prune(version)
+                print(f"🪑 Furniture catalog {version}: {len(paths)} items")
+
+            self._index = index
+            return index
+
+    def _prune(self, keep: str):
+        """刪除舊版本的 atlas 與索引"""
+        for old in list(self.cache_dir.glob("atlas-*.webp")) + list(self.cache_dir.glob("index-*.json")):
+            if keep not in old.name:
+                old.unlink(missing_ok=True)
@@ -0,0 +1,170 @@
+"""
+伺服器端合成 - 用伺服器上已有的底圖 + 家具擺放，組出送給模型的輸入圖
+
+繪製方式與 index.html 的 handleSubmit 相同（圖片、"move this object here" 文字、紅色箭頭），
+客戶端不需要再下載底圖、合成並重新上傳整張 PNG。
+"""
+
+import io
+import math
+import re
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+from PIL import Image, ImageDraw, ImageFont
+
+# 與 index.html 的 canvas 與 FURNITURE_DISPLAY 一致
+CANVAS_SIZE = (1184, 864)
+DEFAULT_ITEM_SIZE = 150
+# 家具大小上限（index.html 的尺寸滑桿最大 250），避免單一請求做超大的 resize
+MAX_ITEM_SIZE = 600
+LABEL_TEXT = "move this object here"
+ARROW_LENGTH = 40
+FONT_SIZE = 16
+SPACING = 5
+
+ITEM_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+def _font():
+    try:
+        return ImageFont.load_default(size=FONT_SIZE)
+    except TypeError:
+        # Pillow < 10.1 的 load_default 不支援 size
+        return ImageFont.load_default()
+
+
+def _draw_arrow(draw: ImageDraw.ImageDraw, x: float, y_from: float, y_to: float):
+    draw.line((x, y_from, x, y_to), fill="#FF0000", width=2)
+    draw.polygon([(x, y_to), (x - 8, y_to - 12), (x + 8, y_to - 12)], fill="#FF0000")
+
+
+def _draw_label(draw: ImageDraw.ImageDraw, x: float, baseline: float, font):
+    width = draw.textlength(LABEL_TEXT, font=font)
+    draw.text(
+        (x - width / 2, baseline),
+        LABEL_TEXT,
+        font=font,
+        fill="#FFFFFF",
+        stroke_width=1,
+        stroke_fill="#000000",
+        anchor="ls"
+    )
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def validate_placements(placements) -> List[dict]:
+    """
+    檢查家具擺放格式，size 限制在 1..MAX_ITEM_SIZE
+
+    Returns:
+        List[dict]: [{"id", "x", "y", "size"}, ...]
+
+    Raises:
+        ValueError: 不是 dict 的 list，或 x / y / size 不是數字
+    """
+    if not isinstance(placements, list):
+        raise ValueError("placements must be a list")
+    result = []
+    for placement in placements:
+        if not isinstance(placement, dict):
+            raise ValueError(f"Invalid placement: {placement!r}")
+        x, y, size = placement.get("x"), placement.get("y"), placement.get("size")
+        if not _is_number(x) or not _is_number(y) or (size is not None and not _is_number(size)):
+            raise ValueError(f"Invalid placement: {placement!r}")
+        if size is not None:
+            size = max(1, min(int(size), MAX_ITEM_SIZE))
+        result.append({"id": str(placement.get("id", "")), "x": x, "y": y, "size": size})
+    return result
+
+
+def load_item_image(item_dir: Path, item_id: str) -> Optional[Image.Image]:
+    """載入家具圖片（只接受簡單的 id，避免路徑穿越）"""
+    if not item_id or not ITEM_ID_PATTERN.match(item_id):
+        return None
+    path = item_dir / f"{item_id}.png"
+    if not path.exists():
+        return None
+    with Image.open(path) as img:
+        return img.convert("RGBA")
+
+
+def draw_placements(canvas: Image.Image, placements: List[dict], item_dir: Path):
+    """
+    在 canvas 上繪製家具擺放標示
+
+    Args:
+        canvas: RGBA 畫布
+        placements: [{"id", "x", "y", "size"}, ...]
+        item_dir: 家具圖片目錄 (static/img)
+    """
+    draw = ImageDraw.Draw(canvas)
+    font = _font()
+    width, height = canvas.size
+    label_width = draw.textlength(LABEL_TEXT, font=font)
+
+    for placement in placements:
+        item = load_item_image(item_dir, str(placement.get("id", "")))
+        if item is None:
+            continue
+        x = float(placement.get("x", 0))
+        y = float(placement.get("y", 0))
+        size = max(1, min(int(placement.get("size") or DEFAULT_ITEM_SIZE), MAX_ITEM_SIZE))
+        # 標示（圖片、文字、箭頭）不會離 (x, y) 超過 reach；完全在畫布外就不畫（座標太大時 PIL 也會 overflow）
+        reach = size + label_width + ARROW_LENGTH + FONT_SIZE + SPACING * 3
+        if not (-reach < x < width + reach and -reach < y < height + reach):
+            continue
+        item = item.resize((size, size), Image.Resampling.LANCZOS)
+
+        if y < height / 4:
+            # 上方 1/4: 文字 -> 圖片 -> 箭頭（箭頭在下方指向 y）
+            current_y = y - ARROW_LENGTH - SPACING
+            _draw_arrow(draw, x, current_y, y)
+            current_y = current_y - size - SPACING
+            canvas.alpha_composite(item, (int(x - size / 2), int(current_y)))
+            _draw_label(draw, x, current_y - SPACING, font)
+        else:
+            # 其他位置: 圖片 -> 文字 -> 箭頭
+            current_y = y - size - SPACING * 2 - FONT_SIZE - ARROW_LENGTH
+            canvas.alpha_composite(item, (int(x - size / 2), int(current_y)))
+            current_y += size + SPACING + FONT_SIZE
+            _draw_label(draw, x, current_y, font)
+            current_y += SPACING
+            _draw_arrow(draw, x, current_y, y)
+
+
+def compose_scene(base_bytes: bytes, item_dir: Path, placements: Optional[List[dict]] = None,
+                  overlay_bytes: Optional[bytes] = None,
+                  canvas_size: Tuple[int, int] = CANVAS_SIZE) -> bytes:
+    """
+    合成送給模型的輸入圖
+
+    Args:
+        base_bytes: 底圖（上一張結果或起始場景）
+        item_dir: 家具圖片目錄
+        placements: 家具擺放（伺服器端繪製）
+        overlay_bytes: 客戶端畫好的透明疊加層 PNG（只有家具標示）
+        canvas_size: 畫布大小（客戶端座標系）
+
+    Returns:
+        bytes: PNG
+    """
+    with Image.open(io.BytesIO(base_bytes)) as base_img:
+        canvas = base_img.convert("RGBA").resize(canvas_size, Image.Resampling.LANCZOS)
+
+    if overlay_bytes:
+        with Image.open(io.BytesIO(overlay_bytes)) as overlay_img:
+            overlay = overlay_img.convert("RGBA")
+        if overlay.size != canvas_size:
+            overlay = overlay.resize(canvas_size, Image.Resampling.LANCZOS)
+        canvas.alpha_composite(overlay)
+
+    if placements:
+        draw_placements(canvas, placements, item_dir)
+
+    buffer = io.BytesIO()
+    canvas.convert("RGB").save(buffer, format="PNG")
+    return buffer.getvalue()
@@ -0,0 +1,392 @@
+"""
+Session 層級的 Gemini context cache
+
+同一個 session 反覆編輯同一張圖時，每次都要重送整張圖和同一段指令前言。
+這裡為每個 session 建立一份 cached content：
+
+- 內容 = 固定的指令前言（system instruction）+ 目前的底圖
+- 請求只送使用者的文字，config 帶 cached_content；輸入圖不是快取的底圖時照常送完整內容
+- 第一次使用時建立；history 前進（產生新結果）時在背景換成新的底圖；
+  超過 TTL 自動失效（遠端的 cache 也會在 TTL 後自行刪除）
+- cache 綁定 backend（API key / 專案）與模型；建立失敗（模型不支援、token 數太少）時
+  該 backend + 模型在一段時間內不再嘗試，直接走一般請求
+- 使用 cache 的請求失敗（例如 cache 已過期）時，router 會改用完整內容重試
+
+stub backend 使用 FakeCacheService（記憶體內，介面與 client.caches 相同），
+不呼叫真正的 API 也能跑完整個建立 / 使用 / 更新 / 過期流程。
+"""
+
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Callable, Dict, Optional, Tuple
+
+import jsonlog
+
+DEFAULT_TTL = 600
+# 剩餘時間少於這個秒數的 cache 視為過期（避免請求途中過期）
+EXPIRY_MARGIN = 30
+# 建立失敗後，同一個 backend + 模型暫停嘗試的秒數
+UNSUPPORTED_COOLDOWN = 600
+MAX_SESSIONS = 200
+
+# index.html buildPrompt() 產生的固定前言（與使用者輸入的文字分開快取）
+# 有家具擺放時的 interior design / inpainting 前言不列入：那條路徑的輸入圖是底圖 + 家具標示的合成圖，
+# 每次都不同，不會是快取的底圖；只快取前言本身也遠低於 cached content 的最低 token 數
+KNOWN_INSTRUCTIONS = (
+    "Creatively reimagine and enhance the image(s). ",
+)
+
+
+def split_instructions(prompt: str) -> Tuple[Optional[str], str]:
+    """
+    把 prompt 拆成固定前言與使用者文字
+
+    Returns:
+        Tuple[Optional[str], str]: (前言, 其餘文字)；沒有已知前言或沒有其餘文字時前言為 None
+    """
+    for instructions in KNOWN_INSTRUCTIONS:
+        if prompt.startswith(instructions):
+            rest = prompt[len(instructions):].strip()
+            if rest:
+                return instructions.strip(), rest
+    return None, prompt
+
+
+def image_key(image_bytes: bytes) -> str:
+    return hashlib.sha1(image_bytes).hexdigest()
+
+
+class CacheNotFound(Exception):
+    """FakeCacheService 找不到（或已過期）的 cache"""
+    code = 404
+
+
+class FakeCacheService:
+    """
+    記憶體內的 client.caches（create / get / delete），給 stub backend 使用
+
+    Args:
+        clock: 時間來源（可替換以模擬過期）
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.time):
+        self.clock = clock
+        self._caches: Dict[str, SimpleNamespace] = {}
+        self._lock = threading.Lock()
+        self.created = 0
+        self.deleted = 0
+
+    def create(self, model: str, config) -> SimpleNamespace:
+        ttl = float(str(getattr(config, "ttl", None) or f"{DEFAULT_TTL}s").rstrip("s"))
+        cache = SimpleNamespace(
+            name=f"cachedContents/fake-{uuid.uuid4().hex[:12]}",
+            model=model,
+            contents=list(getattr(config, "contents", None) or []),
+            system_instruction=getattr(config, "system_instruction", None),
+            expire_time=self.clock() + ttl,
+            usage_metadata=SimpleNamespace(total_token_count=None),
+        )
+        with self._lock:
+            self._caches[cache.name] = cache
+            self.created += 1
+        return cache
+
+    def get(self, name: str) -> SimpleNamespace:
+        with self._lock:
+            cache = self._caches.get(name)
+            if cache is not None and cache.expire_time <= self.clock():
+                del self._caches[name]
+                cache = None
+        if cache is None:
+            raise CacheNotFound(f"404 NOT_FOUND: {name}")
+        return cache
+
+    def delete(self, name: str):
+        with self._lock:
+            if self._caches.pop(name, None) is not None:
+                self.deleted += 1
+
+    def __len__(self):
+        return len(self._caches)
+
+
+FAKE_CACHES = FakeCacheService()
+
+
+def caches_for(backend):
+    """backend 的 caches API（stub 使用 FakeCacheService）"""
+    return FAKE_CACHES if backend.stub else backend.client().caches
+
+
+@dataclass
+class CacheEntry:
+    session_id: str
+    backend: object
+    model: str
+    name: str
+    key: str
+    variant: str
+    instructions: Optional[str]
+    build: Callable[[bytes], Tuple[bytes, str]]
+    expires_at: float
+    tokens: Optional[int] = None
+    hits: int = 0
+
+
+class SessionContext:
+    """
+    一次生成可以使用的 context；交給 router，依實際選到的 backend 套用
+
+    Args:
+        manager: ContextCacheManager
+        session_id: Session ID
+        raw_bytes: 輸入圖（history 中的圖片，未經設定檔處理）
+        build: raw_bytes -> (送給模型的圖片, MIME type)
+        variant: 處理方式（生成設定檔名稱），不同 variant 不共用 cache
+        instructions: 固定前言（system instruction）
+        text: 每次請求送出的文字
+    """
+
+    def __init__(self, manager: "ContextCacheManager", session_id: str, raw_bytes: bytes,
+                 build: Callable[[bytes], Tuple[bytes, str]], variant: str,
+                 instructions: Optional[str], text: str):
+        self.manager = manager
+        self.session_id = session_id
+        self.raw_bytes = raw_bytes
+        self.key = image_key(raw_bytes)
+        self.build = build
+        self.variant = variant
+        self.instructions = instructions
+        self.text = text
+
+    def apply(self, backend, model: str, contents, config):
+        """
+        Returns:
+            Optional[tuple]: (contents, config) 使用 cache 的請求；無法使用 cache 時回傳 None
+        """
+        name = self.manager.acquire(self, backend, model)
+        if name is None:
+            return None
+        from google.genai import types
+        contents = [types.Content(role="user", parts=[types.Part.from_text(text=self.text)])]
+        return contents, config.model_copy(update={"cached_content": name})
+
+    def invalidate(self, backend):
+        self.manager.invalidate(self.session_id, backend.name)
+
+
+class ContextCacheManager:
+    """
+    Args:
+        ttl: cache 存活秒數
+        max_sessions: 最多保留的 cache 數（超過時刪除最久沒用的）
+        enabled: 是否啟用
+        caches_for: backend -> caches API
+    """
+
+    def __init__(self, ttl: int = DEFAULT_TTL, max_sessions: int = MAX_SESSIONS,
+                 enabled: bool = True, caches_for: Callable = caches_for):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.enabled = enabled and ttl > EXPIRY_MARGIN
+        self._caches_for = caches_for
+        self._entries: "OrderedDict[Tuple[str, str], CacheEntry]" = OrderedDict()
+        self._unsupported: Dict[Tuple[str, str], float] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="context-cache")
+        self.hits = 0
+        self.created = 0
+        self.refreshed = 0
+        self.expired = 0
+        self.invalidated = 0
+        self.evicted = 0
+        self.unsupported = 0
+        self.errors = 0
+
+    def context(self, session_id: Optional[str], raw_bytes: bytes, build: Callable[[bytes], Tuple[bytes, str]],
+                variant: str, prompt: str) -> Optional[SessionContext]:
+        """建立這次生成的 SessionContext；未啟用或沒有 session 時回傳 None"""
+        if not self.enabled or not session_id:
+            return None
+        instructions, text = split_instructions(prompt)
+        return SessionContext(self, session_id, raw_bytes, build, variant, instructions, text)
+
+    # -- 建立 / 查詢 --
+
+    def _create(self, context_or_entry, backend, model: str, raw_bytes: bytes) -> Optional[CacheEntry]:
+        from google.genai import types
+
+        image_data, mime_type = context_or_entry.build(raw_bytes)
+        config = types.CreateCachedContentConfig(
+            display_name=f"session-{context_or_entry.session_id}",
+            system_instruction=context_or_entry.instructions,
+            contents=[types.Content(role="user", parts=[types.Part.from_bytes(data=image_data, mime_type=mime_type)])],
+            ttl=f"{self.ttl}s",
+        )
+        try:
+            cache = self._caches_for(backend).create(model=model, config=config)
+        except Exception as e:
+            # 模型不支援、token 數低於下限等：這個 backend + 模型暫停嘗試
+            with self._lock:
+                self._unsupported[(backend.name, model)] = time.monotonic() + UNSUPPORTED_COOLDOWN
+                self.unsupported += 1
+            jsonlog.log("context_cache_unsupported", str(e), severity="WARNING",
+                        backend=backend.name, model=model, session_id=context_or_entry.session_id)
+            return None
+
+        usage = getattr(cache, "usage_metadata", None)
+        return CacheEntry(
+            session_id=context_or_entry.session_id,
+            backend=backend,
+            model=model,
+            name=cache.name,
+            key=image_key(raw_bytes),
+            variant=context_or_entry.variant,
+            instructions=context_or_entry.instructions,
+            build=context_or_entry.build,
+            expires_at=time.monotonic() + self.ttl - EXPIRY_MARGIN,
+            tokens=getattr(usage, "total_token_count", None),
+        )
+
+    def acquire(self, context: SessionContext, backend, model: str) -> Optional[str]:
+        """
+        取得可用的 cache 名稱；沒有時建立。無法使用 cache 時回傳 None
+        """
+        now = time.monotonic()
+        slot = (context.session_id, backend.name)
+        with self._lock:
+            if self._unsupported.get((backend.name, model), 0) > now:
+                return None
+            entry = self._entries.get(slot)
+            if entry is not None and entry.expires_at <= now:
+                del self._entries[slot]
+                self.expired += 1
+                entry = None
+            if (entry is not None and entry.key == context.key and entry.variant == context.variant
+                    and entry.model == model and entry.instructions == context.instructions):
+                entry.hits += 1
+                self.hits += 1
+                self._entries.move_to_end(slot)
+                return entry.name
+
+        entry = self._create(context, backend, model, context.raw_bytes)
+        if entry is None:
+            return None
+        with self._lock:
+            self.created += 1
+        self._store(slot, entry)
+        jsonlog.log("context_cache_created", session_id=context.session_id, backend=backend.name,
+                    model=model, tokens=entry.tokens)
+        return entry.name
+
+    def _store(self, slot: Tuple[str, str], entry: CacheEntry):
+        """放入新的 cache，刪除被取代或超過上限的舊 cache"""
+        stale = []
+        with self._lock:
+            old = self._entries.pop(slot, None)
+            if old is not None and old.name != entry.name:
+                stale.append(old)
+            self._entries[slot] = entry
+            while len(self._entries) > self.max_sessions:
+                _, evicted = self._entries.popitem(last=False)
+                stale.append(evicted)
+                self.evicted += 1
+        for old in stale:
+            self._delete(old)
+
+    def _delete(self, entry: CacheEntry):
+        """在背景刪除遠端 cache（失敗也沒關係，TTL 到了會自動刪除）"""
+        def run():
+            try:
+                self._caches_for(entry.backend).delete(name=entry.name)
+            except Exception as e:
+                with self._lock:
+                    self.errors += 1
+                jsonlog.log("context_cache_delete_failed", str(e), severity="WARNING", cache=entry.name)
+
+        try:
+            self._executor.submit(run)
+        except RuntimeError:
+            pass
+
+    # -- 更新 / 失效 --
+
+    def advance(self, session_id: str, raw_bytes: bytes):
+        """
+        session 產生新結果時呼叫：已有 cache 的 session 在背景換成新的底圖，
+        下一次編輯就能直接命中
+        """
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        key = image_key(raw_bytes)
+        with self._lock:
+            entries = [
+                (slot, entry) for slot, entry in self._entries.items()
+                if slot[0] == session_id and entry.expires_at > now and entry.key != key
+            ]
+        for slot, entry in entries:
+            try:
+                self._executor.submit(self._refresh, slot, entry, raw_bytes)
+            except RuntimeError:
+                return
+
+    def _refresh(self, slot: Tuple[str, str], entry: CacheEntry, raw_bytes: bytes):
+        with self._lock:
+            if self._entries.get(slot) is not entry:
+                return
+        try:
+            fresh = self._create(entry, entry.backend, entry.model, raw_bytes)
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+            jsonlog.log("context_cache_refresh_failed", str(e), severity="WARNING", session_id=entry.session_id)
+            return
+        if fresh is None:
+            return
+        with self._lock:
+            self.refreshed += 1
+        self._store(slot, fresh)
+
+    def invalidate(self, session_id: str, backend_name: str):
+        """使用 cache 的請求失敗時呼叫（cache 可能已被刪除或過期）"""
+        with self._lock:
+            entry = self._entries.pop((session_id, backend_name), None)
+            if entry is not None:
+                self.invalidated += 1
+        if entry is not None:
+            self._delete(entry)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "ttl": self.ttl,
+                "active": len(self._entries),
+                "hits": self.hits,
+                "created": self.created,
+                "refreshed": self.refreshed,
+                "expired": self.expired,
+                "invalidated": self.invalidated,
+                "evicted": self.evicted,
+                "unsupported": self.unsupported,
+                "errors": self.errors,
+            }
+
+
+# 全域 manager
+manager = ContextCacheManager(
+    ttl=int(os.getenv("CONTEXT_CACHE_TTL", str(DEFAULT_TTL))),
+    max_sessions=int(os.getenv("CONTEXT_CACHE_MAX_SESSIONS", str(MAX_SESSIONS))),
+    enabled=os.getenv("CONTEXT_CACHE_ENABLED", "false").lower() == "true",
+)
@@ -0,0 +1,319 @@
+"""
+Gemini 路由層 - 多 API key / 多專案 / 多模型負載平衡
+
+generate_nano_banana 透過 GeminiRouter 呼叫模型：
+- 維護一組 backend（API key、Vertex AI 專案），每個有權重
+- 追蹤每個 backend 的 in-flight 請求數與最近的 429 次數
+- 選擇負載最低且健康的 backend，失敗（429）時自動換下一個
+- 主要模型全部不可用時，改用設定的備用模型
+- GEMINI_BACKEND=stub 時使用本地 stub，不呼叫真正的 API（測試用）
+- 可帶入 session 的 context cache（context_cache.py），依選到的 backend 改用 cached content
+"""
+
+import os
+import time
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+from typing import Optional, List, Iterator
+
+import jsonlog
+import context_cache
+
+DEFAULT_MODEL = "gemini-2.5-flash-image"
+
+# 429 之後冷卻秒數、統計 429 的時間窗
+COOLDOWN_SECONDS = float(os.getenv("GEMINI_COOLDOWN_SECONDS", "30"))
+RATE_LIMIT_WINDOW = 60.0
+
+
+class NoBackendAvailable(Exception):
+    """沒有可用的 backend"""
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """
+    判斷是否為配額/速率限制錯誤 (HTTP 429 / RESOURCE_EXHAUSTED)
+
+    只看錯誤碼與 RESOURCE_EXHAUSTED 狀態；訊息中剛好出現 "429"（uuid、位元組數）不算
+    """
+    if getattr(error, "code", None) == 429 or getattr(error, "status_code", None) == 429:
+        return True
+    if getattr(error, "status", None) == "RESOURCE_EXHAUSTED":
+        return True
+    return "RESOURCE_EXHAUSTED" in str(error)
+
+
+@dataclass
+class Backend:
+    """單一 Gemini backend（一把 key 或一個 Vertex AI 專案 + 模型）"""
+    name: str
+    model: str = DEFAULT_MODEL
+    api_key: Optional[str] = None
+    vertexai: bool = False
+    project: Optional[str] = None
+    location: Optional[str] = None
+    weight: float = 1.0
+    fallback: bool = False
+    stub: bool = False
+    inflight: int = 0
+    total_requests: int = 0
+    total_errors: int = 0
+    cooldown_until: float = 0.0
+    recent_429s: deque = field(default_factory=deque)
+    _client: object = field(default=None, repr=False)
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.cooldown_until
+
+    def load(self) -> float:
+        """負載分數：in-flight 數量除以權重，加上近期 429 的懲罰"""
+        return (self.inflight + len(self.recent_429s)) / max(self.weight, 0.01)
+
+    def client(self):
+        """延遲建立 genai.Client，並重複使用"""
+        if self._client is None:
+            from google import genai
+            if self.vertexai:
+                self._client = genai.Client(
+                    vertexai=True,
+                    project=self.project,
+                    location=self.location or "global"
+                )
+            else:
+                self._client = genai.Client(vertexai=False, api_key=self.api_key)
+        return self._client
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "model": self.model,
+            "weight": self.weight,
+            "fallback": self.fallback,
+            "inflight": self.inflight,
+            "total_requests": self.total_requests,
+            "total_errors": self.total_errors,
+            "recent_429s": len(self.recent_429s),
+            "healthy": self.healthy(time.monotonic()),
+        }
+
+
+def stub_generate_content_stream(contents, config=None) -> Iterator:
+    """
+    本地 stub：把輸入圖片原封不動當成結果回傳
+    產生的 chunk 結構與 google.genai 的串流回應相同（text / candidates / inline_data）
+    """
+    image_data, mime_type = b"", "image/png"
+    cached_name = getattr(config, "cached_content", None)
+    if cached_name:
+        # cached content 放在請求內容前面（過期時與真實 API 一樣回傳 404）
+        contents = context_cache.FAKE_CACHES.get(cached_name).contents + list(contents or [])
+    for content in contents or []:
+        for part in getattr(content, "parts", None) or []:
+            inline = getattr(part, "inline_data", None)
+            if inline is not None and getattr(inline, "data", None):
+                image_data = inline.data
+                mime_type = getattr(inline, "mime_type", None) or mime_type
+
+    # 與真實模型一樣，response_modalities 只有 IMAGE 時不回傳文字
+    modalities = getattr(config, "response_modalities", None) or ["TEXT", "IMAGE"]
+    part = SimpleNamespace(inline_data=SimpleNamespace(data=image_data, mime_type=mime_type), text=None)
+    yield SimpleNamespace(
+        text="stub" if "TEXT" in modalities else None,
+        candidates=[SimpleNamespace(content=SimpleNamespace(parts=[part]))]
+    )
+
+
+class GeminiRouter:
+    """
+    在多個 backend 之間做負載平衡的路由器
+    """
+
+    def __init__(self, backends: List[Backend]):
+        if not backends:
+            raise ValueError("GeminiRouter 需要至少一個 backend")
+        self.backends = backends
+        self._lock = threading.Lock()
+
+    def _prune(self, backend: Backend, now: float):
+        while backend.recent_429s and now - backend.recent_429s[0] > RATE_LIMIT_WINDOW:
+            backend.recent_429s.popleft()
+
+    def pick(self, exclude: Optional[set] = None) -> Backend:
+        """
+        選擇負載最低的健康 backend；主要模型都不可用時才選備用模型
+        """
+        exclude = exclude or set()
+        now = time.monotonic()
+        with self._lock:
+            for backend in self.backends:
+                self._prune(backend, now)
+            candidates = [b for b in self.backends if b.name not in exclude and b.healthy(now)]
+            primary = [b for b in candidates if not b.fallback]
+            pool = primary or candidates
+            if not pool:
+                raise NoBackendAvailable("所有 Gemini backend 都在冷卻中")
+            return min(pool, key=lambda b: (b.load(), -b.weight))
+
+    def acquire(self, exclude: Optional[set] = None) -> Backend:
+        """取得 backend 並增加 in-flight 數量，用完必須呼叫 release()"""
+        backend = self.pick(exclude)
+        with self._lock:
+            backend.inflight += 1
+            backend.total_requests += 1
+        return backend
+
+    def release(self, backend: Backend):
+        with self._lock:
+            backend.inflight -= 1
+
+    def report_error(self, backend: Backend, error: Exception):
+        """記錄錯誤；429 時讓 backend 進入冷卻"""
+        now = time.monotonic()
+        with self._lock:
+            backend.total_errors += 1
+            if is_rate_limit_error(error):
+                backend.recent_429s.append(now)
+                backend.cooldown_until = now + COOLDOWN_SECONDS
+
+    def generate_content_stream(self, contents, config=None, model: Optional[str] = None,
+                                context=None) -> Iterator:
+        """
+        透過路由器呼叫 generate_content_stream
+        尚未收到任何 chunk 前遇到 429，會自動換下一個 backend 重試
+
+        Args:
+            contents: 要送給模型的內容
+            config: GenerateContentConfig
+            model: 指定模型（None 時使用 backend 自己的模型；備用 backend 一律用備用模型）
+            context: context_cache.SessionContext，選定 backend 後改用 cached content；
+                     使用 cache 的請求失敗時改用完整內容重試
+        """
+        tried = set()
+        last_error = None
+        while len(tried) < len(self.backends):
+            try:
+                backend = self.acquire(exclude=tried)
+            except NoBackendAvailable:
+                if last_error is not None:
+                    raise last_error
+                raise
+
+            tried.add(backend.name)
+            yielded = False
+            cached = None
+            try:
+                model_name = backend.model if backend.fallback else (model or backend.model)
+                if context is not None and config is not None:
+                    cached = context.apply(backend, model_name, contents, config)
+                request_contents, request_config = cached or (contents, config)
+                if backend.stub:
+                    stream = stub_generate_content_stream(request_contents, request_config)
+                else:
+                    stream = backend.client().models.generate_content_stream(
+                        model=model_name,
+                        contents=request_contents,
+                        config=request_config
+                    )
+                for chunk in stream:
+                    yielded = True
+                    yield chunk
+                return
+            except Exception as e:
+                if cached is not None and not yielded and not is_rate_limit_error(e):
+                    # cache 已過期或被刪除：不使用 cache，同一個 backend 再試一次
+                    jsonlog.log("context_cache_failed", str(e), severity="WARNING", backend=backend.name)
+                    context.invalidate(backend)
+                    context = None
+                    tried.discard(backend.name)
+                    continue
+                self.report_error(backend, e)
+                last_error = e
+                if yielded or not is_rate_limit_error(e):
+                    raise
+                jsonlog.log("gemini_rate_limited", f"Gemini backend {backend.name} rate limited, trying next backend",
+                            severity="WARNING", backend=backend.name)
+            finally:
+                self.release(backend)
+
+        raise last_error or NoBackendAvailable("沒有可用的 Gemini backend")
+
+    def warm(self):
+        """預先建立所有 backend 的 client（warmup 用）"""
+        for backend in self.backends:
+            if not backend.stub:
+                try:
+                    backend.client()
+                except Exception as e:
+                    print(f"⚠️  Gemini backend {backend.name} warmup failed: {e}")
+
+    def stats(self) -> List[dict]:
+        with self._lock:
+            return [b.stats() for b in self.backends]
+
+
+def _parse_weighted(entry: str):
+    """解析 'value' 或 'value@weight' 格式"""
+    if "@" in entry:
+        value, weight = entry.rsplit("@", 1)
+        try:
+            return value.strip(), float(weight)
+        except ValueError:
+            return entry.strip(), 1.0
+    return entry.strip(), 1.0
+
+
+def build_router_from_env(default_api_key: Optional[str] = None) -> GeminiRouter:
+    """
+    從環境變數建立路由器
+
+    環境變數:
+        GEMINI_BACKEND: 設為 "stub" 時使用本地 stub
+        GOOGLE_API_KEYS: 以逗號分隔的多把 key，可加權重，例如 "key1@2,key2"
+        VERTEX_PROJECTS: 以逗號分隔的 Vertex AI 專案，格式 "project:location@weight"
+        GEMINI_MODEL: 主要模型 (預設 gemini-2.5-flash-image)
+        GEMINI_FALLBACK_MODEL: 備用模型，主要模型都被限流時使用
+    """
+    model = os.getenv("GEMINI_MODEL", DEFAULT_MODEL)
+    fallback_model = os.getenv("GEMINI_FALLBACK_MODEL")
+
+    if os.getenv("GEMINI_BACKEND", "").lower() == "stub":
+        return GeminiRouter([Backend(name="stub", model=model, stub=True)])
+
+    backends: List[Backend] = []
+
+    keys = [k for k in os.getenv("GOOGLE_API_KEYS", "").split(",") if k.strip()]
+    if not keys and default_api_key:
+        keys = [default_api_key]
+    for index, entry in enumerate(keys):
+        api_key, weight = _parse_weighted(entry)
+        backends.append(Backend(name=f"key{index}", model=model, api_key=api_key, weight=weight))
+
+    projects = [p for p in os.getenv("VERTEX_PROJECTS", "").split(",") if p.strip()]
+    for entry in projects:
+        value, weight = _parse_weighted(entry)
+        project, _, location = value.partition(":")
+        backends.append(Backend(
+            name=f"vertex:{project}",
+            model=model,
+            vertexai=True,
+            project=project,
+            location=location or None,
+            weight=weight
+        ))
+
+    if fallback_model:
+        for backend in list(backends):
+            backends.append(Backend(
+                name=f"{backend.name}:fallback",
+                model=fallback_model,
+                api_key=backend.api_key,
+                vertexai=backend.vertexai,
+                project=backend.project,
+                location=backend.location,
+                weight=backend.weight,
+                fallback=True
+            ))
+
+    return GeminiRouter(backends)
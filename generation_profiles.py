@@ -0,0 +1,224 @@
+"""
+生成設定檔 (generation profile)
+
+- 每個設定檔決定回傳內容 (只要圖片 / 文字 + 圖片)、取樣參數、輸出比例與輸入縮圖
+- aspect_ratio="auto" 時依送給模型的圖片尺寸選最接近的支援比例，
+  上傳的圖不是 4:3 也不會被模型重新構圖
+- 每個設定檔分別記錄延遲（第一張圖、總時間）與 token 用量，
+  用來判斷哪個設定檔的品質足夠且成本最低
+
+選擇順序：request 的 profile > session 的 generation_profile > DEFAULT_GENERATION_PROFILE
+"""
+
+import io
+import math
+import os
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+from PIL import Image
+
+# 模型支援的輸出比例
+SUPPORTED_ASPECT_RATIOS = ["1:1", "2:3", "3:2", "3:4", "4:3", "4:5", "5:4", "9:16", "16:9", "21:9"]
+
+# 指標保留的樣本數
+METRIC_SAMPLES = 500
+
+
+@dataclass(frozen=True)
+class GenerationProfile:
+    """單一生成設定檔"""
+    name: str
+    description: str
+    response_modalities: Tuple[str, ...] = ("IMAGE",)
+    temperature: float = 1.0
+    top_p: float = 0.95
+    max_output_tokens: int = 32768
+    # "auto" = 依輸入圖片尺寸
+    aspect_ratio: str = "auto"
+    # 送給模型前把輸入圖縮到這個長邊（None 為原尺寸）
+    max_input_side: Optional[int] = None
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "description": self.description,
+            "response_modalities": list(self.response_modalities),
+            "temperature": self.temperature,
+            "max_output_tokens": self.max_output_tokens,
+            "aspect_ratio": self.aspect_ratio,
+            "max_input_side": self.max_input_side,
+        }
+
+
+PROFILES: Dict[str, GenerationProfile] = {
+    "draft": GenerationProfile(
+        name="draft",
+        description="快速草稿：只回傳圖片，輸入縮到 1024px",
+        max_output_tokens=8192,
+        max_input_side=1024,
+    ),
+    "final": GenerationProfile(
+        name="final",
+        description="正式結果：只回傳圖片，原尺寸輸入",
+    ),
+    "classic": GenerationProfile(
+        name="classic",
+        description="舊行為：文字 + 圖片，固定 4:3",
+        response_modalities=("TEXT", "IMAGE"),
+        aspect_ratio="4:3",
+    ),
+}
+
+DEFAULT_PROFILE = os.getenv("DEFAULT_GENERATION_PROFILE", "final")
+if DEFAULT_PROFILE not in PROFILES:
+    DEFAULT_PROFILE = "final"
+
+
+def resolve_profile(*names: Optional[str]) -> GenerationProfile:
+    """
+    依序取第一個有值的設定檔名稱（request、session），都沒有時使用預設
+
+    Raises:
+        KeyError: 指定了不存在的設定檔
+    """
+    for name in names:
+        if name:
+            if name not in PROFILES:
+                raise KeyError(name)
+            return PROFILES[name]
+    return PROFILES[DEFAULT_PROFILE]
+
+
+def closest_aspect_ratio(width: int, height: int) -> str:
+    """最接近 width:height 的支援比例（以對數距離比較）"""
+    target = math.log(width / height)
+
+    def distance(ratio: str) -> float:
+        w, h = ratio.split(":")
+        return abs(math.log(int(w) / int(h)) - target)
+
+    return min(SUPPORTED_ASPECT_RATIOS, key=distance)
+
+
+def prepare_input(image_bytes: bytes, profile: GenerationProfile) -> Tuple[bytes, str, str]:
+    """
+    依設定檔準備送給模型的圖片
+
+    Returns:
+        Tuple[bytes, str, str]: (圖片資料, MIME type, aspect_ratio)
+    """
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        width, height = img.size
+        mime_type = Image.MIME.get(img.format or "", "image/jpeg")
+        aspect_ratio = profile.aspect_ratio
+        if aspect_ratio == "auto":
+            aspect_ratio = closest_aspect_ratio(width, height)
+
+        if profile.max_input_side and max(width, height) > profile.max_input_side:
+            resized = img.convert("RGB")
+            resized.thumbnail((profile.max_input_side, profile.max_input_side), Image.Resampling.LANCZOS)
+            buffer = io.BytesIO()
+            resized.save(buffer, format="JPEG", quality=90)
+            return buffer.getvalue(), "image/jpeg", aspect_ratio
+
+    return image_bytes, mime_type, aspect_ratio
+
+
+def _percentile(samples, pct: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return round(ordered[index], 1)
+
+
+class _ProfileStats:
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.images = 0
+        self.total_ms = deque(maxlen=METRIC_SAMPLES)
+        self.first_image_ms = deque(maxlen=METRIC_SAMPLES)
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.total_tokens = 0
+        self.cached_tokens = 0
+        self.token_samples = 0
+
+
+class ProfileMetrics:
+    """各設定檔的延遲與 token 用量（生成在 thread pool 執行，需要 lock）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._profiles: Dict[str, _ProfileStats] = {}
+
+    def record(self, profile: str, total_ms: float, first_image_ms: Optional[float],
+               images: int, usage: Optional[dict] = None, error: bool = False):
+        """
+        記錄一次生成
+
+        Args:
+            profile: 設定檔名稱
+            total_ms: 從呼叫模型到串流結束的時間
+            first_image_ms: 收到第一張圖的時間（沒有圖時為 None）
+            images: 生成的圖片數
+            usage: {"prompt_tokens", "cached_tokens", "output_tokens", "total_tokens"}（模型有回傳時）
+            error: 是否失敗
+        """
+        with self._lock:
+            stats = self._profiles.setdefault(profile, _ProfileStats())
+            stats.requests += 1
+            stats.images += images
+            if error:
+                stats.errors += 1
+                return
+            stats.total_ms.append(total_ms)
+            if first_image_ms is not None:
+                stats.first_image_ms.append(first_image_ms)
+            if usage:
+                stats.prompt_tokens += usage.get("prompt_tokens") or 0
+                stats.output_tokens += usage.get("output_tokens") or 0
+                stats.total_tokens += usage.get("total_tokens") or 0
+                stats.cached_tokens += usage.get("cached_tokens") or 0
+                stats.token_samples += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            result = {}
+            for name, stats in self._profiles.items():
+                samples = stats.token_samples
+                result[name] = {
+                    "requests": stats.requests,
+                    "errors": stats.errors,
+                    "images": stats.images,
+                    "total_ms_p50": _percentile(stats.total_ms, 50),
+                    "total_ms_p95": _percentile(stats.total_ms, 95),
+                    "first_image_ms_p50": _percentile(stats.first_image_ms, 50),
+                    "first_image_ms_p95": _percentile(stats.first_image_ms, 95),
+                    "prompt_tokens_avg": round(stats.prompt_tokens / samples, 1) if samples else None,
+                    "cached_tokens_avg": round(stats.cached_tokens / samples, 1) if samples else None,
+                    "output_tokens_avg": round(stats.output_tokens / samples, 1) if samples else None,
+                    "total_tokens": stats.total_tokens,
+                }
+            return {"default": DEFAULT_PROFILE, "profiles": result}
+
+
+def usage_from_chunk(chunk) -> Optional[dict]:
+    """從串流 chunk 取出 token 用量（最後一個 chunk 的值為整次呼叫的總數）"""
+    usage = getattr(chunk, "usage_metadata", None)
+    if usage is None:
+        return None
+    return {
+        "prompt_tokens": getattr(usage, "prompt_token_count", None),
+        "cached_tokens": getattr(usage, "cached_content_token_count", None),
+        "output_tokens": getattr(usage, "candidates_token_count", None),
+        "total_tokens": getattr(usage, "total_token_count", None),
+    }
+
+
+# 全域指標
+profile_metrics = ProfileMetrics()
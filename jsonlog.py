@@ -0,0 +1,295 @@
+"""
+非同步結構化 log（JSON lines）
+
+- log() 只把事件放進佇列，由背景 thread 批次寫到 stdout；
+  log pipe 塞住時 request 不會被卡住（佇列滿了就丟棄並計數）
+- request id 存在 contextvars，asyncio task 與 asyncio.to_thread 會自動帶入，
+  generate_nano_banana 與儲存函式不需要額外傳參數
+- stage(name) 記錄各階段耗時，request 結束時與 request log 一起輸出
+- 高頻事件可抽樣（LOG_SAMPLING=event=rate,...），WARNING 以上一律輸出
+- 欄位符合 Cloud Logging 的結構化格式（severity、message、logging.googleapis.com/trace）
+"""
+
+import atexit
+import contextvars
+import json
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+# 預設抽樣比例（高頻事件）
+DEFAULT_SAMPLING = {
+    "session_verified": 0.1,
+    "gcs_save": 0.2,
+    "static_request": 0.01,
+}
+
+QUEUE_SIZE = 10000
+BATCH_SIZE = 200
+
+# 接受客戶端傳入的 X-Request-ID（限制長度與字元）
+_REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+_request_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+_trace: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("trace", default=None)
+_stages: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar("stages", default=None)
+
+
+def parse_sampling(value: Optional[str]) -> Dict[str, float]:
+    """'gcs_save=0.1,session_verified=0' -> {"gcs_save": 0.1, "session_verified": 0.0}"""
+    rates = dict(DEFAULT_SAMPLING)
+    for item in (value or "").split(","):
+        if "=" not in item:
+            continue
+        event, rate = item.split("=", 1)
+        try:
+            rates[event.strip()] = max(0.0, min(1.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+class AsyncJsonLogger:
+    """
+    Args:
+        stream: 輸出（預設 stdout）
+        sampling: 事件抽樣比例
+        project: GCP project（有值時輸出 Cloud Logging 的 trace 欄位）
+    """
+
+    def __init__(self, stream=None, sampling: Optional[Dict[str, float]] = None,
+                 project: Optional[str] = None, queue_size: int = QUEUE_SIZE):
+        self.stream = stream or sys.stdout
+        self.sampling = sampling if sampling is not None else dict(DEFAULT_SAMPLING)
+        self.project = project
+        self._queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._start_lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="jsonlog-writer", daemon=True)
+                    self._thread.start()
+                    atexit.register(self.flush)
+
+    def log(self, event: str, message: Optional[str] = None, severity: str = "INFO",
+            sample: Optional[float] = None, **fields):
+        """
+        記錄一個事件（不阻塞）
+
+        Args:
+            event: 事件名稱（也是抽樣的 key）
+            message: 人看的訊息（預設為 event）
+            severity: DEBUG / INFO / WARNING / ERROR
+            sample: 抽樣比例，未指定時使用設定值
+            **fields: 其他欄位
+        """
+        if severity not in ("WARNING", "ERROR"):
+            rate = self.sampling.get(event, 1.0) if sample is None else sample
+            if rate < 1.0 and random.random() >= rate:
+                self.sampled_out += 1
+                return
+            if rate < 1.0:
+                fields["sample_rate"] = rate
+
+        record = {
+            "time": datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+            "severity": severity,
+            "event": event,
+            "message": message or event,
+        }
+        request_id = _request_id.get()
+        if request_id:
+            record["request_id"] = request_id
+        trace = _trace.get()
+        if trace and self.project:
+            record["logging.googleapis.com/trace"] = f"projects/{self.project}/traces/{trace}"
+        record.update(fields)
+
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write(self, records):
+        lines = []
+        for record in records:
+            try:
+                lines.append(json.dumps(record, ensure_ascii=False, default=str))
+            except (TypeError, ValueError):
+                lines.append(json.dumps({"severity": "ERROR", "event": "log_encode_failed",
+                                         "message": repr(record)[:500]}))
+        try:
+            self.stream.write("\n".join(lines) + "\n")
+            self.stream.flush()
+            self.written += len(lines)
+        except Exception:
+            self.dropped += len(lines)
+
+    def _run(self):
+        while True:
+            records = [self._queue.get()]
+            while len(records) < BATCH_SIZE:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(records)
+            for _ in records:
+                self._queue.task_done()
+
+    def flush(self, timeout: float = 2.0):
+        """等待佇列寫完（結束時呼叫）"""
+        if self._thread is None:
+            return
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+        }
+
+
+# 全域 logger
+logger = AsyncJsonLogger(
+    sampling=parse_sampling(os.getenv("LOG_SAMPLING")),
+    project=os.getenv("GOOGLE_CLOUD_PROJECT")
+)
+
+
+def log(event: str, message: Optional[str] = None, severity: str = "INFO",
+        sample: Optional[float] = None, **fields):
+    logger.log(event, message, severity, sample, **fields)
+
+
+# ---------------------------------------------------------------------------
+# Request context
+# ---------------------------------------------------------------------------
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def current_request_id() -> Optional[str]:
+    return _request_id.get()
+
+
+@contextmanager
+def request_context(request_id: Optional[str] = None, trace: Optional[str] = None):
+    """
+    設定目前 request 的 id、trace 與 stage 計時
+
+    Yields:
+        dict: 各階段耗時 (ms)，request 結束後可一起輸出
+    """
+    stages: Dict[str, float] = {}
+    tokens = (
+        _request_id.set(request_id or new_request_id()),
+        _trace.set(trace),
+        _stages.set(stages),
+    )
+    try:
+        yield stages
+    finally:
+        _stages.reset(tokens[2])
+        _trace.reset(tokens[1])
+        _request_id.reset(tokens[0])
+
+
+@contextmanager
+def stage(name: str):
+    """記錄一個階段的耗時（同一 request 中重複的階段會累加）"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stages = _stages.get()
+        if stages is not None:
+            elapsed = (time.perf_counter() - started) * 1000
+            stages[f"{name}_ms"] = round(stages.get(f"{name}_ms", 0.0) + elapsed, 1)
+
+
+def record_stage(name: str, ms: float):
+    """記錄已知的階段耗時（例如排程器回傳的排隊時間）"""
+    stages = _stages.get()
+    if stages is not None:
+        stages[f"{name}_ms"] = round(stages.get(f"{name}_ms", 0.0) + ms, 1)
+
+
+class RequestLogMiddleware:
+    """
+    ASGI middleware：每個 request 設定 request id（X-Request-ID，或 App Engine 的 trace id），
+    回應帶 X-Request-ID，結束時（包含串流回應送完）輸出一筆 request log 與各階段耗時
+
+    Args:
+        app: ASGI app
+        static_prefixes: 靜態檔案路徑，以 static_request 事件記錄（預設高比例抽樣）
+    """
+
+    def __init__(self, app, static_prefixes=("/static/", "/images/")):
+        self.app = app
+        self.static_prefixes = tuple(static_prefixes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+        trace = headers.get("x-cloud-trace-context", "").split("/", 1)[0] or None
+        request_id = headers.get("x-request-id")
+        if not request_id or not _REQUEST_ID_PATTERN.match(request_id):
+            request_id = None
+
+        status = {"code": 500}
+        started = time.perf_counter()
+        with request_context(request_id, trace) as stages:
+            request_id = current_request_id()
+
+            async def send_with_request_id(message):
+                if message["type"] == "http.response.start":
+                    status["code"] = message["status"]
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"x-request-id", request_id.encode("latin-1"))
+                    ]
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_request_id)
+            finally:
+                path = scope.get("path", "")
+                method = scope.get("method", "")
+                code = status["code"]
+                fields = {
+                    "method": method,
+                    "path": path,
+                    "status": code,
+                    "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+                }
+                if stages:
+                    fields["stages"] = dict(stages)
+                log(
+                    "static_request" if path.startswith(self.static_prefixes) else "request",
+                    f"{method} {path} {code}",
+                    severity="ERROR" if code >= 500 else "INFO",
+                    **fields
+                )
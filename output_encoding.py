@@ -0,0 +1,198 @@
+"""
+生成結果的輸出編碼
+
+模型回傳的 inline_data 可能是 PNG 或 JPEG（region mode 貼回後是 PNG），
+以前一律存成 .jpg、Content-Type 由副檔名決定，內容原封不動。
+
+- 由檔頭判斷實際格式
+- 重新編碼成設定的輸出格式（progressive JPEG 或 WebP），副檔名與 Content-Type 跟著實際格式
+- 重新編碼後反而變大、且原始格式已經適合直接提供時，保留原始資料
+- region mode 貼回的 PNG 不做有損編碼（未變動的區域要逐像素不變）
+- 記錄編碼前後的大小，統計節省的位元組
+
+encode_result 在生成的 worker thread 中執行，不會佔用 event loop。
+"""
+
+import io
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+from PIL import Image
+
+# 結果圖片檔名唯一、內容不會變，可以長期快取
+RESULT_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+CONTENT_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".webp": "image/webp",
+    ".gif": "image/gif",
+    ".json": "application/json",
+}
+
+EXTENSIONS = {
+    "jpeg": ".jpg",
+    "png": ".png",
+    "webp": ".webp",
+    "gif": ".gif",
+}
+
+DEFAULT_QUALITY = {
+    "jpeg": 85,
+    "webp": 80,
+}
+
+# 不需要重新編碼也適合直接提供的格式
+WEB_FORMATS = {"jpeg", "webp"}
+
+METRIC_SAMPLES = 500
+
+
+def content_type_for(filename: str, default: str = "application/octet-stream") -> str:
+    """依副檔名決定 Content-Type"""
+    return CONTENT_TYPES.get(os.path.splitext(filename)[1].lower(), default)
+
+
+def detect_format(data: bytes) -> Optional[str]:
+    """由檔頭判斷格式（jpeg / png / webp / gif），無法判斷時回傳 None"""
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpeg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    return None
+
+
+@dataclass
+class EncodedImage:
+    data: bytes
+    format: str
+    source_format: Optional[str]
+    source_bytes: int
+    reencoded: bool
+
+    @property
+    def extension(self) -> str:
+        return EXTENSIONS.get(self.format, ".bin")
+
+    @property
+    def content_type(self) -> str:
+        return content_type_for(self.extension)
+
+
+class OutputEncoder:
+    """
+    Args:
+        format: 輸出格式 jpeg / webp / original（不重新編碼，只修正副檔名與 Content-Type）
+        quality: 編碼品質（None 時使用各格式的預設值）
+    """
+
+    def __init__(self, format: str = "jpeg", quality: Optional[int] = None):
+        if format not in ("jpeg", "webp", "original"):
+            raise ValueError(f"Unsupported output format: {format}")
+        self.format = format
+        self.quality = quality or DEFAULT_QUALITY.get(format)
+        self._lock = threading.Lock()
+        self._encode_ms = deque(maxlen=METRIC_SAMPLES)
+        self.images = 0
+        self.reencoded = 0
+        self.kept_original = 0
+        self.failed = 0
+        self.source_bytes = 0
+        self.output_bytes = 0
+        self.source_formats = {}
+
+    def _encode(self, data: bytes) -> bytes:
+        with Image.open(io.BytesIO(data)) as img:
+            img.load()
+            has_alpha = img.mode in ("RGBA", "LA") or "transparency" in img.info
+            buffer = io.BytesIO()
+            if self.format == "webp":
+                img.convert("RGBA" if has_alpha else "RGB").save(
+                    buffer, format="WEBP", quality=self.quality, method=4
+                )
+            else:
+                img.convert("RGB").save(
+                    buffer, format="JPEG", quality=self.quality, optimize=True, progressive=True
+                )
+        return buffer.getvalue()
+
+    def encode(self, data: bytes, lossless: bool = False) -> EncodedImage:
+        """
+        把生成的圖片轉成輸出格式
+
+        Args:
+            data: 生成的圖片
+            lossless: 來源是 PNG 時保留原始資料（不做有損編碼）
+
+        Returns:
+            EncodedImage: 編碼後的資料、實際格式與原始大小
+        """
+        started = time.perf_counter()
+        source_format = detect_format(data)
+        result = EncodedImage(data, source_format or "jpeg", source_format, len(data), False)
+
+        keep_lossless = lossless and source_format == "png"
+        if self.format != "original" and source_format is not None and not keep_lossless:
+            try:
+                encoded = self._encode(data)
+            except Exception:
+                encoded = None
+                with self._lock:
+                    self.failed += 1
+            if encoded is not None:
+                if len(encoded) < len(data) or source_format not in WEB_FORMATS:
+                    result = EncodedImage(encoded, self.format, source_format, len(data), True)
+
+        elapsed = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self.images += 1
+            self._encode_ms.append(elapsed)
+            self.source_bytes += len(data)
+            self.output_bytes += len(result.data)
+            key = source_format or "unknown"
+            self.source_formats[key] = self.source_formats.get(key, 0) + 1
+            if result.reencoded:
+                self.reencoded += 1
+            else:
+                self.kept_original += 1
+        return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            ordered = sorted(self._encode_ms)
+            return {
+                "format": self.format,
+                "quality": self.quality,
+                "images": self.images,
+                "reencoded": self.reencoded,
+                "kept_original": self.kept_original,
+                "failed": self.failed,
+                "source_formats": dict(self.source_formats),
+                "source_bytes": self.source_bytes,
+                "output_bytes": self.output_bytes,
+                "saved_bytes": self.source_bytes - self.output_bytes,
+                "saved_ratio": round(1 - self.output_bytes / self.source_bytes, 4) if self.source_bytes else None,
+                "encode_ms_p50": round(ordered[len(ordered) // 2], 1) if ordered else None,
+            }
+
+
+def encoder_from_env() -> OutputEncoder:
+    """
+    環境變數:
+        OUTPUT_FORMAT: jpeg (預設) / webp / original
+        OUTPUT_QUALITY: 編碼品質（jpeg 預設 85，webp 預設 80）
+    """
+    format = os.getenv("OUTPUT_FORMAT", "jpeg").lower()
+    if format not in ("jpeg", "webp", "original"):
+        format = "jpeg"
+    quality = os.getenv("OUTPUT_QUALITY")
+    return OutputEncoder(format, int(quality) if quality else None)
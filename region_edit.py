@@ -0,0 +1,173 @@
+"""
+區域編輯 (region mode) - 只把有變動的區域送給模型，再貼回上一張結果
+
+流程：
+1. 依家具擺放的 bounding box 算出聯集，加上 padding，擴展成 4:3
+2. 從上傳的合成圖裁出該區域送給 Gemini
+3. 模型回傳的圖縮放回區域大小，以羽化遮罩貼回上一張結果
+未變動的區域直接沿用上一張結果，像素完全不變
+"""
+
+import io
+import math
+from typing import List, Optional, Sequence, Tuple
+
+from PIL import Image, ImageDraw, ImageFilter
+
+# 區域外擴的像素
+REGION_PADDING = 48
+# 羽化邊緣寬度
+FEATHER = 24
+# 區域最小邊長（太小的 crop 模型效果差）
+MIN_REGION_SIZE = 256
+# 區域佔整張圖超過這個比例時，直接整張編輯
+MAX_REGION_RATIO = 0.6
+# 區域固定擴展成 4:3（模型支援的比例；aspect_ratio=auto 時依 crop 尺寸選到同一個比例）
+ASPECT_RATIO = 4 / 3
+
+BBox = Tuple[int, int, int, int]
+
+
+def parse_regions(regions: Sequence) -> List[BBox]:
+    """
+    解析 [x, y, w, h] 或 {"x","y","w","h"} 格式的區域
+
+    Returns:
+        List[BBox]: (left, top, right, bottom)
+
+    Raises:
+        ValueError: 格式不正確（不是 list、缺少欄位或不是有限的數字）
+    """
+    if regions is None:
+        return []
+    if not isinstance(regions, list):
+        raise ValueError("regions must be a list")
+    boxes = []
+    for region in regions:
+        if isinstance(region, dict):
+            values = (
+                region.get("x"),
+                region.get("y"),
+                region.get("w", region.get("width")),
+                region.get("h", region.get("height")),
+            )
+        elif isinstance(region, (list, tuple)) and len(region) == 4:
+            values = tuple(region)
+        else:
+            raise ValueError(f"Invalid region: {region!r}")
+        if not all(isinstance(v, (int, float)) and not isinstance(v, bool) and math.isfinite(v) for v in values):
+            raise ValueError(f"Invalid region: {region!r}")
+        x, y, w, h = (int(round(v)) for v in values)
+        if w > 0 and h > 0:
+            boxes.append((x, y, x + w, y + h))
+    return boxes
+
+
+def _expand_axis(low: int, high: int, target: int, limit: int) -> Tuple[int, int]:
+    """把 [low, high) 以中心擴展到 target 長度，並保持在 [0, limit) 內"""
+    target = min(target, limit)
+    center = (low + high) / 2
+    low = int(round(center - target / 2))
+    low = max(0, min(low, limit - target))
+    return low, low + target
+
+
+def region_bbox(boxes: List[BBox], width: int, height: int,
+                padding: int = REGION_PADDING) -> Optional[BBox]:
+    """
+    計算要編輯的區域（聯集 + padding，擴展成 4:3）
+
+    Returns:
+        Optional[BBox]: 區域；沒有區域或區域太大時回傳 None（改為整張編輯）
+    """
+    if not boxes:
+        return None
+
+    left = max(0, min(b[0] for b in boxes) - padding)
+    top = max(0, min(b[1] for b in boxes) - padding)
+    right = min(width, max(b[2] for b in boxes) + padding)
+    bottom = min(height, max(b[3] for b in boxes) + padding)
+    if right <= left or bottom <= top:
+        return None
+
+    w = max(right - left, MIN_REGION_SIZE)
+    h = max(bottom - top, MIN_REGION_SIZE)
+    if w / h > ASPECT_RATIO:
+        h = int(round(w / ASPECT_RATIO))
+    else:
+        w = int(round(h * ASPECT_RATIO))
+    if w > width or h > height:
+        return None
+
+    left, right = _expand_axis(left, right, w, width)
+    top, bottom = _expand_axis(top, bottom, h, height)
+
+    if (right - left) * (bottom - top) > MAX_REGION_RATIO * width * height:
+        return None
+    return left, top, right, bottom
+
+
+def image_size(image_bytes: bytes) -> Tuple[int, int]:
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        return img.size
+
+
+def crop_region(image_bytes: bytes, bbox: BBox) -> bytes:
+    """從圖片裁出區域，回傳 PNG"""
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        cropped = img.convert("RGB").crop(bbox)
+    buffer = io.BytesIO()
+    cropped.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _feather_mask(size: Tuple[int, int], feather: int) -> Image.Image:
+    """中間不透明、邊緣漸層的遮罩"""
+    w, h = size
+    feather = max(0, min(feather, w // 4, h // 4))
+    mask = Image.new("L", size, 0)
+    ImageDraw.Draw(mask).rectangle((feather, feather, w - feather - 1, h - feather - 1), fill=255)
+    if feather:
+        mask = mask.filter(ImageFilter.GaussianBlur(feather / 2))
+    return mask
+
+
+def blend_region(base_bytes: bytes, edited_bytes: bytes, bbox: BBox,
+                 feather: int = FEATHER, format: str = "PNG") -> bytes:
+    """
+    把編輯後的區域貼回底圖
+
+    Args:
+        base_bytes: 上一張結果（底圖）
+        edited_bytes: 模型回傳的區域圖
+        bbox: 區域位置（以底圖座標表示）
+        feather: 羽化寬度
+        format: 輸出格式
+
+    Returns:
+        bytes: 合成後的整張圖
+    """
+    with Image.open(io.BytesIO(base_bytes)) as base_img:
+        base = base_img.convert("RGB")
+    with Image.open(io.BytesIO(edited_bytes)) as edited_img:
+        size = (bbox[2] - bbox[0], bbox[3] - bbox[1])
+        edited = edited_img.convert("RGB").resize(size, Image.Resampling.LANCZOS)
+
+    base.paste(edited, bbox[:2], _feather_mask(size, feather))
+    buffer = io.BytesIO()
+    base.save(buffer, format=format)
+    return buffer.getvalue()
+
+
+def scale_bbox(bbox: BBox, from_size: Tuple[int, int], to_size: Tuple[int, int]) -> BBox:
+    """把區域從一個圖片尺寸換算到另一個尺寸（合成圖與底圖解析度不同時）"""
+    if from_size == to_size:
+        return bbox
+    sx = to_size[0] / from_size[0]
+    sy = to_size[1] / from_size[1]
+    return (
+        int(round(bbox[0] * sx)),
+        int(round(bbox[1] * sy)),
+        int(round(bbox[2] * sx)),
+        int(round(bbox[3] * sy)),
+    )
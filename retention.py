@@ -0,0 +1,503 @@
+"""
+儲存空間保留政策與垃圾回收 - input/、result/、sessions/
+
+- 每個目錄可設定最長保留天數與容量上限
+- 背景 sweeper 每次只處理一小批檔案（分批 scandir + 依時間排序的 heap），
+  不會每次都完整掃描目錄
+- 仍被 session history 引用的結果圖片不會被刪除
+- 可另外指定 protect hook 保護其他仍在使用的檔案（例如尚未取用的預先生成庫存）
+- 可產生對應的 GCS lifecycle 規則
+
+多個 gunicorn worker 之間以檔案鎖確保只有一個 worker 執行 sweeper。
+各 worker 新增的引用寫入共用的引用記錄（reference_log，例如 session 索引），
+sweeper 每一批都會讀取，不必等到下一次完整掃描。
+"""
+
+import heapq
+import json
+import os
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+DAY = 86400
+# 引用記錄在 session 掃描起點之前多久的才刪除（涵蓋引用寫入記錄後、session 檔寫入前的空檔）
+REFERENCE_LOG_MARGIN = 3600
+
+
+def _env_float(name: str) -> Optional[float]:
+    value = os.getenv(name)
+    return float(value) if value else None
+
+
+def _env_bytes(name: str) -> Optional[int]:
+    """讀取容量設定，支援 500M / 10G 這類寫法"""
+    value = os.getenv(name)
+    if not value:
+        return None
+    value = value.strip().upper()
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+@dataclass
+class RetentionPolicy:
+    """單一目錄的保留政策"""
+    name: str
+    directory: Path
+    max_age_days: Optional[float] = None
+    max_bytes: Optional[int] = None
+    # 是否保護被 session history 引用的檔案
+    protect_referenced: bool = False
+    # 對應的 GCS prefix（產生 lifecycle 規則用）
+    gcs_prefix: Optional[str] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_age_days is not None or self.max_bytes is not None
+
+
+def referenced_names(history: Iterable[str]) -> List[str]:
+    """從 history URL 取出檔名"""
+    return [Path(str(url).split("?", 1)[0]).name for url in history or [] if url]
+
+
+class _Inventory:
+    """單一目錄的檔案清單：name -> (mtime, size)，以及依 mtime 排序的 heap"""
+
+    def __init__(self, policy: RetentionPolicy):
+        self.policy = policy
+        self.entries: Dict[str, tuple] = {}
+        self.heap: List[tuple] = []
+        self.total_bytes = 0
+        # 分批掃描用的 scandir 堆疊：(iterator, 相對路徑 prefix)
+        self.scan_stack: List[tuple] = []
+        self.scan_entries: Dict[str, tuple] = {}
+        self.scanned_at = 0.0
+        self.deleted_files = 0
+        self.deleted_bytes = 0
+
+    def add(self, name: str, mtime: float, size: int):
+        old = self.entries.get(name)
+        if old:
+            self.total_bytes -= old[1]
+        self.entries[name] = (mtime, size)
+        self.total_bytes += size
+        heapq.heappush(self.heap, (mtime, name))
+
+    def remove(self, name: str) -> Optional[tuple]:
+        entry = self.entries.pop(name, None)
+        if entry:
+            self.total_bytes -= entry[1]
+        return entry
+
+    @property
+    def scanning(self) -> bool:
+        return bool(self.scan_stack)
+
+    def start_scan(self):
+        self.policy.directory.mkdir(exist_ok=True)
+        self.scan_stack = [(os.scandir(self.policy.directory), "")]
+        self.scan_entries = {}
+
+    def scan_step(self, budget: int) -> Tuple[List[str], bool]:
+        """
+        繼續分批掃描目錄
+
+        Returns:
+            Tuple[List[str], bool]: (本批掃到的檔名, 掃描是否完成)
+        """
+        names = []
+        for _ in range(budget):
+            iterator, prefix = self.scan_stack[-1]
+            try:
+                entry = next(iterator)
+            except StopIteration:
+                iterator.close()
+                self.scan_stack.pop()
+                if not self.scan_stack:
+                    self._finish_scan()
+                    return names, True
+                continue
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                # 分片子目錄（例如 sessions/a3/）
+                self.scan_stack.append((os.scandir(entry.path), f"{prefix}{entry.name}/"))
+                continue
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            name = f"{prefix}{entry.name}"
+            self.scan_entries[name] = (stat.st_mtime, stat.st_size)
+            names.append(name)
+        return names, False
+
+    def _finish_scan(self):
+        """掃描完成：以掃描結果取代清單（掃描期間新增的檔案會保留）"""
+        started = self.scanned_at
+        for name, (mtime, size) in list(self.entries.items()):
+            if name not in self.scan_entries and mtime >= started:
+                self.scan_entries[name] = (mtime, size)
+        self.entries = {}
+        self.total_bytes = 0
+        self.heap = []
+        for name, (mtime, size) in self.scan_entries.items():
+            self.entries[name] = (mtime, size)
+            self.total_bytes += size
+        self.heap = [(mtime, name) for name, (mtime, _) in self.entries.items()]
+        heapq.heapify(self.heap)
+        self.scan_entries = {}
+
+
+class RetentionManager:
+    """
+    保留政策管理 + 背景 sweeper
+
+    用法:
+        manager.track("result", path)         # 寫入新檔案後呼叫
+        manager.add_references(history_urls)  # session history 新增時呼叫
+        manager.start()                       # 啟動背景 sweeper
+    """
+
+    def __init__(self, policies: List[RetentionPolicy], interval: float = 60.0,
+                 batch_size: int = 500, rescan_hours: float = 6.0, lock_path: Optional[Path] = None,
+                 on_delete: Optional[Callable[[str, str], None]] = None,
+                 protect: Optional[Callable[[str, str], bool]] = None, reference_log=None):
+        self.policies = {p.name: p for p in policies}
+        protects = any(p.enabled and p.protect_referenced for p in policies)
+        # session 目錄即使沒有保留政策，只要有目錄需要保護引用，就要掃描它來建立引用表
+        self.inventories = {
+            p.name: _Inventory(p) for p in policies
+            if p.enabled or (p.name == "sessions" and protects)
+        }
+        self.interval = interval
+        self.batch_size = batch_size
+        self.rescan_seconds = rescan_hours * 3600
+        self.lock_path = lock_path
+        self.references: Counter = Counter()
+        # 引用表涵蓋到的時間點；比這個時間新的檔案一律視為受保護（可能來自其他 worker）
+        self.references_as_of = 0.0
+        self._scan_references: Counter = Counter()
+        self._pending_references: Counter = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock_file = None
+        # 刪除檔案後的 callback：(policy 名稱, 相對路徑)
+        self.on_delete = on_delete
+        # 額外的保護條件：(policy 名稱, 相對路徑) -> 是否不可刪除
+        self.protect = protect
+        # 跨 worker 共用的引用記錄（session_index.SessionIndex）；None 時只記在記憶體
+        self.reference_log = reference_log if protects else None
+        self._reference_cursor = 0
+
+    # ----- 寫入端 hooks -----
+
+    def track(self, name: str, path: Path):
+        """記錄新寫入的檔案，sweeper 不用重新掃描目錄就能知道"""
+        inventory = self.inventories.get(name)
+        if inventory is None or self._thread is None:
+            return
+        try:
+            stat = os.stat(path)
+            relpath = Path(path).relative_to(inventory.policy.directory).as_posix()
+        except (OSError, ValueError):
+            return
+        with self._lock:
+            inventory.add(relpath, stat.st_mtime, stat.st_size)
+
+    def add_references(self, history: Iterable[str]):
+        """session history 新增圖片時呼叫，這些檔案會受到保護"""
+        names = referenced_names(history)
+        if self.reference_log is not None:
+            try:
+                # sweeper 可能在其他 worker，寫入共用記錄
+                self.reference_log.add_references(names)
+                return
+            except Exception as e:
+                print(f"⚠️  Retention: cannot record references: {e}")
+        with self._lock:
+            self.references.update(names)
+            self._pending_references.update(names)
+
+    def _read_reference_log(self):
+        """讀取其他 worker（以及自己）新增到共用記錄的引用"""
+        if self.reference_log is None:
+            return
+        rows = self.reference_log.references_since(self._reference_cursor)
+        if not rows:
+            return
+        self._reference_cursor = rows[-1][0]
+        names = [name for _, name in rows]
+        with self._lock:
+            self.references.update(names)
+            self._pending_references.update(names)
+
+    def is_referenced(self, name: str) -> bool:
+        return self.references.get(name, 0) > 0
+
+    @property
+    def references_ready(self) -> bool:
+        return self.references_as_of > 0
+
+    # ----- sweeper -----
+
+    def _acquire_process_lock(self) -> bool:
+        """只讓一個 worker 執行 sweeper"""
+        if fcntl is None or self.lock_path is None:
+            return True
+        try:
+            self._lock_file = open(self.lock_path, "w")
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            if self._lock_file:
+                self._lock_file.close()
+                self._lock_file = None
+            return False
+
+    def start(self) -> bool:
+        """啟動背景 sweeper；其他 worker 已在執行時回傳 False"""
+        if not self.inventories or self._thread is not None:
+            return False
+        if not self._acquire_process_lock():
+            return False
+        self._thread = threading.Thread(target=self._run, name="retention-sweeper", daemon=True)
+        self._thread.start()
+        print(f"🧹 Retention sweeper started: {', '.join(self.inventories)}")
+        return True
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.step()
+            except Exception as e:
+                print(f"⚠️  Retention sweep failed: {e}")
+            self._stop.wait(self.interval)
+
+    def _referenced_in_session(self, path: Path) -> List[str]:
+        try:
+            with open(path, "r") as f:
+                return referenced_names(json.load(f).get("history"))
+        except (OSError, ValueError, AttributeError):
+            return []
+
+    def step(self) -> dict:
+        """
+        執行一批工作：繼續掃描，或刪除過期/超量的檔案
+        session 目錄先處理，確保引用表完整後才刪除結果圖片
+
+        Returns:
+            dict: 本批掃描/刪除的數量
+        """
+        now = time.time()
+        summary = {"scanned": 0, "deleted": 0}
+        self._read_reference_log()
+        for name, inventory in self.inventories.items():
+            if not inventory.scanning and now - inventory.scanned_at > self.rescan_seconds:
+                inventory.scanned_at = now
+                inventory.start_scan()
+                if name == "sessions":
+                    # 剛記錄、session 檔可能還沒寫入的引用，不能只靠掃描
+                    recent = (self.reference_log.references_added_after(now - REFERENCE_LOG_MARGIN)
+                              if self.reference_log is not None else [])
+                    with self._lock:
+                        self._scan_references = Counter()
+                        self._pending_references = Counter(recent)
+
+            if inventory.scanning:
+                with self._lock:
+                    names, done = inventory.scan_step(self.batch_size)
+                summary["scanned"] += len(names)
+                if name == "sessions":
+                    for session_file in names:
+                        self._scan_references.update(
+                            self._referenced_in_session(inventory.policy.directory / session_file)
+                        )
+                if done and name == "sessions":
+                    with self._lock:
+                        # 掃描結果 + 掃描期間新增的引用
+                        self.references = self._scan_references + self._pending_references
+                        self.references_as_of = inventory.scanned_at
+                    if self.reference_log is not None:
+                        self.reference_log.prune_references(inventory.scanned_at - REFERENCE_LOG_MARGIN)
+                continue
+
+            summary["deleted"] += self._evict(inventory, now)
+
+        return summary
+
+    def _evict(self, inventory: _Inventory, now: float) -> int:
+        """從最舊的檔案開始刪除，直到符合保留政策或用完這批的額度"""
+        policy = inventory.policy
+        if not policy.enabled:
+            return 0
+        if policy.protect_referenced and not self.references_ready:
+            return 0
+
+        max_age = policy.max_age_days * DAY if policy.max_age_days is not None else None
+        deleted = 0
+        skipped = []
+        with self._lock:
+            while inventory.heap and deleted + len(skipped) < self.batch_size:
+                mtime, name = inventory.heap[0]
+                entry = inventory.entries.get(name)
+                if entry is None or entry[0] != mtime:
+                    heapq.heappop(inventory.heap)  # 過時的 heap 項目
+                    continue
+
+                too_old = max_age is not None and now - mtime > max_age
+                too_big = policy.max_bytes is not None and inventory.total_bytes > policy.max_bytes
+                if not too_old and not too_big:
+                    break
+
+                heapq.heappop(inventory.heap)
+                if policy.protect_referenced and (mtime >= self.references_as_of or self.is_referenced(name)):
+                    skipped.append((mtime, name))
+                    continue
+                if self.protect is not None and self.protect(policy.name, name):
+                    skipped.append((mtime, name))
+                    continue
+
+                removed = self._delete(inventory, name)
+                if removed is not None:
+                    deleted += 1
+
+            for item in skipped:
+                heapq.heappush(inventory.heap, item)
+        if deleted:
+            print(f"🧹 Retention: removed {deleted} files from {policy.name}/")
+        return deleted
+
+    def _delete(self, inventory: _Inventory, name: str) -> Optional[tuple]:
+        path = inventory.policy.directory / name
+        if inventory.policy.name == "sessions":
+            # session 過期後，其引用的圖片不再受保護
+            for ref in self._referenced_in_session(path):
+                self.references[ref] -= 1
+                if self.references[ref] <= 0:
+                    del self.references[ref]
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"⚠️  Retention: cannot remove {path}: {e}")
+            return None
+        entry = inventory.remove(name)
+        if entry:
+            inventory.deleted_files += 1
+            inventory.deleted_bytes += entry[1]
+        if self.on_delete:
+            try:
+                self.on_delete(inventory.policy.name, name)
+            except Exception as e:
+                print(f"⚠️  Retention: on_delete callback failed for {name}: {e}")
+        return entry
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "running": self._thread is not None,
+                "references": len(self.references),
+                "references_ready": self.references_ready,
+                "directories": {
+                    name: {
+                        "max_age_days": inv.policy.max_age_days,
+                        "max_bytes": inv.policy.max_bytes,
+                        "files": len(inv.entries),
+                        "bytes": inv.total_bytes,
+                        "scanning": inv.scanning,
+                        "deleted_files": inv.deleted_files,
+                        "deleted_bytes": inv.deleted_bytes,
+                    }
+                    for name, inv in self.inventories.items()
+                }
+            }
+
+
+def gcs_lifecycle_rules(policies: List[RetentionPolicy]) -> List[dict]:
+    """
+    依保留天數產生 GCS lifecycle 刪除規則
+    GCS lifecycle 無法判斷 session 引用，受保護的目錄 (result) 只有明確設定
+    RETENTION_GCS_RESULT_DAYS 時才會產生規則
+    """
+    rules = []
+    for policy in policies:
+        if not policy.gcs_prefix:
+            continue
+        days = policy.max_age_days
+        if policy.protect_referenced:
+            days = _env_float(f"RETENTION_GCS_{policy.name.upper()}_DAYS")
+        if days is None:
+            continue
+        rules.append({
+            "action": {"type": "Delete"},
+            "condition": {"age": max(1, int(days)), "matchesPrefix": [f"{policy.gcs_prefix}/"]},
+        })
+    return rules
+
+
+def apply_gcs_lifecycle(storage_client, bucket_name: str, policies: List[RetentionPolicy]) -> List[dict]:
+    """把 lifecycle 規則套用到 bucket（保留 bucket 上其他 prefix 的既有規則）"""
+    rules = gcs_lifecycle_rules(policies)
+    prefixes = {prefix for rule in rules for prefix in rule["condition"]["matchesPrefix"]}
+    bucket = storage_client.get_bucket(bucket_name)
+    existing = [
+        dict(rule) for rule in bucket.lifecycle_rules
+        if not set(rule.get("condition", {}).get("matchesPrefix", [])) & prefixes
+    ]
+    bucket.lifecycle_rules = existing + rules
+    bucket.patch()
+    return bucket.lifecycle_rules
+
+
+def policies_from_env(input_dir: Path, result_dir: Path, sessions_dir: Path) -> List[RetentionPolicy]:
+    """
+    從環境變數建立保留政策
+
+    環境變數:
+        RETENTION_INPUT_DAYS / RETENTION_INPUT_MAX_BYTES (預設保留 3 天)
+        RETENTION_RESULT_DAYS / RETENTION_RESULT_MAX_BYTES (預設不限)
+        RETENTION_SESSIONS_DAYS / RETENTION_SESSIONS_MAX_BYTES (預設不限)
+    """
+    return [
+        RetentionPolicy(
+            name="input",
+            directory=input_dir,
+            max_age_days=float(os.getenv("RETENTION_INPUT_DAYS", "3")),
+            max_bytes=_env_bytes("RETENTION_INPUT_MAX_BYTES"),
+        ),
+        RetentionPolicy(
+            name="result",
+            directory=result_dir,
+            max_age_days=_env_float("RETENTION_RESULT_DAYS"),
+            max_bytes=_env_bytes("RETENTION_RESULT_MAX_BYTES"),
+            protect_referenced=True,
+            gcs_prefix="result",
+        ),
+        RetentionPolicy(
+            name="sessions",
+            directory=sessions_dir,
+            max_age_days=_env_float("RETENTION_SESSIONS_DAYS"),
+            max_bytes=_env_bytes("RETENTION_SESSIONS_MAX_BYTES"),
+            gcs_prefix="json",
+        ),
+    ]
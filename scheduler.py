@@ -0,0 +1,233 @@
+"""
+Gemini 請求排程器 - 依 session 公平排隊 + 優先等級
+
+- 每個 session 有自己的佇列，同一等級內以 round-robin 輪流派發，
+  一個 session 排了很多請求也不會餓死其他人
+- 優先等級（interactive / batch）以加權輪詢分配執行名額
+- 全域併發上限，超過就排隊
+- 記錄排隊等待時間與執行時間，區分排隊延遲和模型延遲
+- 等待結果的請求被取消（client 斷線）時，worker thread 仍會跑完；
+  名額一直保留到 thread 結束才歸還，實際併發不會超過上限
+
+注意：排程器是 process 內的，gunicorn 每個 worker 各自有一個。
+"""
+
+import asyncio
+import os
+import time
+from collections import deque, OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Optional
+
+# 優先等級與權重（數字越大分到越多名額）
+PRIORITY_WEIGHTS = {
+    "interactive": 4,
+    "batch": 1,
+}
+DEFAULT_PRIORITY = "interactive"
+
+# 指標保留的樣本數
+METRIC_SAMPLES = 500
+
+
+@dataclass
+class _Ticket:
+    session_id: str
+    priority: str
+    future: asyncio.Future
+    enqueued_at: float = field(default_factory=time.monotonic)
+
+
+class _PriorityClass:
+    """單一優先等級：session_id -> 佇列，以及輪詢順序"""
+
+    def __init__(self, weight: int):
+        self.weight = weight
+        self.queues: "OrderedDict[str, deque]" = OrderedDict()
+        self.credits = weight
+
+    def push(self, ticket: _Ticket):
+        self.queues.setdefault(ticket.session_id, deque()).append(ticket)
+
+    def pop(self) -> Optional[_Ticket]:
+        """取出下一個 session 的第一個請求，並把該 session 移到輪詢尾端"""
+        while self.queues:
+            session_id, queue = next(iter(self.queues.items()))
+            ticket = queue.popleft()
+            if queue:
+                self.queues.move_to_end(session_id)
+            else:
+                del self.queues[session_id]
+            if not ticket.future.done():
+                return ticket
+        return None
+
+    def discard(self, ticket: _Ticket):
+        queue = self.queues.get(ticket.session_id)
+        if queue is None:
+            return
+        try:
+            queue.remove(ticket)
+        except ValueError:
+            return
+        if not queue:
+            del self.queues[ticket.session_id]
+
+    def __len__(self):
+        return sum(len(q) for q in self.queues.values())
+
+
+def _percentile(samples, pct: float) -> Optional[float]:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return round(ordered[index] * 1000, 1)
+
+
+class FairScheduler:
+    """
+    公平排程器
+
+    用法:
+        result, timing = await scheduler.run(session_id, func, *args, priority="interactive")
+    func 是同步函式，會在 thread pool 中執行，不會阻塞 event loop
+    （session_id 與 func 是 positional-only，func 本身也可以有 session_id 參數）
+    """
+
+    def __init__(self, max_concurrency: int = 4, weights: Optional[Dict[str, int]] = None):
+        self.max_concurrency = max(1, max_concurrency)
+        self.classes = {name: _PriorityClass(w) for name, w in (weights or PRIORITY_WEIGHTS).items()}
+        self.inflight = 0
+        self.wait_times = {name: deque(maxlen=METRIC_SAMPLES) for name in self.classes}
+        self.run_times = {name: deque(maxlen=METRIC_SAMPLES) for name in self.classes}
+        self.completed = {name: 0 for name in self.classes}
+        # 等待結果的請求被取消、thread 仍在執行的數量
+        self.orphaned = 0
+
+    def _next_ticket(self) -> Optional[_Ticket]:
+        """加權輪詢選擇優先等級，再從該等級取出下一個請求"""
+        waiting = [c for c in self.classes.values() if len(c)]
+        if not waiting:
+            return None
+        if all(c.credits <= 0 for c in waiting):
+            for c in self.classes.values():
+                c.credits = c.weight
+        for cls in sorted(waiting, key=lambda c: -c.weight):
+            if cls.credits > 0:
+                ticket = cls.pop()
+                if ticket is not None:
+                    cls.credits -= 1
+                    return ticket
+        return None
+
+    def _dispatch(self):
+        while self.inflight < self.max_concurrency:
+            ticket = self._next_ticket()
+            if ticket is None:
+                return
+            self.inflight += 1
+            ticket.future.set_result(time.monotonic())
+
+    def _release(self):
+        self.inflight -= 1
+        self._dispatch()
+
+    async def acquire(self, session_id: str, priority: str = DEFAULT_PRIORITY) -> float:
+        """
+        排隊取得執行名額
+
+        Returns:
+            float: 排隊等待秒數
+        """
+        if priority not in self.classes:
+            priority = DEFAULT_PRIORITY
+        ticket = _Ticket(
+            session_id=session_id or "anonymous",
+            priority=priority,
+            future=asyncio.get_running_loop().create_future()
+        )
+        self.classes[priority].push(ticket)
+        self._dispatch()
+
+        try:
+            started_at = await ticket.future
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled():
+                # 已經拿到名額才被取消，要還回去
+                self._release()
+            else:
+                self.classes[priority].discard(ticket)
+            raise
+
+        wait = started_at - ticket.enqueued_at
+        self.wait_times[priority].append(wait)
+        return wait
+
+    async def run(self, session_id: str, func: Callable, /, *args, priority: str = DEFAULT_PRIORITY, **kwargs):
+        """
+        排隊後在 thread pool 執行 func
+
+        Returns:
+            tuple: (func 的回傳值, {"queue_wait_ms": ..., "run_ms": ...})
+        """
+        if priority not in self.classes:
+            priority = DEFAULT_PRIORITY
+        wait = await self.acquire(session_id, priority)
+        started = time.monotonic()
+        work = asyncio.ensure_future(asyncio.to_thread(func, *args, **kwargs))
+
+        def finished(future: asyncio.Future):
+            # thread 結束（不論呼叫端是否還在等）才歸還名額
+            self.run_times[priority].append(time.monotonic() - started)
+            self.completed[priority] += 1
+            self._release()
+            if orphaned:
+                self.orphaned -= 1
+                if not future.cancelled():
+                    future.exception()  # 沒有人等結果，避免 "exception was never retrieved"
+
+        orphaned = False
+        work.add_done_callback(finished)
+        try:
+            result = await asyncio.shield(work)
+        except asyncio.CancelledError:
+            if not work.done():
+                orphaned = True
+                self.orphaned += 1
+            raise
+        elapsed = time.monotonic() - started
+
+        return result, {
+            "queue_wait_ms": round(wait * 1000, 1),
+            "run_ms": round(elapsed * 1000, 1),
+        }
+
+    def idle(self) -> bool:
+        """沒有執行中也沒有排隊中的請求"""
+        return self.inflight == 0 and not any(len(c) for c in self.classes.values())
+
+    def stats(self) -> dict:
+        """排隊狀態與等待/執行時間指標"""
+        return {
+            "max_concurrency": self.max_concurrency,
+            "inflight": self.inflight,
+            "orphaned": self.orphaned,
+            "classes": {
+                name: {
+                    "weight": cls.weight,
+                    "queued": len(cls),
+                    "queued_sessions": len(cls.queues),
+                    "completed": self.completed[name],
+                    "queue_wait_ms_p50": _percentile(self.wait_times[name], 50),
+                    "queue_wait_ms_p95": _percentile(self.wait_times[name], 95),
+                    "run_ms_p50": _percentile(self.run_times[name], 50),
+                    "run_ms_p95": _percentile(self.run_times[name], 95),
+                }
+                for name, cls in self.classes.items()
+            }
+        }
+
+
+# 全域排程器
+scheduler = FairScheduler(max_concurrency=int(os.getenv("GEMINI_MAX_CONCURRENCY", "4")))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+冷啟動基準測試
+在全新的 Python process 中量測：
+- import app 的時間
+- 第一個請求 (/health) 的回應時間
+- /_ah/warmup 的時間
+
+用法:
+    python scripts/bench_startup.py --runs 5 --mode lazy
+    python scripts/bench_startup.py --mode eager --output bench_startup.jsonl
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from datetime import datetime
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+# 子 process 的結果行前綴（jsonlog 的背景 writer 可能在結果之後才輸出 log）
+RESULT_MARKER = "BENCH_RESULT "
+
+# 在子 process 中執行的量測程式
+CHILD_SCRIPT = r"""
+import json, time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+from fastapi.testclient import TestClient
+client = TestClient(app.app)
+t2 = time.perf_counter()
+client.get("/health")
+t3 = time.perf_counter()
+client.get("/_ah/warmup")
+t4 = time.perf_counter()
+print(RESULT_MARKER + json.dumps({
+    "import_ms": round((t1 - t0) * 1000, 1),
+    "first_request_ms": round((t3 - t2) * 1000, 1),
+    "warmup_ms": round((t4 - t3) * 1000, 1),
+}), flush=True)
+"""
+
+
+def run_once(mode: str) -> dict:
+    """在新的 process 中跑一次量測"""
+    env = dict(os.environ)
+    env["STARTUP_MODE"] = mode
+    env.setdefault("GOOGLE_API_KEY", "benchmark")
+    result = subprocess.run(
+        [sys.executable, "-c", f"RESULT_MARKER = {RESULT_MARKER!r}\n" + CHILD_SCRIPT],
+        cwd=str(ROOT_DIR),
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True
+    )
+    for line in result.stdout.splitlines():
+        if line.startswith(RESULT_MARKER):
+            return json.loads(line[len(RESULT_MARKER):])
+    raise RuntimeError(f"找不到量測結果:\n{result.stdout[-2000:]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="量測 app 冷啟動時間")
+    parser.add_argument("--runs", type=int, default=5, help="量測次數")
+    parser.add_argument("--mode", default="lazy", choices=["lazy", "background", "eager"], help="STARTUP_MODE")
+    parser.add_argument("--output", help="把結果附加到 JSONL 檔案（追蹤不同版本）")
+    args = parser.parse_args()
+
+    print(f"⏱️  Measuring cold start ({args.mode}, {args.runs} runs)...")
+    samples = [run_once(args.mode) for _ in range(args.runs)]
+
+    summary = {
+        "timestamp": datetime.now().isoformat(),
+        "mode": args.mode,
+        "runs": args.runs,
+    }
+    for key in samples[0]:
+        values = [s[key] for s in samples]
+        summary[f"{key}_median"] = round(statistics.median(values), 1)
+        summary[f"{key}_max"] = round(max(values), 1)
+
+    for key, value in summary.items():
+        print(f"   {key}: {value}")
+
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(summary) + "\n")
+        print(f"💾 Appended to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+本地 <-> GCS 資料搬移（切換 USE_GCS 前後使用）
+
+複製 input/、result/、sessions/，以 CRC32C/MD5 驗證，並改寫 session history 的圖片 URL。
+可重複執行：目的地已有相同內容的檔案會略過，進度記錄在 .migration-{direction}.jsonl
+
+用法:
+    python scripts/migrate_storage.py to-gcs                     # 本地 -> GCS
+    python scripts/migrate_storage.py to-local --workers 16      # GCS -> 本地
+    python scripts/migrate_storage.py to-gcs --only result --dry-run
+    python scripts/migrate_storage.py to-gcs --fake-bucket /tmp/bucket   # 以本地目錄模擬 bucket
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+import session_index  # noqa: E402
+import storage_migration  # noqa: E402
+
+# 載入環境變數
+load_dotenv(ROOT_DIR / ".env")
+
+
+def open_bucket(args):
+    bucket_name = os.getenv("GCS_BUCKET_NAME", "team-bubu")
+    if args.fake_bucket:
+        return storage_migration.DirectoryBucket(Path(args.fake_bucket), name=bucket_name)
+    from google.cloud import storage
+    return storage.Client().bucket(bucket_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 <-> GCS 資料搬移")
+    parser.add_argument("direction", choices=storage_migration.DIRECTIONS)
+    parser.add_argument("--only", action="append", choices=list(storage_migration.FOLDERS),
+                        help="只搬移指定目錄（可重複）")
+    parser.add_argument("--workers", type=int, default=8, help="並行傳輸數")
+    parser.add_argument("--dry-run", action="store_true", help="只計算要搬移的項目")
+    parser.add_argument("--restart", action="store_true", help="忽略之前的進度記錄")
+    parser.add_argument("--fake-bucket", help="以本地目錄模擬 bucket（測試用）")
+    parser.add_argument("--base-url", default=os.getenv("BASE_URL", "http://localhost:8000"),
+                        help="本地模式的 BASE_URL（改寫 /images/ URL 用）")
+    args = parser.parse_args()
+
+    journal_path = ROOT_DIR / f".migration-{args.direction}.jsonl"
+    if args.restart and journal_path.exists():
+        journal_path.unlink()
+
+    last_report = [0.0]
+
+    def progress(stats):
+        now = time.monotonic()
+        if now - last_report[0] >= 2:
+            last_report[0] = now
+            s = stats.as_dict()
+            print(f"   … {s['copied']} copied, {s['skipped']} skipped, {s['failed']} failed, {s['mb_per_s']} MB/s")
+
+    migration = storage_migration.StorageMigration(
+        base_dir=ROOT_DIR,
+        bucket=open_bucket(args),
+        direction=args.direction,
+        base_url=args.base_url,
+        folders=args.only,
+        workers=args.workers,
+        journal_path=None if args.dry_run else journal_path,
+        index=session_index.SessionIndex(ROOT_DIR / "sessions" / session_index.INDEX_FILENAME),
+        dry_run=args.dry_run,
+        progress=progress
+    )
+    print(f"🚚 Migrating {', '.join(migration.folders)} {args.direction} ({migration.bucket.name})")
+    stats = migration.run()
+
+    for error in stats.errors[:20]:
+        print(f"❌ {error}")
+    print(json.dumps(stats.as_dict(), indent=2))
+    if stats.failed:
+        print("⚠️  Some items failed; run again to retry (completed items are skipped)")
+        sys.exit(1)
+    if not args.dry_run:
+        target = "true" if args.direction == "to-gcs" else "false"
+        print(f"✅ Done. Set USE_GCS={target} in .env")
+
+
+if __name__ == "__main__":
+    main()
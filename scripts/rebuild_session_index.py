@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+重建 session 索引，並把舊的平面路徑搬到分片路徑
+
+    sessions/{session_id}.json  ->  sessions/{shard}/{session_id}.json
+    json/{session_id}.json      ->  json/{shard}/{session_id}.json   (--gcs)
+
+用法:
+    python scripts/rebuild_session_index.py              # 只重建索引
+    python scripts/rebuild_session_index.py --migrate    # 同時搬移舊檔案
+    python scripts/rebuild_session_index.py --gcs --migrate
+"""
+
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+import session_index  # noqa: E402
+
+# 載入環境變數
+load_dotenv(ROOT_DIR / ".env")
+
+SESSIONS_DIR = ROOT_DIR / "sessions"
+
+
+def rebuild_local(index: session_index.SessionIndex, migrate: bool) -> int:
+    """掃描本地 sessions/（平面 + 分片），更新索引"""
+    count = 0
+    for path in SESSIONS_DIR.rglob("*.json"):
+        session_id = path.stem
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️  Skip {path.name}: {e}")
+            continue
+
+        relpath = session_index.session_relpath(session_id)
+        target = SESSIONS_DIR / relpath
+        if migrate and path != target:
+            target.parent.mkdir(exist_ok=True)
+            if target.exists():
+                path.unlink()  # 分片路徑已有較新的版本
+            else:
+                path.rename(target)
+
+        current = index.get(session_id)
+        index.upsert(session_id, data, current["location"] if current else "local", relpath)
+        count += 1
+    return count
+
+
+def rebuild_gcs(index: session_index.SessionIndex, migrate: bool) -> int:
+    """掃描 GCS json/，更新索引（--migrate 時把平面 key 搬到分片 key）"""
+    from google.cloud import storage
+
+    bucket_name = os.getenv("GCS_BUCKET_NAME", "team-bubu")
+    client = storage.Client()
+    bucket = client.bucket(bucket_name)
+    count = 0
+    for blob in client.list_blobs(bucket_name, prefix="json/"):
+        if not blob.name.endswith(".json"):
+            continue
+        session_id = Path(blob.name).stem
+        relpath = session_index.session_relpath(session_id)
+        data = json.loads(blob.download_as_bytes())
+
+        if migrate and blob.name != f"json/{relpath}":
+            target = bucket.blob(f"json/{relpath}")
+            if not target.exists():
+                bucket.copy_blob(blob, bucket, f"json/{relpath}")
+            blob.delete()
+
+        index.upsert(session_id, data, "gcs", relpath)
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="重建 session 索引")
+    parser.add_argument("--migrate", action="store_true", help="把舊的平面路徑搬到分片路徑")
+    parser.add_argument("--gcs", action="store_true", help="同時掃描 GCS json/")
+    args = parser.parse_args()
+
+    index = session_index.SessionIndex(SESSIONS_DIR / session_index.INDEX_FILENAME)
+    local_count = rebuild_local(index, args.migrate)
+    print(f"📁 Indexed {local_count} local sessions")
+    if args.gcs:
+        gcs_count = rebuild_gcs(index, args.migrate)
+        print(f"☁️  Indexed {gcs_count} GCS sessions")
+    print(json.dumps(index.stats(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+保留政策工具
+- 立即執行一次完整清理（不等背景 sweeper）
+- 產生 / 套用對應的 GCS lifecycle 規則
+
+用法:
+    python scripts/retention.py sweep
+    python scripts/retention.py gcs-lifecycle            # 只顯示規則
+    python scripts/retention.py gcs-lifecycle --apply    # 套用到 bucket
+"""
+
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+import retention  # noqa: E402
+import session_index  # noqa: E402
+
+# 載入環境變數
+load_dotenv(ROOT_DIR / ".env")
+
+
+def build_policies():
+    return retention.policies_from_env(ROOT_DIR / "input", ROOT_DIR / "result", ROOT_DIR / "sessions")
+
+
+def sweep():
+    """一直執行到所有目錄都掃描完成且沒有可刪除的檔案"""
+    index = session_index.SessionIndex(ROOT_DIR / "sessions" / session_index.INDEX_FILENAME)
+
+    def on_delete(policy, name):
+        if policy == "sessions":
+            index.remove(Path(name).stem)
+
+    manager = retention.RetentionManager(build_policies(), batch_size=2000, on_delete=on_delete,
+                                         reference_log=index)
+    total = {"scanned": 0, "deleted": 0}
+    while True:
+        summary = manager.step()
+        total["scanned"] += summary["scanned"]
+        total["deleted"] += summary["deleted"]
+        if not summary["scanned"] and not summary["deleted"] \
+                and not any(inv.scanning for inv in manager.inventories.values()):
+            break
+    print(f"🧹 Scanned {total['scanned']} files, removed {total['deleted']}")
+    print(json.dumps(manager.stats(), indent=2))
+
+
+def gcs_lifecycle(apply: bool):
+    policies = build_policies()
+    rules = retention.gcs_lifecycle_rules(policies)
+    print(json.dumps(rules, indent=2))
+    if not apply:
+        return
+    from google.cloud import storage
+    bucket_name = os.getenv("GCS_BUCKET_NAME", "team-bubu")
+    applied = retention.apply_gcs_lifecycle(storage.Client(), bucket_name, policies)
+    print(f"✅ Lifecycle rules applied to {bucket_name}: {len(list(applied))} rules")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="保留政策工具")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("sweep", help="立即執行完整清理")
+    lifecycle = sub.add_parser("gcs-lifecycle", help="產生 GCS lifecycle 規則")
+    lifecycle.add_argument("--apply", action="store_true", help="套用到 bucket")
+    args = parser.parse_args()
+
+    if args.command == "sweep":
+        sweep()
+    else:
+        gcs_lifecycle(args.apply)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+相似度索引工具
+- 補建索引（已有的結果圖片，或背景佇列滿了被略過的圖片）
+- 列出重複圖片、查詢相似圖片
+
+用法:
+    python scripts/similarity.py backfill            # 本地 result/
+    python scripts/similarity.py backfill --gcs      # GCS result/
+    python scripts/similarity.py duplicates [--kind exact|near]
+    python scripts/similarity.py query <檔名>
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+import similarity  # noqa: E402
+
+# 載入環境變數
+load_dotenv(ROOT_DIR / ".env")
+
+
+def open_index() -> similarity.SimilarityIndex:
+    return similarity.SimilarityIndex(ROOT_DIR / "cache" / "similarity")
+
+
+def iter_local():
+    for path in sorted((ROOT_DIR / "result").iterdir()):
+        if path.is_file() and not path.name.startswith("."):
+            yield path.name, path.read_bytes
+
+
+def iter_gcs():
+    from google.cloud import storage
+
+    bucket_name = os.getenv("GCS_BUCKET_NAME", "team-bubu")
+    for blob in storage.Client().list_blobs(bucket_name, prefix="result/"):
+        name = blob.name[len("result/"):]
+        if name and "/" not in name:
+            yield name, blob.download_as_bytes
+
+
+def backfill(use_gcs: bool):
+    index = open_index()
+    started = time.monotonic()
+    added = skipped = failed = 0
+    for name, read in (iter_gcs() if use_gcs else iter_local()):
+        if index.get(name):
+            skipped += 1
+            continue
+        try:
+            result = index.add(name, read())
+        except Exception as e:
+            print(f"⚠️  {name}: {e}")
+            failed += 1
+            continue
+        added += 1
+        if result and result["duplicate_of"]:
+            print(f"🔁 {name} -> {result['duplicate_of']} ({result['duplicate_kind']})")
+    elapsed = time.monotonic() - started
+    print(f"✅ Added {added}, skipped {skipped}, failed {failed} in {elapsed:.1f}s")
+    print(json.dumps(index.stats(), indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="相似度索引工具")
+    sub = parser.add_subparsers(dest="command", required=True)
+    fill = sub.add_parser("backfill", help="補建索引")
+    fill.add_argument("--gcs", action="store_true", help="從 GCS result/ 讀取")
+    dup = sub.add_parser("duplicates", help="列出重複圖片")
+    dup.add_argument("--kind", choices=["exact", "near"])
+    dup.add_argument("--limit", type=int, default=100)
+    query = sub.add_parser("query", help="查詢相似圖片")
+    query.add_argument("name")
+    query.add_argument("-k", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.command == "backfill":
+        backfill(args.gcs)
+    elif args.command == "duplicates":
+        for row in open_index().duplicates(limit=args.limit, kind=args.kind):
+            print(f"{row['name']}\t{row['duplicate_kind']}\t{row['duplicate_of']}\t{row['similarity']:.4f}")
+    else:
+        started = time.perf_counter()
+        results = open_index().similar(args.name, args.k)
+        if results is None:
+            print(f"❌ {args.name} is not indexed")
+            sys.exit(1)
+        for result in results:
+            print(f"{result['similarity']:.4f}\t{result['distance']}\t{result['name']}")
+        print(f"⏱️  {(time.perf_counter() - started) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
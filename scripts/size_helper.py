@@ -3,13 +3,19 @@
 Image Size Helper
 Checks and resizes images in static/img directory:
 - space.png, moon.png, mars.png, ship.png -> 1184x864
-- item{X}.png -> 200x200
+- item{X}.png -> 200x200 (furniture list comes from catalog.discover_items)
 """
 
 import os
+import sys
 from PIL import Image
 from pathlib import Path
 
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+import catalog  # noqa: E402
+
 
 def resize_image(image_path, target_size, description):
     """Resize an image to target size if needed."""
@@ -41,9 +47,7 @@ def resize_image(image_path, target_size, description):
 
 def main():
     """Main function to check and resize all images."""
-    # Get the script directory and construct path to static/img
-    script_dir = Path(__file__).parent
-    img_dir = script_dir / "static" / "img"
+    img_dir = ROOT_DIR / "static" / "img"
     
     if not img_dir.exists():
         print(f"✗ Directory {img_dir} does not exist!")
@@ -76,17 +80,8 @@ def main():
     resized_count = 0
     found_count = 0
     
-    # Check for item1.png to item20.png (or more if they exist)
-    for i in range(1, 100):  # Check up to item99.png
-        img_name = f"item{i}.png"
-        img_path = img_dir / img_name
-        
-        if not img_path.exists():
-            # Stop when we don't find consecutive items
-            if i > 20:  # At least check first 20
-                break
-            continue
-        
+    # Same discovery as the furniture catalog (/api/catalog)
+    for img_path in catalog.discover_items(img_dir):
         found_count += 1
         if resize_image(img_path, target_size_item, "item"):
             resized_count += 1
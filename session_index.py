@@ -0,0 +1,186 @@
+"""
+Session 分片儲存與索引
+
+- 分片路徑：sessions/{shard}/{session_id}.json（GCS: json/{shard}/{session_id}.json），
+  shard 為 session_id 的 SHA1 前兩碼，每個目錄的檔案數維持在可控範圍
+- 舊的平面路徑 sessions/{session_id}.json 仍可讀取
+- SQLite 索引記錄 id、建立/更新時間、history 長度與儲存位置，
+  每次寫入 session 時增量更新，管理端列表不需要掃描檔案
+- 另有 history 新增圖片的引用記錄，retention sweeper（可能在其他 worker）每一批都會讀取
+"""
+
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+INDEX_FILENAME = ".index.sqlite3"
+
+
+def session_shard(session_id: str) -> str:
+    """session_id 對應的分片名稱（兩碼 hex，共 256 個分片）"""
+    return hashlib.sha1(session_id.encode("utf-8")).hexdigest()[:2]
+
+
+def session_relpath(session_id: str) -> str:
+    """分片後的相對路徑，例如 'a3/aB3xZ.json'"""
+    return f"{session_shard(session_id)}/{session_id}.json"
+
+
+def session_kind(session_id: str) -> str:
+    """session 種類：/api/session/create 產生的 sess_ 開頭，或 5 碼短 id"""
+    return "sess" if session_id.startswith("sess_") else "short"
+
+
+class SessionIndex:
+    """
+    SQLite session 索引（WAL 模式，多個 worker process 可同時讀寫）
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._local = threading.local()
+        self._init_schema()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.path), timeout=5.0, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self._conn()
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                created_at TEXT,
+                updated_at TEXT,
+                history_length INTEGER NOT NULL DEFAULT 0,
+                location TEXT NOT NULL,
+                path TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions (updated_at);
+            CREATE INDEX IF NOT EXISTS idx_sessions_created ON sessions (created_at);
+            CREATE TABLE IF NOT EXISTS image_references (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                added_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_image_references_added ON image_references (added_at);
+        """)
+
+    def upsert(self, session_id: str, data: dict, location: str, path: str):
+        """寫入 session 後更新索引"""
+        self._conn().execute(
+            """
+            INSERT INTO sessions (id, kind, created_at, updated_at, history_length, location, path)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                created_at = COALESCE(sessions.created_at, excluded.created_at),
+                updated_at = excluded.updated_at,
+                history_length = excluded.history_length,
+                location = excluded.location,
+                path = excluded.path
+            """,
+            (
+                session_id,
+                session_kind(session_id),
+                data.get("created_at"),
+                data.get("updated_at") or data.get("created_at"),
+                len(data.get("history") or []),
+                location,
+                path,
+            )
+        )
+
+    def remove(self, session_id: str):
+        self._conn().execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def get(self, session_id: str) -> Optional[dict]:
+        row = self._conn().execute("SELECT * FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return dict(row) if row else None
+
+    def _where(self, kind: Optional[str], since: Optional[str], until: Optional[str], field: str):
+        clauses, params = [], []
+        if kind:
+            clauses.append("kind = ?")
+            params.append(kind)
+        if since:
+            clauses.append(f"{field} >= ?")
+            params.append(since)
+        if until:
+            clauses.append(f"{field} < ?")
+            params.append(until)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", params
+
+    def list(self, limit: int = 50, offset: int = 0, order: str = "updated",
+             kind: Optional[str] = None, since: Optional[str] = None,
+             until: Optional[str] = None) -> List[dict]:
+        """
+        列出 session（依更新或建立時間，新的在前）
+
+        Args:
+            limit: 筆數
+            offset: 略過筆數
+            order: "updated" 或 "created"
+            kind: "sess" / "short"
+            since / until: ISO 時間範圍（套用在排序欄位）
+        """
+        field = "created_at" if order == "created" else "updated_at"
+        where, params = self._where(kind, since, until, field)
+        rows = self._conn().execute(
+            f"SELECT * FROM sessions{where} ORDER BY {field} DESC LIMIT ? OFFSET ?",
+            params + [limit, offset]
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def count(self, kind: Optional[str] = None, since: Optional[str] = None,
+              until: Optional[str] = None, order: str = "updated") -> int:
+        field = "created_at" if order == "created" else "updated_at"
+        where, params = self._where(kind, since, until, field)
+        return self._conn().execute(f"SELECT COUNT(*) FROM sessions{where}", params).fetchone()[0]
+
+    # -- 圖片引用記錄（retention 用） --
+
+    def add_references(self, names: Iterable[str]):
+        """記錄 session history 新增的圖片檔名"""
+        now = time.time()
+        rows = [(name, now) for name in names]
+        if rows:
+            self._conn().executemany("INSERT INTO image_references (name, added_at) VALUES (?, ?)", rows)
+
+    def references_since(self, seq: int) -> List[Tuple[int, str]]:
+        """seq 之後新增的引用：[(seq, 檔名)]，依 seq 排序"""
+        rows = self._conn().execute(
+            "SELECT seq, name FROM image_references WHERE seq > ? ORDER BY seq", (seq,)
+        ).fetchall()
+        return [(row["seq"], row["name"]) for row in rows]
+
+    def references_added_after(self, added_at: float) -> List[str]:
+        rows = self._conn().execute(
+            "SELECT name FROM image_references WHERE added_at >= ?", (added_at,)
+        ).fetchall()
+        return [row["name"] for row in rows]
+
+    def prune_references(self, before: float):
+        """刪除 before 之前的引用記錄（已包含在完整掃描的結果中）"""
+        self._conn().execute("DELETE FROM image_references WHERE added_at < ?", (before,))
+
+    def stats(self) -> dict:
+        row = self._conn().execute("""
+            SELECT COUNT(*) AS sessions,
+                   COALESCE(SUM(history_length), 0) AS images,
+                   MIN(created_at) AS first_created_at,
+                   MAX(updated_at) AS last_updated_at
+            FROM sessions
+        """).fetchone()
+        by_kind = self._conn().execute("SELECT kind, COUNT(*) AS n FROM sessions GROUP BY kind").fetchall()
+        return {**dict(row), "by_kind": {r["kind"]: r["n"] for r in by_kind}}
@@ -0,0 +1,161 @@
+"""
+Session 即時更新（delta / long-poll / SSE）
+
+- 版本號 = history 長度；客戶端帶 since=<版本>，只回傳之後新增的圖片
+- update_session_history 寫入後呼叫 publish()，喚醒所有等待同一 session 的連線
+- 同一 session 的讀取合併成一次（single-flight），最新內容快取在頻道上，
+  多個觀看者只會讀一次 GCS / 本地檔案
+- publish 只在同一個 process 內有效；等待逾時後會重新讀取一次，
+  其他 worker 寫入的更新最晚在一個逾時週期內被看到
+"""
+
+import asyncio
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+
+def history_delta(data: dict, since: Optional[int]) -> dict:
+    """
+    計算 since 之後新增的 history
+
+    Returns:
+        dict: {"version", "since", "reset", "history"}；
+              since 無效（未提供、超過目前長度）時 reset=True 並回傳完整 history
+    """
+    history = data.get("history") or []
+    version = len(history)
+    reset = since is None or since < 0 or since > version
+    start = 0 if reset else since
+    return {
+        "version": version,
+        "since": start,
+        "reset": reset,
+        "history": history[start:],
+    }
+
+
+class _Channel:
+    def __init__(self):
+        self.watchers = 0
+        self.snapshot: Optional[dict] = None
+        self.changed = asyncio.Event()
+
+
+class SessionWatcher:
+    """
+    Args:
+        loader: 同步讀取 session 的函式（在 thread pool 執行），找不到時回傳 None
+    """
+
+    def __init__(self, loader: Callable[[str], Optional[dict]]):
+        self._loader = loader
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._channels: Dict[str, _Channel] = {}
+        self._reads: Dict[str, asyncio.Future] = {}
+        self.backend_reads = 0
+        self.shared_reads = 0
+        self.wakeups = 0
+
+    # -- 寫入端 --
+
+    def publish(self, session_id: str, data: dict):
+        """session 更新後呼叫（任何 thread 都可以）"""
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._publish(session_id, data)
+        else:
+            loop.call_soon_threadsafe(self._publish, session_id, data)
+
+    def _publish(self, session_id: str, data: dict):
+        channel = self._channels.get(session_id)
+        if channel is None:
+            return
+        channel.snapshot = data
+        self.wakeups += channel.watchers
+        # 喚醒目前的等待者，之後的等待者使用新的 event
+        channel.changed.set()
+        channel.changed = asyncio.Event()
+
+    # -- 讀取端 --
+
+    async def read(self, session_id: str, refresh: bool = False) -> Optional[dict]:
+        """
+        讀取 session；有觀看者時使用頻道上的快取，
+        同時多個讀取只會實際讀取一次
+        """
+        self._loop = asyncio.get_running_loop()
+        channel = self._channels.get(session_id)
+        if channel is not None and channel.snapshot is not None and not refresh:
+            return channel.snapshot
+
+        future = self._reads.get(session_id)
+        if future is not None:
+            self.shared_reads += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.ensure_future(asyncio.to_thread(self._loader, session_id))
+        self._reads[session_id] = future
+        self.backend_reads += 1
+        try:
+            data = await asyncio.shield(future)
+        finally:
+            if self._reads.get(session_id) is future:
+                del self._reads[session_id]
+
+        channel = self._channels.get(session_id)
+        if channel is not None and data is not None:
+            # 讀取期間 publish 的內容比較新時不覆蓋
+            current = channel.snapshot
+            if current is None or len(data.get("history") or []) >= len(current.get("history") or []):
+                channel.snapshot = data
+        return data
+
+    @contextmanager
+    def watching(self, session_id: str):
+        """
+        登記為觀看者；期間頻道（與快取的最新內容）會保留。
+        SSE 連線在整個連線期間持有，避免每次等待之間重新讀取
+        """
+        channel = self._channels.setdefault(session_id, _Channel())
+        channel.watchers += 1
+        try:
+            yield channel
+        finally:
+            channel.watchers -= 1
+            if channel.watchers <= 0 and self._channels.get(session_id) is channel:
+                del self._channels[session_id]
+
+    async def wait(self, session_id: str, since: Optional[int], timeout: float) -> Optional[dict]:
+        """
+        等到 history 長度與 since 不同（或逾時）後回傳 session
+
+        Returns:
+            Optional[dict]: session 資料；session 不存在時回傳 None
+        """
+        self._loop = asyncio.get_running_loop()
+        with self.watching(session_id) as channel:
+            changed = channel.changed
+            data = await self.read(session_id)
+            if data is None or since is None or len(data.get("history") or []) != since:
+                return data
+            try:
+                await asyncio.wait_for(changed.wait(), timeout)
+                return channel.snapshot
+            except asyncio.TimeoutError:
+                # 可能是其他 worker 寫入的更新
+                return await self.read(session_id, refresh=True)
+
+    def stats(self) -> dict:
+        return {
+            "watched_sessions": len(self._channels),
+            "watchers": sum(c.watchers for c in self._channels.values()),
+            "backend_reads": self.backend_reads,
+            "shared_reads": self.shared_reads,
+            "wakeups": self.wakeups,
+        }
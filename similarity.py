@@ -0,0 +1,442 @@
+"""
+生成結果的相似度索引 - 找相似設計與重複圖片
+
+- 每張結果圖片計算 64-bit perceptual hash (DCT) 與 128 維 embedding
+  （4x4 色塊平均 + 色彩直方圖 + 邊緣方向直方圖，L2 正規化，只用 NumPy）
+- embedding 與 hash 以 memory-mapped 檔案存放（依列號連續排列），
+  名稱、checksum 與重複標記存在 SQLite
+- 搜尋是向量化的暴力搜尋（一次矩陣乘法 + argpartition），
+  數十萬張圖片仍在毫秒等級，不需要額外的 ANN 套件
+- 寫入時比對 SHA1（完全相同）與 hash 距離 + cosine（幾乎相同），標記重複供清理使用
+- 新結果由背景 thread 計算；多個 worker 以檔案鎖串行寫入
+"""
+
+import hashlib
+import io
+import os
+import queue
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+import jsonlog
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+EMBED_DIM = 128
+# 幾乎相同的判斷：hash 距離與 cosine 都要符合
+NEAR_DUP_HAMMING = 6
+NEAR_DUP_COSINE = 0.97
+# memmap 每次擴充的列數
+GROW_ROWS = 4096
+# 搜尋時每批處理的列數（限制暫存記憶體）
+SEARCH_CHUNK = 262144
+# 背景 worker 檢查停止旗標的間隔（秒）
+POLL_SECONDS = 1.0
+
+
+# ---------------------------------------------------------------------------
+# 特徵
+# ---------------------------------------------------------------------------
+
+_DCT_CACHE: Dict[int, np.ndarray] = {}
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    matrix = _DCT_CACHE.get(n)
+    if matrix is None:
+        k = np.arange(n)[:, None]
+        i = np.arange(n)[None, :]
+        matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+        matrix[0] /= np.sqrt(2)
+        _DCT_CACHE[n] = matrix.astype(np.float32)
+    return matrix
+
+
+def perceptual_hash(img: Image.Image) -> int:
+    """64-bit pHash：32x32 灰階的 DCT，左上 8x8 低頻係數與中位數比較"""
+    gray = np.asarray(img.convert("L").resize((32, 32), Image.Resampling.LANCZOS), dtype=np.float32)
+    dct = _dct_matrix(32)
+    low = (dct @ gray @ dct.T)[:8, :8].flatten()
+    bits = low > np.median(low[1:])
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+def embedding(img: Image.Image) -> np.ndarray:
+    """128 維 embedding（每個區塊各自正規化後再整體正規化）"""
+    rgb = np.asarray(img.convert("RGB").resize((64, 48), Image.Resampling.BILINEAR), dtype=np.float32) / 255.0
+
+    # 4x4 色塊平均 (48)
+    layout = rgb.reshape(4, 12, 4, 16, 3).mean(axis=(1, 3)).flatten()
+    layout -= layout.mean()
+
+    # 色彩直方圖 4x4x4 (64)
+    levels = np.minimum((rgb * 4).astype(np.int32), 3)
+    bins = levels[..., 0] * 16 + levels[..., 1] * 4 + levels[..., 2]
+    color = np.sqrt(np.bincount(bins.ravel(), minlength=64).astype(np.float32))
+
+    # 邊緣方向直方圖 (16)，以梯度大小加權
+    gray = rgb.mean(axis=2)
+    gx = np.diff(gray, axis=1)[:-1, :]
+    gy = np.diff(gray, axis=0)[:, :-1]
+    angle = (np.arctan2(gy, gx) + np.pi) / (2 * np.pi)
+    edges = np.bincount(np.minimum((angle * 16).astype(np.int32), 15).ravel(),
+                        weights=np.hypot(gx, gy).ravel(), minlength=16).astype(np.float32)
+
+    parts = []
+    for part in (layout, color, edges):
+        norm = np.linalg.norm(part)
+        parts.append(part / norm if norm > 0 else part)
+    vector = np.concatenate(parts)
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm > 0 else vector).astype(np.float32)
+
+
+def image_features(data: bytes) -> Tuple[int, np.ndarray, str]:
+    """
+    Returns:
+        tuple: (perceptual hash, embedding, sha1)
+    """
+    with Image.open(io.BytesIO(data)) as img:
+        img.draft("RGB", (256, 256))  # JPEG 直接以較小尺寸解碼
+        return perceptual_hash(img), embedding(img), hashlib.sha1(data).hexdigest()
+
+
+def _popcount(values: np.ndarray) -> np.ndarray:
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    return np.unpackbits(values.view(np.uint8)).reshape(-1, 64).sum(axis=1)
+
+
+def _to_signed(value: int) -> int:
+    """uint64 -> SQLite INTEGER (int64)"""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+# ---------------------------------------------------------------------------
+# 索引
+# ---------------------------------------------------------------------------
+
+class SimilarityIndex:
+    """
+    檔案:
+        vectors.f32  - N x EMBED_DIM float32 (memmap)
+        hashes.u64   - N 個 uint64 (memmap)
+        index.sqlite3 - 列號、名稱、sha1、重複標記
+
+    Args:
+        directory: 索引目錄
+        queue_size: 背景計算佇列長度（滿了就略過，之後可用 scripts/similarity.py backfill 補上）
+    """
+
+    def __init__(self, directory: Path, queue_size: int = 256):
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.vectors_path = directory / "vectors.f32"
+        self.hashes_path = directory / "hashes.u64"
+        self.lock_path = directory / ".lock"
+        self._local = threading.local()
+        self._maps = None
+        self._maps_lock = threading.Lock()
+        self._queue: "queue.Queue" = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self.indexed = 0
+        self.dropped = 0
+        self.failed = 0
+        self._init_schema()
+
+    # -- SQLite --
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.directory / "index.sqlite3"), timeout=10.0, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS images (
+                row INTEGER PRIMARY KEY,
+                name TEXT UNIQUE NOT NULL,
+                sha1 TEXT NOT NULL,
+                phash INTEGER NOT NULL,
+                duplicate_of TEXT,
+                duplicate_kind TEXT,
+                similarity REAL,
+                deleted INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_images_sha1 ON images (sha1);
+            CREATE INDEX IF NOT EXISTS idx_images_duplicate ON images (duplicate_of);
+        """)
+
+    def count(self) -> int:
+        row = self._conn().execute("SELECT MAX(row) FROM images").fetchone()
+        return 0 if row[0] is None else row[0] + 1
+
+    def get(self, name: str) -> Optional[dict]:
+        row = self._conn().execute("SELECT * FROM images WHERE name = ?", (name,)).fetchone()
+        return dict(row) if row else None
+
+    # -- memmap --
+
+    def _arrays(self, count: int):
+        """目前 count 列的 (vectors, hashes) 唯讀 view；檔案變大後重新 map"""
+        size = os.path.getsize(self.vectors_path) if self.vectors_path.exists() else 0
+        with self._maps_lock:
+            if self._maps is None or self._maps[0] != size:
+                if size == 0:
+                    return np.zeros((0, EMBED_DIM), np.float32), np.zeros(0, np.uint64)
+                rows = size // (EMBED_DIM * 4)
+                vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(rows, EMBED_DIM))
+                hashes = np.memmap(self.hashes_path, dtype=np.uint64, mode="r", shape=(rows,))
+                self._maps = (size, vectors, hashes)
+            _, vectors, hashes = self._maps
+        count = min(count, len(hashes))
+        return vectors[:count], hashes[:count]
+
+    def _write_row(self, row: int, vector: np.ndarray, phash: int):
+        capacity = ((row // GROW_ROWS) + 1) * GROW_ROWS
+        for path, width in ((self.vectors_path, EMBED_DIM * 4), (self.hashes_path, 8)):
+            with open(path, "ab") as f:
+                if f.tell() < capacity * width:
+                    f.truncate(capacity * width)
+        with open(self.vectors_path, "r+b") as f:
+            f.seek(row * EMBED_DIM * 4)
+            f.write(vector.astype(np.float32).tobytes())
+        with open(self.hashes_path, "r+b") as f:
+            f.seek(row * 8)
+            f.write(np.array([phash], dtype=np.uint64).tobytes())
+
+    # -- 寫入 --
+
+    def _find_duplicate(self, sha1: str, phash: int, vector: np.ndarray, count: int):
+        row = self._conn().execute(
+            "SELECT name FROM images WHERE sha1 = ? AND deleted = 0 LIMIT 1", (sha1,)
+        ).fetchone()
+        if row:
+            return row["name"], "exact", 1.0
+
+        vectors, hashes = self._arrays(count)
+        if not len(hashes):
+            return None, None, None
+        distances = _popcount(hashes ^ np.uint64(phash))
+        candidates = np.nonzero(distances <= NEAR_DUP_HAMMING)[0]
+        if not len(candidates):
+            return None, None, None
+        scores = vectors[candidates] @ vector
+        best = int(np.argmax(scores))
+        if scores[best] < NEAR_DUP_COSINE:
+            return None, None, None
+        match = self._conn().execute(
+            "SELECT name FROM images WHERE row = ? AND deleted = 0", (int(candidates[best]),)
+        ).fetchone()
+        if not match:
+            return None, None, None
+        return match["name"], "near", float(scores[best])
+
+    def add(self, name: str, data: bytes) -> Optional[dict]:
+        """
+        加入一張圖片（已存在時略過）
+
+        Returns:
+            Optional[dict]: {"name", "row", "duplicate_of", "duplicate_kind", "similarity"}
+        """
+        if self.get(name):
+            return None
+        phash, vector, sha1 = image_features(data)
+
+        lock_file = open(self.lock_path, "w")
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if self.get(name):
+                return None
+            row = self.count()
+            duplicate_of, kind, score = self._find_duplicate(sha1, phash, vector, row)
+            self._write_row(row, vector, phash)
+            self._conn().execute(
+                """
+                INSERT INTO images (row, name, sha1, phash, duplicate_of, duplicate_kind, similarity, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (row, name, sha1, _to_signed(phash), duplicate_of, kind, score, time.time())
+            )
+        finally:
+            lock_file.close()
+
+        self.indexed += 1
+        return {"name": name, "row": row, "duplicate_of": duplicate_of,
+                "duplicate_kind": kind, "similarity": score}
+
+    def remove(self, name: str):
+        """圖片被刪除時標記，並清空向量（搜尋結果不再出現）"""
+        record = self.get(name)
+        if record is None or record["deleted"]:
+            return
+        self._conn().execute("UPDATE images SET deleted = 1 WHERE name = ?", (name,))
+        with open(self.vectors_path, "r+b") as f:
+            f.seek(record["row"] * EMBED_DIM * 4)
+            f.write(bytes(EMBED_DIM * 4))
+
+    # -- 搜尋 --
+
+    def search(self, vector: np.ndarray, k: int = 10, exclude: Optional[str] = None) -> List[dict]:
+        """
+        cosine 相似度最高的 k 張
+
+        Returns:
+            List[dict]: [{"name", "similarity", "distance"}]，distance 為 hash 的 Hamming 距離
+        """
+        count = self.count()
+        vectors, hashes = self._arrays(count)
+        if not len(vectors):
+            return []
+
+        want = k + 1 + (1 if exclude else 0)
+        best_rows, best_scores = [], []
+        for start in range(0, len(vectors), SEARCH_CHUNK):
+            scores = vectors[start:start + SEARCH_CHUNK] @ vector
+            top = np.argpartition(-scores, min(want, len(scores)) - 1)[:want]
+            best_rows.append(top + start)
+            best_scores.append(scores[top])
+        rows = np.concatenate(best_rows)
+        scores = np.concatenate(best_scores)
+        order = np.argsort(-scores)
+
+        query_hash = None
+        results = []
+        placeholders = ",".join("?" * len(order))
+        records = {
+            r["row"]: r for r in self._conn().execute(
+                f"SELECT row, name, phash, deleted FROM images WHERE row IN ({placeholders})",
+                [int(rows[i]) for i in order]
+            )
+        }
+        for i in order:
+            record = records.get(int(rows[i]))
+            if record is None or record["deleted"] or record["name"] == exclude:
+                continue
+            if query_hash is None and exclude:
+                own = self.get(exclude)
+                query_hash = own["phash"] if own else None
+            distance = None
+            if query_hash is not None:
+                distance = bin((record["phash"] ^ query_hash) & ((1 << 64) - 1)).count("1")
+            results.append({
+                "name": record["name"],
+                "similarity": round(float(scores[i]), 4),
+                "distance": distance,
+            })
+            if len(results) >= k:
+                break
+        return results
+
+    def similar(self, name: str, k: int = 10) -> Optional[List[dict]]:
+        """已索引圖片的相似圖片；圖片未索引時回傳 None"""
+        record = self.get(name)
+        if record is None:
+            return None
+        vectors, _ = self._arrays(record["row"] + 1)
+        if record["row"] >= len(vectors):
+            return None
+        return self.search(np.array(vectors[record["row"]]), k, exclude=name)
+
+    def similar_to_bytes(self, data: bytes, k: int = 10) -> List[dict]:
+        _, vector, _ = image_features(data)
+        return self.search(vector, k)
+
+    def duplicates(self, limit: int = 100, offset: int = 0, kind: Optional[str] = None) -> List[dict]:
+        """標記為重複的圖片（可刪除，保留 duplicate_of）"""
+        clause = "duplicate_of IS NOT NULL AND deleted = 0"
+        params: list = []
+        if kind:
+            clause += " AND duplicate_kind = ?"
+            params.append(kind)
+        rows = self._conn().execute(
+            f"""
+            SELECT name, duplicate_of, duplicate_kind, similarity, created_at FROM images
+            WHERE {clause} ORDER BY row DESC LIMIT ? OFFSET ?
+            """,
+            params + [limit, offset]
+        ).fetchall()
+        return [dict(r) for r in rows]
+
+    # -- 背景 worker --
+
+    def submit(self, name: str, data: bytes) -> bool:
+        """排入背景計算；佇列滿了或 worker 未啟動時略過"""
+        if self._thread is None:
+            return False
+        try:
+            self._queue.put_nowait((name, data))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="similarity-indexer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """通知背景 worker 停止（不等待；佇列滿時也不會阻塞）"""
+        if self._thread is not None:
+            self._stop.set()
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                pass  # worker 會在 POLL_SECONDS 內看到停止旗標
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                item = self._queue.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                continue
+            if item is None or self._stop.is_set():
+                return
+            name, data = item
+            try:
+                result = self.add(name, data)
+                if result and result["duplicate_of"]:
+                    jsonlog.log("similarity_duplicate",
+                                f"{name} is a {result['duplicate_kind']} duplicate of {result['duplicate_of']}",
+                                image=name, duplicate_of=result["duplicate_of"],
+                                kind=result["duplicate_kind"], similarity=result["similarity"])
+            except Exception as e:
+                self.failed += 1
+                jsonlog.log("similarity_index_failed", f"Similarity indexing failed for {name}: {e}",
+                            severity="WARNING", image=name)
+
+    def stats(self) -> dict:
+        conn = self._conn()
+        row = conn.execute("""
+            SELECT COUNT(*) AS images,
+                   COALESCE(SUM(deleted), 0) AS deleted,
+                   COALESCE(SUM(duplicate_kind = 'exact' AND deleted = 0), 0) AS exact_duplicates,
+                   COALESCE(SUM(duplicate_kind = 'near' AND deleted = 0), 0) AS near_duplicates
+            FROM images
+        """).fetchone()
+        return {
+            **dict(row),
+            "queued": self._queue.qsize(),
+            "indexed": self.indexed,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
@@ -0,0 +1,426 @@
+"""
+起始場景的預先生成庫存
+
+大部分 session 從同樣四張起始場景（space/moon/mars/ship）開始，第一次編輯通常是
+差不多的「看起來更真實」。這裡為常見的第一步（配方）預先生成幾張結果放著，
+session 的第一次 /api/edit 符合配方時直接回傳庫存，不用等一次 Gemini。
+
+- 配方 = 起始場景 + 正規化後的 prompt + 家具擺放 + region mode + 生成設定檔
+- 每個配方保留 depth 張，每張只給一個 session（先進先出輪替）；超過 max_age 的視為過期丟棄
+- 配方來源：設定的預設 prompt（每個場景各一個），以及實際請求中出現至少 MIN_DEMAND 次的組合
+- 只在所有 worker 的排程器都閒置一段時間後補貨（離峰），每小時最多生成 hourly_budget 張
+- 庫存、學到的配方、每小時預算與閒置時間記在共用的狀態檔（以 flock 互斥），
+  gunicorn 多個 worker 共用同一份；同一時間只有一個 worker 在補貨
+- 沒有狀態檔（或沒有 fcntl）時退回 process 內的記憶體
+
+庫存中的結果由 retention 的 protect hook 保護（held_names）；被丟棄的過期結果
+沒有被任何 session 引用，會由 retention 清掉。
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field, fields
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional, Set
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+DEFAULT_DEPTH = 2
+DEFAULT_MAX_AGE = 6 * 3600
+DEFAULT_HOURLY_BUDGET = 20
+DEFAULT_MAX_RECIPES = 12
+# 學到的配方至少被請求幾次才開始備貨
+MIN_DEMAND = 2
+# 排程器需要連續閒置的秒數
+IDLE_SECONDS = 30
+TICK_SECONDS = 5
+# 補貨中的標記逾時秒數（補貨的 worker 中途結束時，其他 worker 才能接手）
+PRODUCE_TIMEOUT = 300
+# retention 查詢庫存檔名的快取秒數
+HELD_CACHE_SECONDS = 10
+
+METRIC_SAMPLES = 500
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_prompt(prompt: str) -> str:
+    """大小寫、空白與結尾標點不影響配對"""
+    return _WHITESPACE.sub(" ", prompt or "").strip().rstrip(".!").lower()
+
+
+def canonical_placements(placements: Optional[list]) -> list:
+    """家具擺放取整數座標（保留順序，繪製時後面的會蓋住前面的）"""
+    result = []
+    for p in placements or []:
+        result.append({
+            "id": str(p.get("id")),
+            "x": int(round(float(p.get("x", 0)))),
+            "y": int(round(float(p.get("y", 0)))),
+            "size": int(round(float(p["size"]))) if p.get("size") is not None else None,
+        })
+    return result
+
+
+@dataclass
+class Recipe:
+    """一個第一步的組合"""
+    scene: str
+    prompt: str
+    placements: list = field(default_factory=list)
+    regions: Optional[list] = None
+    profile: str = "final"
+    seeded: bool = False
+    demand: int = 0
+    last_requested: float = 0.0
+
+    @property
+    def key(self) -> str:
+        payload = json.dumps([
+            self.scene,
+            normalize_prompt(self.prompt),
+            canonical_placements(self.placements),
+            self.regions,
+            self.profile,
+        ], sort_keys=True)
+        return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        data.pop("seeded")
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Recipe":
+        names = {f.name for f in fields(cls)} - {"seeded"}
+        return cls(**{k: v for k, v in data.items() if k in names})
+
+
+@dataclass
+class StockItem:
+    url: str
+    created_at: float = field(default_factory=time.time)
+
+
+# recipe -> 生成結果的 URL（失敗時回傳 None）
+Producer = Callable[[Recipe], Awaitable[Optional[str]]]
+
+COUNTERS = ("hits", "misses", "stale_discarded", "produced", "failed", "deferred_budget")
+
+
+class _SharedState:
+    """
+    庫存狀態檔 (JSON)：所有 worker 共用，讀改寫期間以 flock 鎖住 <path>.lock
+
+    path 為 None 或沒有 fcntl 時只存在 process 內的記憶體
+    """
+
+    def __init__(self, path: Optional[Path]):
+        self.path = Path(path) if path is not None and fcntl is not None else None
+        self._lock = threading.Lock()
+        self._memory: dict = {}
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path, "r") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return state if isinstance(state, dict) else {}
+
+    def _write(self, state: dict):
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+
+    @contextmanager
+    def transaction(self, write: bool = True) -> Iterator[dict]:
+        """取得狀態；write=True 時離開時寫回（中途發生例外則不寫）"""
+        with self._lock:
+            if self.path is None:
+                yield self._memory
+                return
+            with open(self.path.with_name(self.path.name + ".lock"), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    state = self._read()
+                    yield state
+                    if write:
+                        self._write(state)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class StarterStock:
+    """
+    Args:
+        producer: 生成一張庫存的 coroutine
+        is_idle: 本 worker 的排程器是否閒置
+        depth: 每個配方的庫存數
+        max_age: 庫存的有效秒數
+        hourly_budget: 每小時最多預先生成幾張（所有 worker 合計）
+        max_recipes: 最多備貨的配方數
+        idle_seconds: 所有 worker 的排程器需要連續閒置多久才補貨
+        state_path: 共用狀態檔路徑（None 時只在記憶體中）
+    """
+
+    def __init__(self, producer: Producer, is_idle: Callable[[], bool], depth: int = DEFAULT_DEPTH,
+                 max_age: float = DEFAULT_MAX_AGE, hourly_budget: int = DEFAULT_HOURLY_BUDGET,
+                 max_recipes: int = DEFAULT_MAX_RECIPES, idle_seconds: float = IDLE_SECONDS,
+                 state_path: Optional[Path] = None):
+        self._producer = producer
+        self._is_idle = is_idle
+        self.depth = depth
+        self.max_age = max_age
+        self.hourly_budget = hourly_budget
+        self.max_recipes = max_recipes
+        self.idle_seconds = idle_seconds
+        # 預設配方來自設定，每個 worker 相同；學到的配方與需求記在狀態檔
+        self._seeded: Dict[str, Recipe] = {}
+        self._state = _SharedState(state_path)
+        self._task: Optional[asyncio.Task] = None
+        self._held: Optional[tuple] = None
+
+    # -- 配方 --
+
+    def seed(self, recipe: Recipe):
+        """加入預設配方（一定備貨）"""
+        recipe.seeded = True
+        self._seeded.setdefault(recipe.key, recipe)
+
+    def _recipes(self, state: dict) -> Dict[str, Recipe]:
+        recipes = {key: Recipe(**{**asdict(r), "demand": 0, "last_requested": 0.0})
+                   for key, r in self._seeded.items()}
+        for key, data in state.get("recipes", {}).items():
+            if key in recipes:
+                recipes[key].demand = data.get("demand", 0)
+                recipes[key].last_requested = data.get("last_requested", 0.0)
+            else:
+                recipes[key] = Recipe.from_dict(data)
+        return recipes
+
+    def observe(self, recipe: Recipe) -> Recipe:
+        """記錄一次第一步請求（用來學習常見的組合）"""
+        with self._state.transaction() as state:
+            observed = state.setdefault("recipes", {})
+            data = observed.get(recipe.key) or recipe.to_dict()
+            data["demand"] = data.get("demand", 0) + 1
+            data["last_requested"] = time.time()
+            observed[recipe.key] = data
+            self._prune_recipes(state)
+            return self._recipes(state)[recipe.key]
+
+    def _prune_recipes(self, state: dict):
+        """只保留需求最高的學到的配方（另外保留等待累積需求的新配方）"""
+        observed = state.get("recipes", {})
+        learned = [key for key in observed if key not in self._seeded]
+        limit = self.max_recipes * 4
+        if len(learned) <= limit:
+            return
+        stock = state.get("stock", {})
+        learned.sort(key=lambda k: (observed[k].get("demand", 0), observed[k].get("last_requested", 0.0)))
+        for key in learned[:len(learned) - limit]:
+            if not stock.get(key):
+                del observed[key]
+
+    def _stocked_recipes(self, state: dict) -> List[Recipe]:
+        recipes = self._recipes(state).values()
+        seeded = [r for r in recipes if r.seeded]
+        learned = sorted(
+            (r for r in recipes if not r.seeded and r.demand >= MIN_DEMAND),
+            key=lambda r: (-r.demand, -r.last_requested)
+        )
+        return (seeded + learned)[:max(self.max_recipes, len(seeded))]
+
+    # -- 取用 --
+
+    @staticmethod
+    def _count(state: dict, name: str, n: int = 1):
+        counters = state.setdefault("counters", {})
+        counters[name] = counters.get(name, 0) + n
+
+    def _drop_stale(self, state: dict, key: str, now: float):
+        items = state.get("stock", {}).get(key)
+        while items and now - items[0][1] > self.max_age:
+            items.pop(0)
+            self._count(state, "stale_discarded")
+
+    def take(self, recipe: Recipe) -> Optional[StockItem]:
+        """
+        取出一張庫存（最舊的先用；可能是其他 worker 生成的）
+
+        Returns:
+            Optional[StockItem]: 沒有可用庫存時回傳 None
+        """
+        now = time.time()
+        with self._state.transaction() as state:
+            self._drop_stale(state, recipe.key, now)
+            items = state.get("stock", {}).get(recipe.key)
+            if not items:
+                self._count(state, "misses")
+                return None
+            url, created_at = items.pop(0)
+            self._count(state, "hits")
+            served = state.setdefault("served_age", [])
+            served.append(now - created_at)
+            del served[:-METRIC_SAMPLES]
+            return StockItem(url, created_at)
+
+    def held_names(self) -> Set[str]:
+        """庫存中（尚未取用）的結果檔名，給 retention 保護用（短暫快取）"""
+        now = time.monotonic()
+        if self._held is None or now - self._held[0] > HELD_CACHE_SECONDS:
+            with self._state.transaction(write=False) as state:
+                names = {
+                    Path(url.split("?", 1)[0]).name
+                    for items in state.get("stock", {}).values()
+                    for url, _ in items
+                }
+            self._held = (now, names)
+        return self._held[1]
+
+    # -- 補貨 --
+
+    def _spent(self, state: dict, now: float) -> list:
+        spent = [t for t in state.get("spent", []) if now - t <= 3600]
+        state["spent"] = spent
+        return spent
+
+    def _next_recipe(self, state: dict, now: float) -> Optional[Recipe]:
+        """庫存最少的配方（同樣數量時需求高的優先）"""
+        candidates = []
+        for recipe in self._stocked_recipes(state):
+            self._drop_stale(state, recipe.key, now)
+            count = len(state.get("stock", {}).get(recipe.key) or ())
+            if count < self.depth:
+                candidates.append((count, -recipe.demand, recipe))
+        if not candidates:
+            return None
+        return min(candidates, key=lambda c: c[:2])[2]
+
+    def _reserve(self, idle: bool) -> Optional[tuple]:
+        """
+        所有 worker 都閒置夠久、沒有其他 worker 在補貨且還有預算時，預約一次補貨
+
+        Returns:
+            Optional[tuple]: (配方, 補貨標記)；不補貨時回傳 None
+        """
+        now = time.time()
+        with self._state.transaction() as state:
+            if not idle:
+                # 任一 worker 忙碌，所有 worker 都要重新累積閒置時間
+                state["busy_at"] = now
+                return None
+            if now - state.setdefault("busy_at", now) < self.idle_seconds:
+                return None
+            producing = state.get("producing")
+            if producing and producing["until"] > now:
+                return None
+            recipe = self._next_recipe(state, now)
+            if recipe is None:
+                return None
+            spent = self._spent(state, now)
+            if len(spent) >= self.hourly_budget:
+                self._count(state, "deferred_budget")
+                return None
+            spent.append(now)
+            token = f"{os.getpid()}:{now}"
+            state["producing"] = {"key": recipe.key, "token": token, "until": now + PRODUCE_TIMEOUT}
+            return recipe, token
+
+    def _finish(self, recipe: Recipe, token: str, url: Optional[str]):
+        with self._state.transaction() as state:
+            if (state.get("producing") or {}).get("token") == token:
+                del state["producing"]
+            if not url:
+                self._count(state, "failed")
+                return
+            state.setdefault("stock", {}).setdefault(recipe.key, []).append([url, time.time()])
+            self._count(state, "produced")
+
+    async def refill_once(self) -> bool:
+        """
+        離峰且還有預算時補一張
+
+        Returns:
+            bool: 是否生成了一張
+        """
+        reserved = await asyncio.to_thread(self._reserve, self._is_idle())
+        if reserved is None:
+            return False
+        recipe, token = reserved
+        try:
+            url = await self._producer(recipe)
+        except Exception:
+            url = None
+        await asyncio.to_thread(self._finish, recipe, token, url)
+        return bool(url)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refill_once()
+            except Exception as e:
+                print(f"⚠️  Starter stock refill failed: {e}")
+            await asyncio.sleep(TICK_SECONDS)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        """所有 worker 合計的庫存指標"""
+        now = time.time()
+        with self._state.transaction(write=False) as state:
+            counters = {name: state.get("counters", {}).get(name, 0) for name in COUNTERS}
+            ages = sorted(state.get("served_age", []))
+            budget_left = self.hourly_budget - sum(1 for t in state.get("spent", []) if now - t <= 3600)
+            stock = {key: [i for i in items if now - i[1] <= self.max_age]
+                     for key, items in state.get("stock", {}).items()}
+            recipes = self._stocked_recipes(state)
+            producing = state.get("producing")
+        lookups = counters["hits"] + counters["misses"]
+        return {
+            "depth": self.depth,
+            "max_age": self.max_age,
+            "hourly_budget": self.hourly_budget,
+            "budget_left": budget_left,
+            **counters,
+            "hit_ratio": round(counters["hits"] / lookups, 4) if lookups else None,
+            "producing": producing["key"] if producing and producing["until"] > now else None,
+            "served_age_s_p50": round(ages[len(ages) // 2], 1) if ages else None,
+            "served_age_s_max": round(ages[-1], 1) if ages else None,
+            "recipes": [
+                {
+                    "key": recipe.key,
+                    "scene": recipe.scene,
+                    "prompt": normalize_prompt(recipe.prompt)[:80],
+                    "placements": len(recipe.placements),
+                    "profile": recipe.profile,
+                    "seeded": recipe.seeded,
+                    "demand": recipe.demand,
+                    "stock": len(stock.get(recipe.key) or ()),
+                    "oldest_s": round(now - stock[recipe.key][0][1], 1) if stock.get(recipe.key) else None,
+                }
+                for recipe in recipes
+            ],
+        }
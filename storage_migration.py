@@ -0,0 +1,484 @@
+"""
+本地 <-> GCS 資料搬移
+
+- input/、result/ 直接複製；sessions/ 的 JSON 在搬移時改寫 history 中的圖片 URL
+  （本地 /images/... <-> https://storage.googleapis.com/{bucket}/result/...）
+- 以 thread pool 並行傳輸，傳輸後以 CRC32C（沒有時用 MD5）比對驗證
+- 目的地已有相同內容的檔案直接略過；進度記錄在 journal 檔，中斷後重跑會接續
+- DirectoryBucket 以本地目錄模擬 bucket（介面與 google-cloud-storage 相同的子集），
+  可以不連 GCS 測試整個流程
+"""
+
+import base64
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import output_encoding
+import session_index
+
+try:
+    import google_crc32c
+except ImportError:  # google-cloud-storage 的相依套件，一般都會有
+    google_crc32c = None
+
+# 本地目錄 -> GCS prefix
+FOLDERS = {
+    "input": "input",
+    "result": "result",
+    "sessions": "json",
+}
+DIRECTIONS = ("to-gcs", "to-local")
+CHUNK_SIZE = 1024 * 1024
+
+
+# ---------------------------------------------------------------------------
+# Checksums
+# ---------------------------------------------------------------------------
+
+def _b64(digest: bytes) -> str:
+    return base64.b64encode(digest).decode("ascii")
+
+
+def checksums_of_bytes(data: bytes) -> Tuple[Optional[str], str]:
+    """(crc32c, md5)，格式與 GCS blob 的 crc32c / md5_hash 相同（base64）"""
+    crc = _b64(google_crc32c.Checksum(data).digest()) if google_crc32c else None
+    return crc, _b64(hashlib.md5(data).digest())
+
+
+def checksums_of_file(path: Path) -> Tuple[Optional[str], str]:
+    crc = google_crc32c.Checksum() if google_crc32c else None
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            md5.update(chunk)
+            if crc is not None:
+                crc.update(chunk)
+    return (_b64(crc.digest()) if crc is not None else None), _b64(md5.digest())
+
+
+def checksums_match(crc_a: Optional[str], md5_a: Optional[str],
+                    crc_b: Optional[str], md5_b: Optional[str]) -> bool:
+    """優先比對 CRC32C（composite object 沒有 MD5），其次 MD5"""
+    if crc_a and crc_b:
+        return crc_a == crc_b
+    if md5_a and md5_b:
+        return md5_a == md5_b
+    return False
+
+
+# ---------------------------------------------------------------------------
+# 本地模擬 bucket
+# ---------------------------------------------------------------------------
+
+class _DirectoryBlob:
+    def __init__(self, bucket: "DirectoryBucket", name: str):
+        self.bucket = bucket
+        self.name = name
+        self.size = None
+        self.crc32c = None
+        self.md5_hash = None
+
+    @property
+    def _path(self) -> Path:
+        return self.bucket.root / self.name
+
+    def exists(self) -> bool:
+        return self._path.is_file()
+
+    def reload(self):
+        self.size = self._path.stat().st_size
+        self.crc32c, self.md5_hash = checksums_of_file(self._path)
+
+    def upload_from_filename(self, filename, content_type=None):
+        self.upload_from_string(Path(filename).read_bytes(), content_type=content_type)
+
+    def upload_from_string(self, data: bytes, content_type=None):
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self._path.with_name(self._path.name + ".uploading")
+        tmp.write_bytes(data)
+        os.replace(tmp, self._path)
+
+    def download_to_filename(self, filename):
+        Path(filename).write_bytes(self.download_as_bytes())
+
+    def download_as_bytes(self) -> bytes:
+        return self._path.read_bytes()
+
+
+class DirectoryBucket:
+    """以本地目錄模擬 GCS bucket，物件名稱即相對路徑"""
+
+    def __init__(self, root: Path, name: str = "fake-bucket"):
+        self.root = Path(root)
+        self.name = name
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def blob(self, name: str) -> _DirectoryBlob:
+        return _DirectoryBlob(self, name)
+
+    def list_blobs(self, prefix: str = "") -> Iterator[_DirectoryBlob]:
+        base = self.root / prefix
+        if not base.is_dir():
+            return
+        for path in sorted(base.rglob("*")):
+            if path.is_file() and not path.name.endswith(".uploading"):
+                blob = self.blob(path.relative_to(self.root).as_posix())
+                blob.reload()
+                yield blob
+
+
+# ---------------------------------------------------------------------------
+# URL 改寫
+# ---------------------------------------------------------------------------
+
+_LOCAL_URL = re.compile(r"^(?:https?://[^/]+)?/images/([^/?#]+)$")
+
+
+def rewrite_url(url: str, direction: str, bucket_name: str, base_url: str) -> str:
+    """
+    改寫 history 中的結果圖片 URL，其他 URL（起始場景等）不變
+
+    Args:
+        url: 原本的 URL
+        direction: "to-gcs" / "to-local"
+        bucket_name: GCS bucket 名稱
+        base_url: 本地模式的 BASE_URL
+    """
+    if direction == "to-gcs":
+        match = _LOCAL_URL.match(url)
+        if match:
+            return f"https://storage.googleapis.com/{bucket_name}/result/{match.group(1)}"
+    else:
+        prefix = f"https://storage.googleapis.com/{bucket_name}/result/"
+        if url.startswith(prefix):
+            return f"{base_url.rstrip('/')}/images/{url[len(prefix):]}"
+    return url
+
+
+def rewrite_session(data: dict, direction: str, bucket_name: str, base_url: str) -> int:
+    """改寫 session 的 history（就地修改），回傳改寫的 URL 數"""
+    history = data.get("history") or []
+    changed = 0
+    for index, url in enumerate(history):
+        if not isinstance(url, str):
+            continue
+        new_url = rewrite_url(url, direction, bucket_name, base_url)
+        if new_url != url:
+            history[index] = new_url
+            changed += 1
+    return changed
+
+
+# ---------------------------------------------------------------------------
+# Journal（續傳）
+# ---------------------------------------------------------------------------
+
+class Journal:
+    """
+    已完成的項目（JSON lines）：key、來源大小與 stamp、checksum
+    stamp 是本地來源的 mtime 或遠端來源的 checksum；
+    來源沒有變動時直接略過，不需要重新計算 checksum 或查詢目的地
+    """
+
+    def __init__(self, path: Optional[Path]):
+        self.path = path
+        self.entries: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        if path and path.exists():
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.entries[entry["key"]] = entry
+                    except (ValueError, KeyError):
+                        continue  # 中斷時寫到一半的行
+
+    def done(self, key: str, size: int, stamp) -> bool:
+        entry = self.entries.get(key)
+        return bool(entry) and entry.get("size") == size and entry.get("stamp") == stamp
+
+    def record(self, key: str, size: int, stamp, crc32c: Optional[str], md5: Optional[str]):
+        entry = {"key": key, "size": size, "stamp": stamp, "crc32c": crc32c, "md5": md5}
+        with self._lock:
+            self.entries[key] = entry
+            if self.path:
+                with open(self.path, "a") as f:
+                    f.write(json.dumps(entry) + "\n")
+
+
+# ---------------------------------------------------------------------------
+# 搬移
+# ---------------------------------------------------------------------------
+
+@dataclass
+class Task:
+    kind: str           # input / result / sessions
+    key: str            # GCS 物件名稱
+    local_path: Path    # 本地路徑
+    source_path: Optional[Path] = None   # to-gcs: 來源檔（舊的平面 session 路徑可能與 local_path 不同）
+    remote: Optional[object] = None      # to-local: 來源 blob
+
+
+@dataclass
+class MigrationStats:
+    copied: int = 0
+    skipped: int = 0
+    failed: int = 0
+    bytes: int = 0
+    urls_rewritten: int = 0
+    errors: List[str] = field(default_factory=list)
+    started_at: float = field(default_factory=time.monotonic)
+
+    def as_dict(self) -> dict:
+        elapsed = max(time.monotonic() - self.started_at, 1e-6)
+        return {
+            "copied": self.copied,
+            "skipped": self.skipped,
+            "failed": self.failed,
+            "bytes": self.bytes,
+            "urls_rewritten": self.urls_rewritten,
+            "seconds": round(elapsed, 2),
+            "mb_per_s": round(self.bytes / elapsed / 1024 / 1024, 2),
+            "objects_per_s": round((self.copied + self.skipped) / elapsed, 1),
+        }
+
+
+class StorageMigration:
+    """
+    本地 <-> bucket 搬移
+
+    Args:
+        base_dir: 專案根目錄（包含 input/、result/、sessions/）
+        bucket: google.cloud.storage.Bucket 或 DirectoryBucket
+        direction: "to-gcs" / "to-local"
+        base_url: 本地模式的 BASE_URL（改寫 URL 用）
+        folders: 要搬移的本地目錄（預設全部）
+        workers: 並行傳輸數
+        journal_path: 續傳記錄檔
+        index: session 索引（搬移 session 後更新儲存位置）
+        dry_run: 只列出要搬移的項目
+    """
+
+    def __init__(self, base_dir: Path, bucket, direction: str, base_url: str,
+                 folders: Optional[List[str]] = None, workers: int = 8,
+                 journal_path: Optional[Path] = None,
+                 index: Optional[session_index.SessionIndex] = None,
+                 dry_run: bool = False, progress: Optional[Callable[[MigrationStats], None]] = None):
+        if direction not in DIRECTIONS:
+            raise ValueError(f"direction must be one of {DIRECTIONS}")
+        self.base_dir = Path(base_dir)
+        self.bucket = bucket
+        self.direction = direction
+        self.base_url = base_url
+        self.folders = folders or list(FOLDERS)
+        self.workers = max(1, workers)
+        self.journal = Journal(journal_path)
+        self.index = index
+        self.dry_run = dry_run
+        self.progress = progress
+        self.stats = MigrationStats()
+        self._stats_lock = threading.Lock()
+
+    # -- 列出項目 --
+
+    def _local_tasks(self) -> Iterator[Task]:
+        for kind in self.folders:
+            folder = self.base_dir / kind
+            if not folder.is_dir():
+                continue
+            pattern = "*.json" if kind == "sessions" else "*"
+            for path in sorted(folder.rglob(pattern)):
+                if not path.is_file() or path.name.startswith("."):
+                    continue
+                if kind == "sessions":
+                    relpath = session_index.session_relpath(path.stem)
+                    local_path = folder / relpath
+                    if path != local_path and local_path.exists():
+                        continue  # 舊的平面路徑，分片路徑已有較新的版本
+                else:
+                    relpath = path.relative_to(folder).as_posix()
+                    local_path = path
+                yield Task(kind, f"{FOLDERS[kind]}/{relpath}", local_path, source_path=path)
+
+    def _remote_tasks(self) -> Iterator[Task]:
+        for kind in self.folders:
+            prefix = FOLDERS[kind] + "/"
+            blobs = [b for b in self.bucket.list_blobs(prefix=prefix) if not b.name.endswith("/")]
+            names = {b.name for b in blobs}
+            for blob in blobs:
+                name = blob.name[len(prefix):]
+                if kind == "sessions":
+                    if not name.endswith(".json"):
+                        continue
+                    name = session_index.session_relpath(Path(name).stem)
+                    if blob.name != prefix + name and prefix + name in names:
+                        continue  # 舊的平面路徑，分片路徑已有較新的版本
+                yield Task(kind, blob.name, self.base_dir / kind / name, remote=blob)
+
+    def _remote_inventory(self) -> Dict[str, object]:
+        """目的地 bucket 的現有物件（每個 prefix 一次 list，不需要逐一查詢）"""
+        inventory = {}
+        for kind in self.folders:
+            for blob in self.bucket.list_blobs(prefix=FOLDERS[kind] + "/"):
+                inventory[blob.name] = blob
+        return inventory
+
+    # -- 單一項目 --
+
+    def _session_bytes(self, data: bytes) -> Tuple[bytes, int]:
+        session = json.loads(data)
+        changed = rewrite_session(session, self.direction, self.bucket.name, self.base_url)
+        if not changed:
+            return data, 0
+        return json.dumps(session, indent=2, ensure_ascii=False).encode("utf-8"), changed
+
+    def _upload(self, task: Task, existing) -> Tuple[str, int, int]:
+        """上傳一個項目，回傳 (狀態, bytes, 改寫的 URL 數)"""
+        stat = task.source_path.stat()
+        if self.journal.done(task.key, stat.st_size, stat.st_mtime):
+            return "skipped", 0, 0
+
+        changed = 0
+        if task.kind == "sessions":
+            data, changed = self._session_bytes(task.source_path.read_bytes())
+            crc, md5 = checksums_of_bytes(data)
+        else:
+            data = None
+            crc, md5 = checksums_of_file(task.source_path)
+
+        if existing is not None and checksums_match(crc, md5, existing.crc32c, existing.md5_hash):
+            status, size = "skipped", 0
+        else:
+            if self.dry_run:
+                return "copied", stat.st_size, changed
+            blob = self.bucket.blob(task.key)
+            content_type = output_encoding.content_type_for(task.key, "image/jpeg")
+            if task.kind == "result":
+                blob.cache_control = output_encoding.RESULT_CACHE_CONTROL
+            if data is not None:
+                blob.upload_from_string(data, content_type=content_type)
+            else:
+                blob.upload_from_filename(str(task.source_path), content_type=content_type)
+            blob.reload()
+            if not checksums_match(crc, md5, blob.crc32c, blob.md5_hash):
+                raise RuntimeError(f"checksum mismatch after upload: {task.key}")
+            status, size = "copied", len(data) if data is not None else stat.st_size
+
+        if task.kind == "sessions" and not self.dry_run:
+            self._finish_local_session(task, data)
+            stat = task.local_path.stat()
+        self.journal.record(task.key, stat.st_size, stat.st_mtime, crc, md5)
+        return status, size, changed
+
+    def _finish_local_session(self, task: Task, data: bytes):
+        """本地備份也使用改寫後的內容，並搬到分片路徑；更新索引"""
+        task.local_path.parent.mkdir(parents=True, exist_ok=True)
+        if task.source_path != task.local_path or task.local_path.read_bytes() != data:
+            tmp = task.local_path.with_suffix(".json.tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, task.local_path)
+            if task.source_path != task.local_path:
+                task.source_path.unlink(missing_ok=True)
+        self._update_index(task, data, "gcs")
+
+    def _download(self, task: Task) -> Tuple[str, int, int]:
+        blob = task.remote
+        size = blob.size or 0
+        stamp = blob.crc32c or blob.md5_hash
+        if self.journal.done(task.key, size, stamp) and task.local_path.exists():
+            return "skipped", 0, 0
+
+        changed = 0
+        if task.kind == "sessions":
+            raw = blob.download_as_bytes()
+            if not checksums_match(*checksums_of_bytes(raw), blob.crc32c, blob.md5_hash):
+                raise RuntimeError(f"checksum mismatch after download: {task.key}")
+            data, changed = self._session_bytes(raw)
+            if task.local_path.exists() and task.local_path.read_bytes() == data:
+                status = "skipped"
+            elif self.dry_run:
+                return "copied", len(data), changed
+            else:
+                task.local_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp = task.local_path.with_suffix(".json.tmp")
+                tmp.write_bytes(data)
+                os.replace(tmp, task.local_path)
+                status = "copied"
+            if not self.dry_run:
+                self._update_index(task, data, "local")
+        else:
+            if task.local_path.exists() and checksums_match(
+                    *checksums_of_file(task.local_path), blob.crc32c, blob.md5_hash):
+                status = "skipped"
+            elif self.dry_run:
+                return "copied", size, 0
+            else:
+                task.local_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp = task.local_path.with_name(task.local_path.name + ".downloading")
+                blob.download_to_filename(str(tmp))
+                if not checksums_match(*checksums_of_file(tmp), blob.crc32c, blob.md5_hash):
+                    tmp.unlink(missing_ok=True)
+                    raise RuntimeError(f"checksum mismatch after download: {task.key}")
+                os.replace(tmp, task.local_path)
+                status = "copied"
+
+        self.journal.record(task.key, size, stamp, blob.crc32c, blob.md5_hash)
+        return status, (size if status == "copied" else 0), changed
+
+    def _update_index(self, task: Task, data: bytes, location: str):
+        if self.index is None:
+            return
+        try:
+            self.index.upsert(task.local_path.stem, json.loads(data), location,
+                              session_index.session_relpath(task.local_path.stem))
+        except Exception as e:
+            print(f"⚠️  Session index update failed for {task.key}: {e}")
+
+    # -- 執行 --
+
+    def _record(self, task: Task, result: Optional[Tuple[str, int, int]], error: Optional[Exception]):
+        with self._stats_lock:
+            if error is not None:
+                self.stats.failed += 1
+                self.stats.errors.append(f"{task.key}: {error}")
+            else:
+                status, size, changed = result
+                if status == "copied":
+                    self.stats.copied += 1
+                else:
+                    self.stats.skipped += 1
+                self.stats.bytes += size
+                self.stats.urls_rewritten += changed
+            if self.progress:
+                self.progress(self.stats)
+
+    def run(self) -> MigrationStats:
+        """執行搬移（可重複執行，已完成的項目會略過）"""
+        if self.direction == "to-gcs":
+            inventory = self._remote_inventory()
+            tasks = self._local_tasks()
+
+            def work(task):
+                return self._upload(task, inventory.get(task.key))
+        else:
+            tasks = self._remote_tasks()
+            work = self._download
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(work, task): task for task in tasks}
+            for future in as_completed(futures):
+                task = futures[future]
+                try:
+                    self._record(task, future.result(), None)
+                except Exception as e:
+                    self._record(task, None, e)
+
+        return self.stats
@@ -0,0 +1,32 @@
+import importlib.util
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+# 模組都放在專案根目錄（與 app.py 同層）
+sys.path.insert(0, str(ROOT_DIR))
+
+
+@pytest.fixture(scope="session")
+def app_module(tmp_path_factory):
+    """
+    以 stub backend 載入 app
+
+    app.py 複製到暫存目錄再載入，input/、result/、sessions/ 與 cache/ 都建在暫存目錄，
+    不會寫進專案目錄；static/ 以 symlink 共用
+    """
+    base = tmp_path_factory.mktemp("app")
+    shutil.copy(ROOT_DIR / "app.py", base / "app.py")
+    (base / "static").symlink_to(ROOT_DIR / "static")
+    os.environ.update(GEMINI_BACKEND="stub", BASE_URL="http://testserver", USE_GCS="false")
+
+    spec = importlib.util.spec_from_file_location("app", base / "app.py")
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["app"] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,92 @@
+"""
+家具目錄：搜尋順序、atlas 產生、版本號，以及多個 worker 同時產生
+"""
+
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+import catalog
+
+
+def _item(item_dir, name, size=(40, 30), box=None):
+    img = Image.new("RGBA", size, (0, 0, 0, 0))
+    img.paste((200, 100, 50, 255), box or (5, 5, size[0] - 5, size[1] - 5))
+    img.save(item_dir / name)
+
+
+def test_discover_items_uses_natural_order(tmp_path):
+    for name in ("item10.png", "item2.png", "item1.png", "other.png"):
+        _item(tmp_path, name)
+
+    assert [p.name for p in catalog.discover_items(tmp_path)] == ["item1.png", "item2.png", "item10.png"]
+
+
+def test_build_atlas_places_trimmed_sprites(tmp_path):
+    for index in range(1, 6):
+        _item(tmp_path, f"item{index}.png", size=(60, 40), box=(10, 8, 50, 30))
+    paths = catalog.discover_items(tmp_path)
+
+    index = catalog.build_atlas(paths, tmp_path / "atlas.webp", cell_size=32)
+
+    assert (index["columns"], index["width"], index["height"]) == (3, 96, 64)
+    assert [item["id"] for item in index["items"]] == [f"item{i}" for i in range(1, 6)]
+    assert index["items"][4]["x"] == 32 and index["items"][4]["y"] == 32
+    assert index["items"][0]["bbox"] == [10, 8, 50, 30]
+    assert index["items"][0]["width"] == 60
+    with Image.open(tmp_path / "atlas.webp") as atlas:
+        assert atlas.size == (96, 64)
+    assert [p.name for p in tmp_path.iterdir() if p.name.endswith(".tmp")] == []
+
+
+def test_version_changes_when_an_item_changes(tmp_path):
+    _item(tmp_path, "item1.png")
+    paths = catalog.discover_items(tmp_path)
+    version = catalog.catalog_version(paths)
+
+    assert catalog.catalog_version(paths) == version
+    assert catalog.catalog_version(paths, cell_size=64) != version
+    os.utime(paths[0], ns=(1, 1))
+    assert catalog.catalog_version(paths) != version
+    _item(tmp_path, "item2.png")
+    assert catalog.catalog_version(catalog.discover_items(tmp_path)) != catalog.catalog_version(paths)
+
+
+def test_load_reuses_index_and_prunes_old_versions(tmp_path):
+    item_dir, cache_dir = tmp_path / "img", tmp_path / "cache"
+    item_dir.mkdir()
+    _item(item_dir, "item1.png")
+    first = catalog.FurnitureCatalog(item_dir, cache_dir).load()
+
+    assert first["count"] == 1
+    with open(cache_dir / f"index-{first['version']}.json") as f:
+        assert json.load(f) == first
+
+    _item(item_dir, "item2.png")
+    second = catalog.FurnitureCatalog(item_dir, cache_dir).load()
+    assert second["count"] == 2 and second["version"] != first["version"]
+    assert sorted(p.name for p in cache_dir.iterdir()) == [
+        f"atlas-{second['version']}.webp", f"index-{second['version']}.json"
+    ]
+
+
+def _load_in_worker(item_dir, cache_dir):
+    return catalog.FurnitureCatalog(item_dir, cache_dir).load()
+
+
+def test_concurrent_workers_build_one_consistent_catalog(tmp_path):
+    item_dir, cache_dir = tmp_path / "img", tmp_path / "cache"
+    item_dir.mkdir()
+    for index in range(1, 9):
+        _item(item_dir, f"item{index}.png")
+
+    # 與 /_ah/warmup 一樣，多個 worker process 同時產生同一版本
+    with ProcessPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(_load_in_worker, [item_dir] * 4, [cache_dir] * 4))
+
+    assert len({r["version"] for r in results}) == 1
+    with Image.open(cache_dir / f"atlas-{results[0]['version']}.webp") as atlas:
+        atlas.load()
+    assert [p.name for p in cache_dir.iterdir() if p.name.endswith(".tmp")] == []
@@ -0,0 +1,90 @@
+"""
+伺服器端合成：擺放驗證、負座標與畫布外的擺放、不合法的家具 id
+"""
+
+import io
+import math
+
+import pytest
+from PIL import Image
+
+import composer
+
+BLUE = (0, 0, 255)
+
+
+@pytest.fixture
+def item_dir(tmp_path):
+    item_dir = tmp_path / "img"
+    item_dir.mkdir()
+    Image.new("RGBA", (64, 64), BLUE + (255,)).save(item_dir / "item1.png")
+    Image.new("RGBA", (64, 64), BLUE + (255,)).save(tmp_path / "secret.png")
+    return item_dir
+
+
+def _base():
+    buffer = io.BytesIO()
+    Image.new("RGB", composer.CANVAS_SIZE, "white").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _compose(item_dir, placements):
+    with Image.open(io.BytesIO(composer.compose_scene(_base(), item_dir, placements))) as img:
+        return img.convert("RGB")
+
+
+def test_validate_placements_clamps_size():
+    placements = [
+        {"id": "item1", "x": 10, "y": 20.5},
+        {"id": 3, "x": -5, "y": 0, "size": 10 ** 9},
+        {"x": 0, "y": 0, "size": -7.9},
+    ]
+
+    assert composer.validate_placements(placements) == [
+        {"id": "item1", "x": 10, "y": 20.5, "size": None},
+        {"id": "3", "x": -5, "y": 0, "size": composer.MAX_ITEM_SIZE},
+        {"id": "", "x": 0, "y": 0, "size": 1},
+    ]
+    assert composer.validate_placements([]) == []
+
+
+@pytest.mark.parametrize("placements", [
+    {"id": "item1", "x": 1, "y": 2},
+    ["item1"],
+    [{"id": "item1", "x": "1", "y": 2}],
+    [{"id": "item1", "x": 1}],
+    [{"id": "item1", "x": True, "y": 2}],
+    [{"id": "item1", "x": math.nan, "y": 2}],
+    [{"id": "item1", "x": 1, "y": math.inf}],
+    [{"id": "item1", "x": 1, "y": 2, "size": "big"}],
+])
+def test_validate_placements_rejects_invalid_input(placements):
+    with pytest.raises(ValueError):
+        composer.validate_placements(placements)
+
+
+def test_negative_placements_are_drawn_partially(item_dir):
+    out = _compose(item_dir, composer.validate_placements([
+        {"id": "item1", "x": -20, "y": 500, "size": 100},  # 圖片一半在畫布左邊外
+        {"id": "item1", "x": 600, "y": 10, "size": 100},   # 上方：圖片在畫布上面外，只看得到箭頭
+    ]))
+
+    assert out.getpixel((0, 380)) == BLUE
+    assert out.getpixel((40, 380)) == (255, 255, 255)
+    red, green, blue = out.getpixel((600, 5))
+    assert red > 200 and green < 80 and blue < 80
+
+
+@pytest.mark.parametrize("x, y", [(-5000, 400), (600, 10 ** 5), (1e12, 1e12), (-1e300, 500)])
+def test_off_canvas_placements_are_skipped(item_dir, x, y):
+    out = _compose(item_dir, composer.validate_placements([{"id": "item1", "x": x, "y": y, "size": 600}]))
+
+    assert out.getcolors() == [(composer.CANVAS_SIZE[0] * composer.CANVAS_SIZE[1], (255, 255, 255))]
+
+
+@pytest.mark.parametrize("item_id", ["", "missing", "../secret", "item1.png", "item1/..", "item 1"])
+def test_invalid_item_ids_are_skipped(item_dir, item_id):
+    assert composer.load_item_image(item_dir, item_id) is None
+    out = _compose(item_dir, [{"id": item_id, "x": 600, "y": 400, "size": 100}])
+
+    assert len(out.getcolors()) == 1
@@ -0,0 +1,166 @@
+"""
+context cache 的生命週期：經由 GeminiRouter + stub backend + FakeCacheService
+"""
+
+from types import SimpleNamespace
+
+import pytest
+from google.genai import types
+
+import context_cache
+import gemini_router
+
+PREAMBLE = context_cache.KNOWN_INSTRUCTIONS[0]
+BASE = b"\x89PNG\r\n\x1a\nbase-image"
+NEXT = b"\x89PNG\r\n\x1a\nnext-image"
+
+
+class Clock:
+    """可手動前進的時間（同時取代 monotonic 與 time）"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(context_cache, "time", SimpleNamespace(monotonic=clock, time=clock))
+    monkeypatch.setattr(context_cache.FAKE_CACHES, "clock", clock)
+    return clock
+
+
+@pytest.fixture
+def manager(clock):
+    manager = context_cache.ContextCacheManager(ttl=120, enabled=True)
+    yield manager
+    manager.shutdown()
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """記錄 stub 收到的每個請求 (contents, config)"""
+    requests = []
+    original = gemini_router.stub_generate_content_stream
+
+    def recording(contents, config=None):
+        requests.append((contents, config))
+        return original(contents, config)
+
+    monkeypatch.setattr(gemini_router, "stub_generate_content_stream", recording)
+    return requests
+
+
+@pytest.fixture
+def router():
+    return gemini_router.GeminiRouter([gemini_router.Backend(name="stub", stub=True)])
+
+
+def _config():
+    return types.GenerateContentConfig(response_modalities=["IMAGE"])
+
+
+def _contents(image: bytes, prompt: str):
+    return [types.Content(role="user", parts=[
+        types.Part.from_bytes(data=image, mime_type="image/png"),
+        types.Part.from_text(text=prompt),
+    ])]
+
+
+def _generate(router, manager, image: bytes, text: str = "add a plant"):
+    prompt = PREAMBLE + text
+    context = manager.context("sess1", image, build=lambda data: (data, "image/png"),
+                              variant="final", prompt=prompt)
+    chunks = list(router.generate_content_stream(_contents(image, prompt), _config(), context=context))
+    return chunks[0].candidates[0].content.parts[0].inline_data.data
+
+
+def _wait(manager):
+    """等背景的更新 / 刪除做完"""
+    manager._executor.submit(lambda: None).result()
+
+
+def test_split_instructions():
+    assert context_cache.split_instructions(PREAMBLE + "add a plant \n") == (PREAMBLE.strip(), "add a plant")
+    assert context_cache.split_instructions(PREAMBLE) == (None, PREAMBLE)
+    assert context_cache.split_instructions("just text") == (None, "just text")
+
+
+def test_first_use_creates_cache_and_sends_text_only(router, manager, sent):
+    assert _generate(router, manager, BASE) == BASE
+
+    assert manager.stats()["created"] == 1
+    contents, config = sent[-1]
+    assert config.cached_content.startswith("cachedContents/fake-")
+    parts = contents[0].parts
+    assert [p.text for p in parts] == ["add a plant"]
+    cache = context_cache.FAKE_CACHES.get(config.cached_content)
+    assert cache.system_instruction == PREAMBLE.strip()
+
+
+def test_same_base_hits_cache(router, manager, sent):
+    _generate(router, manager, BASE)
+    first = sent[-1][1].cached_content
+    assert _generate(router, manager, BASE, "make it blue") == BASE
+
+    stats = manager.stats()
+    assert stats["created"] == 1
+    assert stats["hits"] == 1
+    assert sent[-1][1].cached_content == first
+
+
+def test_advance_swaps_base_in_background(router, manager, sent):
+    _generate(router, manager, BASE)
+    old = sent[-1][1].cached_content
+
+    manager.advance("sess1", NEXT)
+    _wait(manager)
+    assert manager.stats()["refreshed"] == 1
+    _wait(manager)
+    with pytest.raises(context_cache.CacheNotFound):
+        context_cache.FAKE_CACHES.get(old)
+
+    # 下一次編輯以新的底圖為輸入：直接命中更新後的 cache
+    assert _generate(router, manager, NEXT) == NEXT
+    assert manager.stats()["hits"] == 1
+    assert sent[-1][1].cached_content != old
+
+
+def test_expired_entry_is_recreated(router, manager, clock, sent):
+    _generate(router, manager, BASE)
+    old = sent[-1][1].cached_content
+
+    clock.now += manager.ttl
+    assert _generate(router, manager, BASE) == BASE
+
+    stats = manager.stats()
+    assert stats["expired"] == 1
+    assert stats["created"] == 2
+    assert sent[-1][1].cached_content != old
+
+
+def test_missing_remote_cache_falls_back_to_full_contents(router, manager, sent):
+    _generate(router, manager, BASE)
+    name = sent[-1][1].cached_content
+    # 遠端的 cache 已經不在（例如被刪除）：stub 與真實 API 一樣回傳 404
+    context_cache.FAKE_CACHES.delete(name)
+
+    assert _generate(router, manager, BASE) == BASE
+
+    # 先用 cache 失敗，再以完整內容（圖片 + 完整 prompt）重試同一個 backend
+    assert sent[-2][1].cached_content == name
+    contents, config = sent[-1]
+    assert config.cached_content is None
+    assert contents[0].parts[0].inline_data.data == BASE
+    assert contents[0].parts[1].text == PREAMBLE + "add a plant"
+    assert manager.stats()["invalidated"] == 1
+    assert router.backends[0].total_errors == 0
+
+
+def test_disabled_manager_gives_no_context(clock):
+    manager = context_cache.ContextCacheManager(enabled=False)
+    assert manager.context("sess1", BASE, build=lambda d: (d, "image/png"), variant="final", prompt="x") is None
+    manager.shutdown()
@@ -0,0 +1,99 @@
+"""
+/api/edit/batch：NDJSON 依完成順序送出，session history 依項目順序寫入；
+client 中途斷線時，項目仍會寫入 history
+"""
+
+import asyncio
+import json
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+STARTERS = ["space", "moon", "mars"]
+
+
+@pytest.fixture
+def slow_first_item(app_module, monkeypatch):
+    """第一個項目 (space) 等其他項目都完成後才完成；記錄每次呼叫的參數"""
+    calls = []
+    others_done = threading.Semaphore(0)
+    generate = app_module.generate_nano_banana
+
+    def delayed(**kwargs):
+        calls.append(kwargs)
+        if kwargs["image_path"].endswith("space.png"):
+            for _ in STARTERS[1:]:
+                others_done.acquire(timeout=10)
+            return generate(**kwargs)
+        try:
+            return generate(**kwargs)
+        finally:
+            others_done.release()
+
+    monkeypatch.setattr(app_module, "generate_nano_banana", delayed)
+    return calls
+
+
+def _new_session(client):
+    session = client.post("/api/session/generate").json()
+    return session["session_id"], session["secret"]
+
+
+def test_stream_follows_completion_and_history_follows_index(app_module, slow_first_item):
+    client = TestClient(app_module.app)
+    session_id, secret = _new_session(client)
+
+    response = client.post("/api/edit/batch", data={
+        "session_id": session_id, "secret": secret, "prompts": ["add a lamp"], "starters": STARTERS,
+    })
+
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines[-1] == {"done": True, "count": 3}
+    items = lines[:-1]
+    assert sorted(item["index"] for item in items) == [0, 1, 2]
+    assert items[-1]["index"] == 0  # 最慢的項目最後送出
+    by_index = {item["index"]: item["image_urls"][0] for item in items}
+
+    history = app_module.read_session(session_id)["history"]
+    assert history == [by_index[0], by_index[1], by_index[2]]
+
+
+def test_history_is_written_after_client_disconnects(app_module, slow_first_item):
+    client = TestClient(app_module.app)
+    session_id, secret = _new_session(client)
+
+    async def disconnect_after_first_line():
+        response = await app_module.edit_image_batch(
+            session_id=session_id, secret=secret, prompts=["add a lamp"],
+            files=None, starters=STARTERS, profile="final"
+        )
+        stream = response.body_iterator
+        first = json.loads(await stream.__anext__())
+        await stream.aclose()  # client 斷線
+        await asyncio.gather(*app_module.batch_history_writers)
+        return first
+
+    first = asyncio.run(disconnect_after_first_line())
+
+    history = app_module.read_session(session_id)["history"]
+    assert len(history) == 3
+    assert first["image_urls"][0] in history
+
+
+def test_single_image_batch_does_not_use_session_context_cache(app_module, monkeypatch):
+    calls = []
+    generate = app_module.generate_nano_banana
+    monkeypatch.setattr(app_module, "generate_nano_banana", lambda **kw: calls.append(kw) or generate(**kw))
+    client = TestClient(app_module.app)
+    session_id, secret = _new_session(client)
+
+    response = client.post("/api/edit/batch", data={
+        "session_id": session_id, "secret": secret, "prompts": ["add a lamp", "add a rug"], "starters": ["moon"],
+    })
+
+    assert response.status_code == 200
+    assert len(calls) == 2
+    # 起始場景不是 session 的底圖，不使用 session 的 context cache
+    assert all(call.get("context_session") is None for call in calls)
@@ -0,0 +1,172 @@
+"""
+GeminiRouter：backend 選擇、429 冷卻與換 backend 重試
+"""
+
+from types import SimpleNamespace
+
+import pytest
+from google.genai import errors
+
+import gemini_router
+from gemini_router import Backend, GeminiRouter, NoBackendAvailable, is_rate_limit_error
+
+
+def _rate_limited():
+    return errors.ClientError(429, {"error": {"code": 429, "message": "quota", "status": "RESOURCE_EXHAUSTED"}})
+
+
+def _server_error():
+    return errors.ServerError(500, {"error": {"code": 500, "message": "internal", "status": "INTERNAL"}})
+
+
+def _backend(name, calls, error=None, fail_after_chunk=False, **kwargs):
+    """不連網路的 backend：呼叫記錄在 calls，可指定要丟出的錯誤"""
+    def generate_content_stream(model, contents, config):
+        calls.append((name, model))
+        if error is not None and not fail_after_chunk:
+            raise error
+        yield SimpleNamespace(text=name, candidates=[])
+        if error is not None:
+            raise error
+
+    client = SimpleNamespace(models=SimpleNamespace(generate_content_stream=generate_content_stream))
+    return Backend(name=name, _client=client, **kwargs)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(gemini_router, "time", SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+def test_is_rate_limit_error():
+    assert is_rate_limit_error(_rate_limited())
+    assert is_rate_limit_error(SimpleNamespace(status_code=429))
+    assert is_rate_limit_error(Exception("RESOURCE_EXHAUSTED: quota exceeded"))
+    assert not is_rate_limit_error(_server_error())
+    # 訊息中剛好出現 429 的數字不是限流
+    assert not is_rate_limit_error(Exception("blob 4f2a-429b-8c1e not found"))
+    assert not is_rate_limit_error(ValueError("image is 14290 bytes, too large"))
+
+
+def test_pick_prefers_lowest_load_per_weight():
+    light = Backend(name="light", weight=1.0, inflight=1)
+    heavy = Backend(name="heavy", weight=3.0, inflight=2)
+    router = GeminiRouter([light, heavy])
+
+    assert router.pick() is heavy
+    assert router.pick(exclude={"heavy"}) is light
+
+
+def test_pick_uses_fallback_only_when_primaries_unavailable(clock):
+    primary = Backend(name="primary")
+    fallback = Backend(name="fallback", fallback=True)
+    router = GeminiRouter([primary, fallback])
+
+    assert router.pick() is primary
+    router.report_error(primary, _rate_limited())
+    assert router.pick() is fallback
+
+    router.report_error(fallback, _rate_limited())
+    with pytest.raises(NoBackendAvailable):
+        router.pick()
+
+
+def test_cooldown_only_after_rate_limit(clock):
+    backend = Backend(name="a")
+    router = GeminiRouter([backend])
+
+    router.report_error(backend, _server_error())
+    assert backend.healthy(clock.now)
+    assert backend.total_errors == 1
+
+    router.report_error(backend, _rate_limited())
+    assert not backend.healthy(clock.now)
+    assert len(backend.recent_429s) == 1
+
+    clock.now += gemini_router.COOLDOWN_SECONDS
+    assert backend.healthy(clock.now)
+    # 冷卻結束後，429 仍在統計時間窗內時計入負載
+    assert router.pick() is backend
+    assert backend.load() == 1
+
+    clock.now += gemini_router.RATE_LIMIT_WINDOW
+    router.pick()
+    assert backend.load() == 0
+
+
+def test_rate_limit_fails_over_to_next_backend(clock):
+    calls = []
+    first = _backend("first", calls, error=_rate_limited(), weight=2.0)
+    second = _backend("second", calls)
+    router = GeminiRouter([first, second])
+
+    chunks = list(router.generate_content_stream(contents=[], config=None))
+
+    assert [c.text for c in chunks] == ["second"]
+    assert [name for name, _ in calls] == ["first", "second"]
+    assert not first.healthy(clock.now)
+    assert (first.inflight, second.inflight) == (0, 0)
+    assert router.pick() is second
+
+
+def test_fallback_backend_uses_its_own_model(clock):
+    calls = []
+    primary = _backend("primary", calls, error=_rate_limited(), model="main-model")
+    fallback = _backend("fallback", calls, fallback=True, model="backup-model")
+    router = GeminiRouter([primary, fallback])
+
+    list(router.generate_content_stream(contents=[], config=None, model="requested-model"))
+
+    assert calls == [("primary", "requested-model"), ("fallback", "backup-model")]
+
+
+def test_other_errors_do_not_fail_over(clock):
+    calls = []
+    first = _backend("first", calls, error=_server_error(), weight=2.0)
+    second = _backend("second", calls)
+    router = GeminiRouter([first, second])
+
+    with pytest.raises(errors.ServerError):
+        list(router.generate_content_stream(contents=[], config=None))
+
+    assert [name for name, _ in calls] == ["first"]
+    assert first.healthy(clock.now)
+    assert first.inflight == 0
+
+
+def test_rate_limit_after_first_chunk_is_not_retried(clock):
+    calls = []
+    first = _backend("first", calls, error=_rate_limited(), fail_after_chunk=True, weight=2.0)
+    second = _backend("second", calls)
+    router = GeminiRouter([first, second])
+
+    received = []
+    with pytest.raises(errors.ClientError):
+        for chunk in router.generate_content_stream(contents=[], config=None):
+            received.append(chunk.text)
+
+    # 已經送出部分結果，不能換 backend 重來
+    assert received == ["first"]
+    assert [name for name, _ in calls] == ["first"]
+    assert not first.healthy(clock.now)
+
+
+def test_all_backends_rate_limited_raises_last_error(clock):
+    calls = []
+    router = GeminiRouter([
+        _backend("a", calls, error=_rate_limited()),
+        _backend("b", calls, error=_rate_limited()),
+    ])
+
+    with pytest.raises(errors.ClientError):
+        list(router.generate_content_stream(contents=[], config=None))
+    assert sorted(name for name, _ in calls) == ["a", "b"]
+
+
+def test_stub_backend_from_env(monkeypatch):
+    monkeypatch.setenv("GEMINI_BACKEND", "stub")
+    router = gemini_router.build_router_from_env()
+
+    assert [b.stub for b in router.backends] == [True]
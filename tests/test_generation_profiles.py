@@ -0,0 +1,108 @@
+"""
+生成設定檔：設定檔選擇、輸入圖準備（比例、縮圖）與各設定檔的指標
+"""
+
+import io
+import threading
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+
+import generation_profiles
+from generation_profiles import PROFILES, ProfileMetrics
+
+
+def _image(size, format="PNG", mode="RGB"):
+    buffer = io.BytesIO()
+    Image.new(mode, size, "white").save(buffer, format=format)
+    return buffer.getvalue()
+
+
+def test_resolve_profile_order():
+    assert generation_profiles.resolve_profile("draft", "classic") is PROFILES["draft"]
+    assert generation_profiles.resolve_profile(None, "classic") is PROFILES["classic"]
+    assert generation_profiles.resolve_profile("", None) is PROFILES[generation_profiles.DEFAULT_PROFILE]
+    assert generation_profiles.resolve_profile() is PROFILES[generation_profiles.DEFAULT_PROFILE]
+    with pytest.raises(KeyError):
+        generation_profiles.resolve_profile(None, "nope")
+
+
+@pytest.mark.parametrize("size, ratio", [
+    ((1184, 864), "4:3"),
+    ((864, 1184), "3:4"),
+    ((1000, 1000), "1:1"),
+    ((1920, 1080), "16:9"),
+    ((2520, 1080), "21:9"),
+    ((1000, 5000), "9:16"),
+])
+def test_closest_aspect_ratio(size, ratio):
+    assert generation_profiles.closest_aspect_ratio(*size) == ratio
+
+
+def test_prepare_input_keeps_small_images_untouched():
+    data = _image((1920, 1080))
+
+    assert generation_profiles.prepare_input(data, PROFILES["final"]) == (data, "image/png", "16:9")
+    assert generation_profiles.prepare_input(data, PROFILES["classic"]) == (data, "image/png", "4:3")
+    jpeg = _image((800, 600), format="JPEG")
+    assert generation_profiles.prepare_input(jpeg, PROFILES["draft"]) == (jpeg, "image/jpeg", "4:3")
+
+
+def test_prepare_input_downscales_for_draft():
+    data, mime_type, aspect_ratio = generation_profiles.prepare_input(
+        _image((2048, 1152), mode="RGBA"), PROFILES["draft"]
+    )
+
+    assert (mime_type, aspect_ratio) == ("image/jpeg", "16:9")  # 比例依原圖
+    with Image.open(io.BytesIO(data)) as img:
+        assert img.format == "JPEG" and img.size == (1024, 576)
+
+
+def test_profile_metrics():
+    metrics = ProfileMetrics()
+    for total in range(1, 101):
+        metrics.record("draft", float(total), total / 2, images=1,
+                       usage={"prompt_tokens": 100, "cached_tokens": None, "output_tokens": 10, "total_tokens": 110})
+    metrics.record("draft", 9999.0, None, images=0, error=True)
+    metrics.record("final", 50.0, None, images=0)
+
+    stats = metrics.stats()
+    assert stats["default"] == generation_profiles.DEFAULT_PROFILE
+    draft = stats["profiles"]["draft"]
+    assert (draft["requests"], draft["errors"], draft["images"]) == (101, 1, 100)
+    assert (draft["total_ms_p50"], draft["total_ms_p95"]) == (51.0, 95.0)  # 失敗的不算延遲
+    assert draft["first_image_ms_p50"] == 25.5
+    assert (draft["prompt_tokens_avg"], draft["cached_tokens_avg"], draft["output_tokens_avg"]) == (100.0, 0.0, 10.0)
+    assert draft["total_tokens"] == 11000
+    final = stats["profiles"]["final"]
+    assert final["first_image_ms_p50"] is None and final["prompt_tokens_avg"] is None
+
+
+def test_profile_metrics_keep_a_bounded_window_across_threads():
+    metrics = ProfileMetrics()
+
+    def worker():
+        for _ in range(generation_profiles.METRIC_SAMPLES):
+            metrics.record("final", 10.0, 5.0, images=2)
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    final = metrics.stats()["profiles"]["final"]
+    assert (final["requests"], final["images"]) == (4 * generation_profiles.METRIC_SAMPLES, 8 * generation_profiles.METRIC_SAMPLES)
+    assert len(metrics._profiles["final"].total_ms) == generation_profiles.METRIC_SAMPLES
+
+
+def test_usage_from_chunk():
+    usage = SimpleNamespace(prompt_token_count=12, cached_content_token_count=None,
+                            candidates_token_count=3, total_token_count=15)
+
+    assert generation_profiles.usage_from_chunk(SimpleNamespace(usage_metadata=usage)) == {
+        "prompt_tokens": 12, "cached_tokens": None, "output_tokens": 3, "total_tokens": 15,
+    }
+    assert generation_profiles.usage_from_chunk(SimpleNamespace(usage_metadata=None)) is None
+    assert generation_profiles.usage_from_chunk(object()) is None
@@ -0,0 +1,186 @@
+"""
+結構化 log：背景佇列寫入、抽樣、request id 與 RequestLogMiddleware
+"""
+
+import asyncio
+import io
+import json
+import threading
+from types import SimpleNamespace
+
+import pytest
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+
+import jsonlog
+from jsonlog import AsyncJsonLogger
+
+
+def _records(stream):
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_writer_thread_writes_json_lines():
+    stream = io.StringIO()
+    logger = AsyncJsonLogger(stream=stream, sampling={})
+
+    logger.log("first", path="/x", extra={"n": 1})
+    with jsonlog.request_context("req-1"):
+        logger.log("second", "hello", severity="WARNING", value=object())  # 不能 JSON 化的欄位用 str
+    logger.flush()
+
+    first, second = _records(stream)
+    assert (first["event"], first["message"], first["severity"]) == ("first", "first", "INFO")
+    assert first["extra"] == {"n": 1} and "request_id" not in first
+    assert (second["message"], second["severity"], second["request_id"]) == ("hello", "WARNING", "req-1")
+    assert second["value"].startswith("<object")
+    assert logger.stats() == {"queued": 0, "written": 2, "dropped": 0, "sampled_out": 0}
+
+
+def test_full_queue_drops_instead_of_blocking():
+    release = threading.Event()
+    writing = threading.Event()
+
+    class BlockedStream(io.StringIO):
+        def write(self, text):
+            writing.set()
+            release.wait(5)
+            return super().write(text)
+
+    stream = BlockedStream()
+    logger = AsyncJsonLogger(stream=stream, sampling={}, queue_size=2)
+    logger.log("e0")
+    assert writing.wait(5)  # 背景 thread 卡在寫入
+    for i in range(1, 6):
+        logger.log(f"e{i}")  # 不會阻塞
+
+    assert logger.dropped == 3
+    release.set()
+    logger.flush()
+    assert [r["event"] for r in _records(stream)] == ["e0", "e1", "e2"]
+
+
+def test_write_errors_are_counted():
+    class BrokenStream:
+        def write(self, text):
+            raise OSError("broken pipe")
+
+        def flush(self):
+            pass
+
+    logger = AsyncJsonLogger(stream=BrokenStream(), sampling={})
+    logger.log("lost")
+    logger.flush()
+
+    assert (logger.written, logger.dropped) == (0, 1)
+
+
+def test_parse_sampling():
+    rates = jsonlog.parse_sampling("gcs_save=0.5, custom=2,bad=x,noequals")
+
+    assert rates["gcs_save"] == 0.5
+    assert rates["custom"] == 1.0
+    assert "bad" not in rates and "noequals" not in rates
+    assert rates["session_verified"] == jsonlog.DEFAULT_SAMPLING["session_verified"]
+    assert jsonlog.parse_sampling(None) == jsonlog.DEFAULT_SAMPLING
+
+
+def test_sampling(monkeypatch):
+    stream = io.StringIO()
+    logger = AsyncJsonLogger(stream=stream, sampling={"noisy": 0.25, "muted": 0.0})
+    draws = iter([0.1, 0.9])
+    monkeypatch.setattr(jsonlog, "random", SimpleNamespace(random=lambda: next(draws)))
+
+    logger.log("noisy")  # 0.1 < 0.25：輸出
+    logger.log("noisy")  # 0.9：丟掉
+    logger.log("muted", sample=1.0)  # 呼叫端指定的比例優先
+    logger.log("muted", severity="ERROR")  # WARNING 以上一律輸出
+    logger.log("other")
+    logger.flush()
+
+    records = _records(stream)
+    assert [r["event"] for r in records] == ["noisy", "muted", "muted", "other"]
+    assert records[0]["sample_rate"] == 0.25 and "sample_rate" not in records[1]
+    assert logger.sampled_out == 1
+
+
+@pytest.fixture
+def captured(monkeypatch):
+    stream = io.StringIO()
+    logger = AsyncJsonLogger(stream=stream, sampling={}, project="proj")
+    monkeypatch.setattr(jsonlog, "logger", logger)
+
+    def records():
+        logger.flush()
+        return _records(stream)
+    return records
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.add_middleware(jsonlog.RequestLogMiddleware)
+
+    @app.get("/work")
+    async def work():
+        with jsonlog.stage("compute"):
+            await asyncio.to_thread(jsonlog.log, "worker_event")
+        jsonlog.record_stage("queue", 12.5)
+        return {"request_id": jsonlog.current_request_id()}
+
+    @app.get("/stream")
+    async def stream():
+        async def body():
+            yield b"a\n"
+            jsonlog.log("streaming")
+            yield b"b\n"
+        return StreamingResponse(body(), media_type="text/plain")
+
+    @app.get("/fail")
+    async def fail():
+        raise RuntimeError("boom")
+
+    @app.get("/static/app.js")
+    async def static():
+        return "ok"
+
+    return TestClient(app, raise_server_exceptions=False)
+
+
+def test_middleware_sets_request_id_and_logs_stages(client, captured):
+    response = client.get("/work", headers={"X-Request-ID": "client-id.1",
+                                            "X-Cloud-Trace-Context": "abc123/1;o=1"})
+
+    assert response.headers["x-request-id"] == "client-id.1"
+    assert response.json() == {"request_id": "client-id.1"}
+    worker, request = captured()
+    assert worker["event"] == "worker_event" and worker["request_id"] == "client-id.1"  # 帶進 to_thread
+    assert worker["logging.googleapis.com/trace"] == "projects/proj/traces/abc123"
+    assert (request["event"], request["status"], request["message"]) == ("request", 200, "GET /work 200")
+    assert set(request["stages"]) == {"compute_ms", "queue_ms"} and request["stages"]["queue_ms"] == 12.5
+
+
+def test_middleware_replaces_invalid_request_ids(client, captured):
+    response = client.get("/work", headers={"X-Request-ID": "bad id!" + "x" * 100})
+
+    request_id = response.headers["x-request-id"]
+    assert request_id != "bad id!" and len(request_id) == 16
+    assert captured()[-1]["request_id"] == request_id
+
+
+def test_middleware_logs_streams_errors_and_static(client, captured):
+    assert client.get("/stream").text == "a\nb\n"
+    assert client.get("/fail").status_code == 500
+    client.get("/static/app.js")
+
+    records = captured()
+    events = [(r["event"], r.get("status"), r["severity"]) for r in records]
+    # 串流送完才輸出 request log
+    assert events == [
+        ("streaming", None, "INFO"),
+        ("request", 200, "INFO"),
+        ("request", 500, "ERROR"),
+        ("static_request", 200, "INFO"),
+    ]
+    assert records[0]["request_id"] == records[1]["request_id"]
@@ -0,0 +1,94 @@
+"""
+區域編輯：解析與驗證、區域計算（4:3、邊界內）、裁切/貼回的往返
+"""
+
+import io
+import math
+
+import pytest
+from PIL import Image
+
+import region_edit
+
+WIDTH, HEIGHT = 1184, 864
+
+
+def _png(img):
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_parse_regions_accepts_lists_and_dicts():
+    regions = [[10, 20, 30, 40], {"x": 1.4, "y": 2.6, "width": 3, "height": 4}, {"x": 0, "y": 0, "w": 0, "h": 5}]
+
+    assert region_edit.parse_regions(regions) == [(10, 20, 40, 60), (1, 3, 4, 7)]  # 空的區域略過
+    assert region_edit.parse_regions(None) == []
+    assert region_edit.parse_regions([]) == []
+
+
+@pytest.mark.parametrize("regions", [
+    {"x": 1, "y": 2, "w": 3, "h": 4},
+    [[1, 2, 3]],
+    [{"x": 1, "y": 2, "w": 3}],
+    [[1, 2, "3", 4]],
+    [[1, 2, True, 4]],
+    [[1, 2, math.inf, 4]],
+    [[1, 2, math.nan, 4]],
+    ["1,2,3,4"],
+])
+def test_parse_regions_rejects_invalid_input(regions):
+    with pytest.raises(ValueError):
+        region_edit.parse_regions(regions)
+
+
+def test_region_bbox_is_4_3_and_clamped_to_the_image():
+    # 靠近右下角的小區域：擴展後仍在圖片內
+    bbox = region_edit.region_bbox([(1150, 840, 1184, 864)], WIDTH, HEIGHT)
+    left, top, right, bottom = bbox
+    assert (right, bottom) == (WIDTH, HEIGHT) and left >= 0 and top >= 0
+    assert (right - left) / (bottom - top) == pytest.approx(4 / 3, abs=0.01)
+    assert right - left >= region_edit.MIN_REGION_SIZE
+
+    # 超出左上角的區域：裁到圖片範圍
+    left, top, right, bottom = region_edit.region_bbox([(-200, -200, 100, 80)], WIDTH, HEIGHT)
+    assert (left, top) == (0, 0)
+
+    # 多個區域取聯集
+    union = region_edit.region_bbox([(100, 100, 150, 150), (400, 300, 450, 350)], WIDTH, HEIGHT)
+    assert union[0] <= 100 - region_edit.REGION_PADDING and union[2] >= 450 + region_edit.REGION_PADDING
+
+
+def test_region_bbox_falls_back_to_full_image():
+    assert region_edit.region_bbox([], WIDTH, HEIGHT) is None
+    assert region_edit.region_bbox([(2000, 2000, 2100, 2100)], WIDTH, HEIGHT) is None  # 完全在圖外
+    assert region_edit.region_bbox([(0, 0, 1000, 700)], WIDTH, HEIGHT) is None  # 區域太大
+
+
+def test_scale_bbox():
+    assert region_edit.scale_bbox((10, 20, 30, 40), (100, 100), (100, 100)) == (10, 20, 30, 40)
+    assert region_edit.scale_bbox((10, 20, 30, 40), (100, 100), (200, 50)) == (20, 10, 60, 20)
+
+
+def test_crop_and_blend_round_trip_keeps_the_base():
+    base = Image.effect_noise((WIDTH, HEIGHT), 50).convert("RGB")
+    base_bytes = _png(base)
+    bbox = region_edit.region_bbox([(500, 400, 560, 450)], WIDTH, HEIGHT)
+
+    crop = region_edit.crop_region(base_bytes, bbox)
+    assert region_edit.image_size(crop) == (bbox[2] - bbox[0], bbox[3] - bbox[1])
+
+    # 模型原封不動回傳（且解析度不同）：貼回後整張圖幾乎不變，區域外完全相同
+    with Image.open(io.BytesIO(crop)) as img:
+        resized = _png(img.resize((img.width // 2, img.height // 2), Image.Resampling.LANCZOS)
+                       .resize(img.size, Image.Resampling.LANCZOS))
+    blended = region_edit.blend_region(base_bytes, resized, bbox)
+
+    with Image.open(io.BytesIO(blended)) as img:
+        assert img.format == "PNG"
+        out = img.convert("RGB")
+    assert out.size == (WIDTH, HEIGHT)
+    outside = [(0, 0), (bbox[0] - 1, bbox[1]), (bbox[2], bbox[3] - 1), (WIDTH - 1, HEIGHT - 1)]
+    assert all(out.getpixel(xy) == base.getpixel(xy) for xy in outside)
+    # 羽化遮罩：區域邊緣以底圖為主
+    assert out.getpixel((bbox[0], bbox[1])) == base.getpixel((bbox[0], bbox[1]))
@@ -0,0 +1,45 @@
+"""
+Region mode：貼回後的結果以 PNG 輸出，區域外的像素與底圖完全相同
+"""
+
+import io
+
+from PIL import Image
+
+import output_encoding
+import region_edit
+
+
+def _png(color, size=(200, 150)):
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def test_region_result_stays_png_and_keeps_untouched_pixels():
+    base = Image.effect_noise((200, 150), 64).convert("RGB")
+    buffer = io.BytesIO()
+    base.save(buffer, format="PNG")
+    bbox = (50, 40, 150, 110)
+    edited = _png((255, 0, 0), size=(100, 70))
+
+    blended = region_edit.blend_region(buffer.getvalue(), edited, bbox)
+    result = output_encoding.OutputEncoder("jpeg").encode(blended, lossless=True)
+
+    assert result.format == "png" and not result.reencoded
+    with Image.open(io.BytesIO(result.data)) as img:
+        out = img.convert("RGB")
+    for xy in [(0, 0), (10, 140), (199, 149), (40, 75), (160, 20)]:
+        assert out.getpixel(xy) == base.getpixel(xy)
+    r, g, b = out.getpixel((100, 75))
+    assert r > 240 and g < 30 and b < 30
+
+
+def test_non_region_result_is_still_reencoded():
+    noisy = Image.effect_noise((200, 150), 64).convert("RGB")
+    buffer = io.BytesIO()
+    noisy.save(buffer, format="PNG")
+
+    result = output_encoding.OutputEncoder("jpeg").encode(buffer.getvalue())
+
+    assert result.format == "jpeg" and result.reencoded
@@ -0,0 +1,168 @@
+"""
+RetentionManager：依時間/容量刪除、保護被引用的結果、掃描與重新掃描的合併，
+以及其他 worker 經由 session 索引加入的引用
+"""
+
+import json
+import os
+import time
+
+import retention
+import session_index
+from retention import RetentionManager, RetentionPolicy
+
+DAY = 86400
+
+
+def _file(directory, name, age_days=0.0, size=10):
+    path = directory / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"x" * size)
+    mtime = time.time() - age_days * DAY
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def _sweep(manager, steps=10):
+    for _ in range(steps):
+        manager.step()
+
+
+def _names(directory):
+    return sorted(p.name for p in directory.iterdir() if not p.name.startswith("."))
+
+
+def _result_policies(tmp_path, **result):
+    result_dir, sessions_dir = tmp_path / "result", tmp_path / "sessions"
+    result_dir.mkdir()
+    sessions_dir.mkdir()
+    return result_dir, sessions_dir, [
+        RetentionPolicy("result", result_dir, protect_referenced=True, **result),
+        RetentionPolicy("sessions", sessions_dir),
+    ]
+
+
+def test_age_eviction(tmp_path):
+    input_dir = tmp_path / "input"
+    for name, age in (("old.png", 5), ("older.png", 9), ("new.png", 1)):
+        _file(input_dir, name, age)
+    manager = RetentionManager([RetentionPolicy("input", input_dir, max_age_days=3)])
+
+    _sweep(manager)
+
+    assert _names(input_dir) == ["new.png"]
+    assert manager.stats()["directories"]["input"]["deleted_files"] == 2
+
+
+def test_size_eviction_removes_oldest_first(tmp_path):
+    input_dir = tmp_path / "input"
+    for index in range(5):
+        _file(input_dir, f"{index}.png", age_days=5 - index, size=100)
+    manager = RetentionManager([RetentionPolicy("input", input_dir, max_bytes=250)])
+
+    _sweep(manager)
+
+    assert _names(input_dir) == ["3.png", "4.png"]
+    assert manager.inventories["input"].total_bytes == 200
+
+
+def test_referenced_results_are_protected(tmp_path):
+    result_dir, sessions_dir, policies = _result_policies(tmp_path, max_age_days=7)
+    _file(result_dir, "kept.png", 30)
+    _file(result_dir, "orphan.png", 30)
+    _file(result_dir, "recent.png", 1)
+    (sessions_dir / "ab").mkdir()
+    (sessions_dir / "ab" / "s1.json").write_text(json.dumps({
+        "history": ["http://localhost:8000/images/kept.png?v=1"]
+    }))
+    manager = RetentionManager(policies)
+
+    _sweep(manager)
+
+    assert _names(result_dir) == ["kept.png", "recent.png"]
+    assert manager.is_referenced("kept.png")
+
+
+def test_results_are_not_deleted_before_sessions_are_scanned(tmp_path):
+    result_dir, sessions_dir, policies = _result_policies(tmp_path, max_age_days=7)
+    _file(result_dir, "old.png", 30)
+    for index in range(3):
+        (sessions_dir / f"s{index}.json").write_text(json.dumps({"history": []}))
+    manager = RetentionManager(policies, batch_size=1)
+
+    manager.step()  # 只掃了 result，還沒有完整的引用表
+
+    assert not manager.references_ready
+    assert _names(result_dir) == ["old.png"]
+
+
+def test_deleting_a_session_releases_its_references(tmp_path):
+    result_dir, sessions_dir, policies = _result_policies(tmp_path, max_age_days=7)
+    policies[1] = RetentionPolicy("sessions", sessions_dir, max_age_days=7)
+    _file(result_dir, "a.png", 30)
+    _file(sessions_dir, "s1.json", 30).write_text(json.dumps({"history": ["/images/a.png"]}))
+    os.utime(sessions_dir / "s1.json", (time.time() - 30 * DAY,) * 2)
+    deleted = []
+    manager = RetentionManager(policies, on_delete=lambda policy, name: deleted.append((policy, name)))
+
+    _sweep(manager)
+
+    assert ("sessions", "s1.json") in deleted
+    assert not manager.is_referenced("a.png")
+    _sweep(manager)
+    assert _names(result_dir) == []
+
+
+def test_references_from_other_workers_reach_the_sweeper(tmp_path):
+    result_dir, _, policies = _result_policies(tmp_path, max_age_days=7)
+    index = session_index.SessionIndex(tmp_path / "sessions" / session_index.INDEX_FILENAME)
+    sweeper = RetentionManager(policies, reference_log=index)
+    other_worker = RetentionManager(policies, reference_log=index)
+    _sweep(sweeper)  # 引用表已建立
+
+    # 舊的結果剛被另一個 worker 加進某個 session 的 history（session 檔還沒被掃描到）
+    _file(result_dir, "reused.png", 30)
+    _file(result_dir, "orphan.png", 30)
+    sweeper.inventories["result"].add("reused.png", time.time() - 30 * DAY, 10)
+    sweeper.inventories["result"].add("orphan.png", time.time() - 30 * DAY, 10)
+    other_worker.add_references(["http://localhost:8000/images/reused.png"])
+
+    _sweep(sweeper)
+
+    assert _names(result_dir) == ["reused.png"]
+
+
+def test_rescan_keeps_recent_log_entries_and_prunes_old_ones(tmp_path):
+    result_dir, _, policies = _result_policies(tmp_path, max_age_days=7)
+    index = session_index.SessionIndex(tmp_path / "sessions" / session_index.INDEX_FILENAME)
+    index.add_references(["old.png"])
+    long_ago = time.time() - 2 * retention.REFERENCE_LOG_MARGIN
+    index._conn().execute("UPDATE image_references SET added_at = ?", (long_ago,))
+    index.add_references(["recent.png"])
+    manager = RetentionManager(policies, reference_log=index)
+
+    _sweep(manager)
+
+    # 最近的記錄在掃描後仍保護（session 檔可能還沒寫入），舊的記錄已清掉
+    assert manager.is_referenced("recent.png")
+    assert [name for _, name in index.references_since(0)] == ["recent.png"]
+
+
+def test_rescan_merges_files_tracked_during_the_scan(tmp_path):
+    input_dir = tmp_path / "input"
+    _file(input_dir, "a.png")
+    _file(input_dir, "b.png")
+    inventory = retention._Inventory(RetentionPolicy("input", input_dir, max_age_days=1))
+    inventory.add("a.png", time.time() - 10, 10)
+    inventory.add("gone.png", time.time() - 10, 10)  # 已被外部刪除
+    inventory.scanned_at = time.time() - 1
+    inventory.start_scan()
+
+    # 掃描期間寫入的新檔案（掃描看不到）
+    inventory.add("written-during-scan.png", time.time(), 7)
+    names, done = inventory.scan_step(100)
+
+    assert done and sorted(names) == ["a.png", "b.png"]
+    assert sorted(inventory.entries) == ["a.png", "b.png", "written-during-scan.png"]
+    assert inventory.total_bytes == 27
+    assert sorted(name for _, name in inventory.heap) == sorted(inventory.entries)
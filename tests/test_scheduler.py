@@ -0,0 +1,107 @@
+"""
+FairScheduler：併發上限、公平輪詢，以及取消後名額保留到 thread 結束
+"""
+
+import asyncio
+import threading
+
+from scheduler import FairScheduler
+
+
+def test_cancelled_request_holds_slot_until_thread_finishes():
+    async def scenario():
+        scheduler = FairScheduler(max_concurrency=1)
+        release = threading.Event()
+        started = threading.Event()
+        order = []
+
+        def slow():
+            started.set()
+            release.wait(5)
+            order.append("slow")
+
+        def fast():
+            order.append("fast")
+            return "ok"
+
+        first = asyncio.create_task(scheduler.run("a", slow))
+        await asyncio.to_thread(started.wait, 5)
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+
+        # 呼叫端已取消，但 thread 還在跑：名額不能給下一個請求
+        assert scheduler.inflight == 1
+        assert scheduler.stats()["orphaned"] == 1
+        second = asyncio.create_task(scheduler.run("b", fast))
+        await asyncio.sleep(0.05)
+        assert not second.done()
+        assert order == []
+
+        release.set()
+        result, timing = await asyncio.wait_for(second, 5)
+        assert result == "ok"
+        assert order == ["slow", "fast"]
+        assert scheduler.inflight == 0
+        assert scheduler.stats()["orphaned"] == 0
+        assert scheduler.idle()
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_while_queued_gives_up_its_place():
+    async def scenario():
+        scheduler = FairScheduler(max_concurrency=1)
+        release = threading.Event()
+
+        running = asyncio.create_task(scheduler.run("a", release.wait, 5))
+        await asyncio.sleep(0.01)
+        queued = asyncio.create_task(scheduler.run("b", lambda: "never"))
+        await asyncio.sleep(0.01)
+        queued.cancel()
+        await asyncio.gather(queued, return_exceptions=True)
+        assert scheduler.stats()["classes"]["interactive"]["queued"] == 0
+
+        release.set()
+        await running
+        assert scheduler.inflight == 0
+
+    asyncio.run(scenario())
+
+
+def test_sessions_take_turns_within_a_priority():
+    async def scenario():
+        scheduler = FairScheduler(max_concurrency=1)
+        release = threading.Event()
+        order = []
+
+        blocker = asyncio.create_task(scheduler.run("blocker", release.wait, 5))
+        await asyncio.sleep(0.01)
+        tasks = []
+        for session_id, label in (("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1")):
+            tasks.append(asyncio.create_task(scheduler.run(session_id, order.append, label)))
+            await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(blocker, *tasks)
+
+        # b 只排了一個請求，不用等 a 的三個都做完
+        assert order == ["a1", "b1", "a2", "a3"]
+
+    asyncio.run(scenario())
+
+
+def test_exception_releases_slot():
+    async def scenario():
+        scheduler = FairScheduler(max_concurrency=1)
+
+        def boom():
+            raise RuntimeError("boom")
+
+        try:
+            await scheduler.run("a", boom)
+        except RuntimeError:
+            pass
+        assert scheduler.inflight == 0
+        result, _ = await scheduler.run("a", lambda: 42)
+        assert result == 42
+
+    asyncio.run(scenario())
@@ -0,0 +1,80 @@
+"""
+Session 索引：分片路徑、upsert 與列表/計數查詢
+"""
+
+import hashlib
+
+import session_index
+from session_index import SessionIndex
+
+
+def _session(created, updated=None, history=0):
+    return {"created_at": created, "updated_at": updated, "history": [f"/images/{i}.png" for i in range(history)]}
+
+
+def test_sharded_paths():
+    shard = hashlib.sha1(b"aB3xZ").hexdigest()[:2]
+
+    assert session_index.session_shard("aB3xZ") == shard
+    assert session_index.session_relpath("aB3xZ") == f"{shard}/aB3xZ.json"
+    assert session_index.session_kind("sess_123") == "sess"
+    assert session_index.session_kind("aB3xZ") == "short"
+    shards = {session_index.session_shard(f"s{i}") for i in range(2000)}
+    assert len(shards) == 256 and all(len(s) == 2 for s in shards)
+
+
+def test_upsert_inserts_and_updates(tmp_path):
+    index = SessionIndex(tmp_path / "sessions" / session_index.INDEX_FILENAME)
+
+    index.upsert("aB3xZ", _session("2024-01-01T00:00:00"), "local", "ab/aB3xZ.json")
+    record = index.get("aB3xZ")
+    assert record["kind"] == "short" and record["history_length"] == 0
+    assert record["updated_at"] == "2024-01-01T00:00:00"  # 沒有 updated_at 時用 created_at
+
+    # 之後的寫入沒有 created_at 也保留原本的建立時間
+    index.upsert("aB3xZ", _session(None, "2024-01-02T00:00:00", history=3), "gcs", "ab/aB3xZ.json")
+    record = index.get("aB3xZ")
+    assert (record["created_at"], record["updated_at"]) == ("2024-01-01T00:00:00", "2024-01-02T00:00:00")
+    assert (record["history_length"], record["location"]) == (3, "gcs")
+
+    index.remove("aB3xZ")
+    assert index.get("aB3xZ") is None
+
+
+def test_list_and_count_filters(tmp_path):
+    index = SessionIndex(tmp_path / session_index.INDEX_FILENAME)
+    rows = [
+        ("sess_a", "2024-01-01", "2024-03-01", 1),
+        ("sess_b", "2024-02-01", "2024-02-15", 2),
+        ("short", "2024-03-01", "2024-03-02", 5),
+    ]
+    for session_id, created, updated, history in rows:
+        relpath = session_index.session_relpath(session_id)
+        index.upsert(session_id, _session(created, updated, history), "local", relpath)
+
+    assert [r["id"] for r in index.list()] == ["short", "sess_a", "sess_b"]
+    assert [r["id"] for r in index.list(order="created")] == ["short", "sess_b", "sess_a"]
+    assert [r["id"] for r in index.list(limit=1, offset=1)] == ["sess_a"]
+    assert [r["id"] for r in index.list(kind="sess")] == ["sess_a", "sess_b"]
+    assert [r["id"] for r in index.list(since="2024-02-20", until="2024-03-02")] == ["sess_a"]
+    assert index.count() == 3
+    assert index.count(kind="short") == 1
+    assert index.count(since="2024-02-01", order="created") == 2
+
+    stats = index.stats()
+    assert (stats["sessions"], stats["images"]) == (3, 8)
+    assert stats["by_kind"] == {"sess": 2, "short": 1}
+    assert (stats["first_created_at"], stats["last_updated_at"]) == ("2024-01-01", "2024-03-02")
+
+
+def test_index_is_shared_between_connections(tmp_path):
+    path = tmp_path / session_index.INDEX_FILENAME
+    writer, reader = SessionIndex(path), SessionIndex(path)
+
+    writer.upsert("sess_x", _session("2024-01-01"), "local", "xx/sess_x.json")
+    writer.add_references(["a.png", "b.png"])
+
+    assert reader.get("sess_x")["path"] == "xx/sess_x.json"
+    seq_names = reader.references_since(0)
+    assert [name for _, name in seq_names] == ["a.png", "b.png"]
+    assert reader.references_since(seq_names[0][0]) == seq_names[1:]
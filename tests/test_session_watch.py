@@ -0,0 +1,108 @@
+"""
+Session 即時更新：delta 計算、合併讀取 (single-flight)、跨 thread publish 與逾時重讀
+"""
+
+import asyncio
+import threading
+
+from session_watch import SessionWatcher, history_delta
+
+
+def _session(n):
+    return {"history": [f"/images/{i}.png" for i in range(n)]}
+
+
+def test_history_delta():
+    data = _session(3)
+
+    assert history_delta(data, 1) == {"version": 3, "since": 1, "reset": False, "history": data["history"][1:]}
+    assert history_delta(data, 3)["history"] == []
+    for since in (None, -1, 4):
+        delta = history_delta(data, since)
+        assert delta["reset"] and delta["since"] == 0 and delta["history"] == data["history"]
+    assert history_delta({}, 0) == {"version": 0, "since": 0, "reset": False, "history": []}
+
+
+def test_concurrent_reads_share_one_load():
+    release = threading.Event()
+    loads = []
+
+    def loader(session_id):
+        loads.append(session_id)
+        release.wait(5)
+        return _session(2)
+
+    async def scenario():
+        watcher = SessionWatcher(loader)
+        readers = [asyncio.create_task(watcher.read("s1")) for _ in range(5)]
+        await asyncio.sleep(0.05)
+        release.set()
+        results = await asyncio.gather(*readers)
+        return watcher, results
+
+    watcher, results = asyncio.run(scenario())
+
+    assert loads == ["s1"]
+    assert all(r == _session(2) for r in results)
+    assert (watcher.backend_reads, watcher.shared_reads) == (1, 4)
+
+
+def test_publish_from_worker_thread_wakes_waiters():
+    store = {"s1": _session(1)}
+
+    async def scenario():
+        watcher = SessionWatcher(lambda sid: store.get(sid))
+        waiters = [asyncio.create_task(watcher.wait("s1", since=1, timeout=5)) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        assert watcher.stats()["watchers"] == 3
+
+        def write():
+            # 與 update_session_history 一樣，在 thread pool 寫入後 publish
+            store["s1"] = _session(2)
+            watcher.publish("s1", store["s1"])
+
+        await asyncio.to_thread(write)
+        results = await asyncio.gather(*waiters)
+        return watcher, results
+
+    watcher, results = asyncio.run(scenario())
+
+    assert all(len(r["history"]) == 2 for r in results)
+    assert watcher.backend_reads == 1  # 等待者共用同一次讀取，之後用 publish 的內容
+    assert watcher.wakeups == 3
+    assert watcher.stats()["watched_sessions"] == 0
+
+
+def test_wait_returns_immediately_when_behind_and_rereads_after_timeout():
+    store = {"s1": _session(2)}
+
+    async def scenario():
+        watcher = SessionWatcher(lambda sid: store.get(sid))
+        behind = await watcher.wait("s1", since=0, timeout=5)
+
+        # 其他 worker 寫入（沒有 publish 到這個 process）：逾時後重新讀取
+        waiting = asyncio.create_task(watcher.wait("s1", since=2, timeout=0.1))
+        await asyncio.sleep(0.02)
+        store["s1"] = _session(3)
+        after_timeout = await waiting
+
+        missing = await watcher.wait("nope", since=0, timeout=5)
+        return behind, after_timeout, missing
+
+    behind, after_timeout, missing = asyncio.run(scenario())
+
+    assert len(behind["history"]) == 2
+    assert len(after_timeout["history"]) == 3
+    assert missing is None
+
+
+def test_publish_without_watchers_or_loop_is_ignored():
+    watcher = SessionWatcher(lambda sid: None)
+    watcher.publish("s1", _session(1))  # 尚未有 event loop
+
+    async def scenario():
+        await watcher.read("s1")
+        watcher.publish("s1", _session(1))  # 沒有觀看者
+
+    asyncio.run(scenario())
+    assert watcher.wakeups == 0
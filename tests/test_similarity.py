@@ -0,0 +1,114 @@
+"""
+相似度索引：加入、完全/幾乎相同的重複判斷、搜尋、刪除，以及背景 worker
+"""
+
+import io
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+import similarity
+
+
+def _image(seed, fmt="PNG", quality=95, shift=0):
+    rng = np.random.default_rng(seed)
+    img = Image.new("RGB", (320, 240), tuple(int(v) for v in rng.integers(0, 255, 3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x, y = (int(v) for v in rng.integers(0, 280, 2))
+        w, h = (int(v) for v in rng.integers(20, 120, 2))
+        draw.rectangle((x + shift, y, x + w + shift, y + h), fill=tuple(int(v) for v in rng.integers(0, 255, 3)))
+    buffer = io.BytesIO()
+    img.save(buffer, format=fmt, quality=quality)
+    return buffer.getvalue()
+
+
+def test_add_detects_exact_and_near_duplicates(tmp_path):
+    index = similarity.SimilarityIndex(tmp_path)
+
+    first = index.add("a.png", _image(1))
+    assert first["row"] == 0 and first["duplicate_of"] is None
+    assert index.add("a.png", _image(1)) is None  # 已存在
+
+    exact = index.add("b.png", _image(1))
+    assert (exact["duplicate_of"], exact["duplicate_kind"]) == ("a.png", "exact")
+
+    near = index.add("c.jpg", _image(1, fmt="JPEG", quality=80))
+    assert (near["duplicate_of"], near["duplicate_kind"]) == ("a.png", "near")
+    assert near["similarity"] >= similarity.NEAR_DUP_COSINE
+
+    other = index.add("d.png", _image(2))
+    assert other["duplicate_of"] is None
+    assert index.count() == 4
+    assert {d["name"] for d in index.duplicates()} == {"b.png", "c.jpg"}
+    assert [d["name"] for d in index.duplicates(kind="near")] == ["c.jpg"]
+
+
+def test_search_ranks_most_similar_first(tmp_path):
+    index = similarity.SimilarityIndex(tmp_path)
+    index.add("base.png", _image(7))
+    index.add("moved.png", _image(7, shift=6))
+    for seed in range(20, 26):
+        index.add(f"other{seed}.png", _image(seed))
+
+    results = index.similar("base.png", k=3)
+
+    assert len(results) == 3
+    assert results[0]["name"] == "moved.png"
+    assert "base.png" not in {r["name"] for r in results}
+    assert results[0]["similarity"] >= results[1]["similarity"] >= results[2]["similarity"]
+    assert results[0]["distance"] is not None
+    assert index.similar_to_bytes(_image(7), k=1)[0]["name"] == "base.png"
+    assert index.similar("missing.png") is None
+
+
+def test_remove_hides_image_from_search_and_duplicates(tmp_path):
+    index = similarity.SimilarityIndex(tmp_path)
+    index.add("a.png", _image(1))
+    index.add("b.png", _image(1))
+    index.add("c.png", _image(3))
+
+    index.remove("b.png")
+
+    assert index.get("b.png")["deleted"] == 1
+    assert "b.png" not in {r["name"] for r in index.similar("a.png", k=5)}
+    assert index.duplicates() == []
+    # 刪除後同樣內容的新圖片對應到仍存在的那張
+    assert index.add("d.png", _image(1))["duplicate_of"] == "a.png"
+    assert index.stats()["deleted"] == 1
+
+
+def test_worker_logs_duplicates_and_stops_with_full_queue(tmp_path, monkeypatch):
+    logged = []
+    monkeypatch.setattr(similarity, "jsonlog", SimpleNamespace(log=lambda event, *a, **kw: logged.append((event, kw))))
+    index = similarity.SimilarityIndex(tmp_path, queue_size=2)
+    index.start()
+    assert index.submit("a.png", _image(1))
+    assert index.submit("b.png", _image(1))
+    deadline = time.monotonic() + 10
+    while index.indexed < 2 and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    assert [event for event, _ in logged] == ["similarity_duplicate"]
+    assert logged[0][1]["duplicate_of"] == "a.png"
+
+    index.submit("bad.png", b"not an image")
+    deadline = time.monotonic() + 10
+    while index.failed < 1 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert logged[-1][0] == "similarity_index_failed" and logged[-1][1]["severity"] == "WARNING"
+
+    # 佇列滿的時候 stop() 也不能阻塞
+    blocker = threading.Event()
+    monkeypatch.setattr(index, "add", lambda name, data: blocker.wait(5))
+    for i in range(4):
+        index.submit(f"x{i}.png", b"")
+    started = time.monotonic()
+    index.stop()
+    assert time.monotonic() - started < 0.5
+    blocker.set()
+    index._thread.join(5)
+    assert not index._thread.is_alive()
@@ -0,0 +1,113 @@
+"""
+StarterStock：多個 worker（兩個 instance 共用狀態檔）共用庫存、預算與閒置時間，
+以及 retention 不刪除尚未取用的庫存
+"""
+
+import asyncio
+import os
+import time
+from types import SimpleNamespace
+
+import retention
+import starter_stock
+from starter_stock import Recipe, StarterStock
+
+
+def _worker(tmp_path, produced, idle=lambda: True, **kwargs):
+    async def producer(recipe):
+        produced.append(recipe.key)
+        return f"http://localhost:8000/result/{recipe.scene}-{len(produced)}.png"
+
+    pool = StarterStock(producer, idle, idle_seconds=0, state_path=tmp_path / "stock.json", **kwargs)
+    pool.seed(Recipe(scene="space", prompt="make it look realistic"))
+    return pool
+
+
+def _fill(pool, times):
+    return [asyncio.run(pool.refill_once()) for _ in range(times)]
+
+
+def test_hourly_budget_is_shared_between_workers(tmp_path):
+    produced = []
+    a = _worker(tmp_path, produced, hourly_budget=2, depth=5)
+    b = _worker(tmp_path, produced, hourly_budget=2, depth=5)
+
+    assert _fill(a, 1) == [True]
+    assert _fill(b, 2) == [True, False]
+    assert len(produced) == 2
+    assert b.stats()["budget_left"] == 0
+    assert a.stats()["deferred_budget"] == 1
+
+
+def test_busy_worker_holds_back_refills_everywhere(tmp_path):
+    produced = []
+    busy = _worker(tmp_path, produced, idle=lambda: False)
+    idle = _worker(tmp_path, produced)
+    idle.idle_seconds = 60
+
+    _fill(idle, 1)  # 第一次只記下閒置起點
+    _fill(busy, 1)
+    assert _fill(idle, 1) == [False]
+    assert produced == []
+
+
+def test_stock_made_by_one_worker_is_served_by_another(tmp_path):
+    produced = []
+    a = _worker(tmp_path, produced, depth=1)
+    b = _worker(tmp_path, produced, depth=1)
+    recipe = Recipe(scene="space", prompt="Make it look  realistic.")
+
+    assert _fill(a, 1) == [True]
+    assert _fill(b, 1) == [False]  # 已經補滿
+    item = b.take(b.observe(recipe))
+    assert item is not None and item.url.endswith("space-1.png")
+    assert a.take(recipe) is None
+    stats = a.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 1)
+
+
+def test_stale_stock_is_discarded(tmp_path, monkeypatch):
+    produced = []
+    pool = _worker(tmp_path, produced, max_age=60)
+    _fill(pool, 1)
+
+    now = time.time() + 120
+    monkeypatch.setattr(starter_stock, "time", SimpleNamespace(time=lambda: now, monotonic=time.monotonic))
+    assert pool.take(Recipe(scene="space", prompt="make it look realistic")) is None
+    assert pool.stats()["stale_discarded"] == 1
+
+
+def test_learned_recipe_is_shared_between_workers(tmp_path):
+    produced = []
+    a = _worker(tmp_path, produced)
+    b = _worker(tmp_path, produced)
+    learned = Recipe(scene="moon", prompt="add a sofa")
+
+    a.observe(learned)
+    b.observe(learned)
+    assert learned.key in {r["key"] for r in a.stats()["recipes"]}
+
+
+def test_retention_keeps_unserved_stock(tmp_path):
+    produced = []
+    pool = _worker(tmp_path, produced, depth=2)
+    result_dir = tmp_path / "result"
+    result_dir.mkdir()
+    _fill(pool, 2)
+    pool.take(Recipe(scene="space", prompt="make it look realistic"))  # space-1 已給 session
+
+    old = time.time() - 30 * 86400
+    for name in ("space-1.png", "space-2.png", "orphan.png"):
+        (result_dir / name).write_bytes(b"x")
+        os.utime(result_dir / name, (old, old))
+
+    manager = retention.RetentionManager(
+        [retention.RetentionPolicy("result", result_dir, max_age_days=7)],
+        protect=lambda policy, name: name in pool.held_names()
+    )
+    inventory = manager.inventories["result"]
+    for entry in os.scandir(result_dir):
+        inventory.add(entry.name, entry.stat().st_mtime, entry.stat().st_size)
+    manager._evict(inventory, time.time())
+
+    assert sorted(p.name for p in result_dir.iterdir()) == ["space-2.png"]
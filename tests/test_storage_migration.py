@@ -0,0 +1,124 @@
+"""
+本地 <-> bucket 搬移：以 DirectoryBucket（本地目錄模擬的 bucket）跑完整流程
+"""
+
+import json
+
+import pytest
+
+import session_index
+import storage_migration as sm
+
+BASE_URL = "http://localhost:8000"
+SESSION_ID = "aB3xZ"
+
+
+@pytest.fixture
+def project(tmp_path):
+    """本地模式的資料：上傳、結果，以及舊的平面路徑 session"""
+    base = tmp_path / "project"
+    (base / "input").mkdir(parents=True)
+    (base / "result").mkdir()
+    (base / "sessions").mkdir()
+    (base / "input" / "upload.png").write_bytes(b"\x89PNG\r\n\x1a\n" + b"u" * 2048)
+    (base / "result" / "r1.jpg").write_bytes(b"\xff\xd8\xff" + b"r" * 4096)
+    session = {
+        "id": SESSION_ID,
+        "history": ["/static/img/space.png", f"{BASE_URL}/images/r1.jpg"],
+    }
+    (base / "sessions" / f"{SESSION_ID}.json").write_text(json.dumps(session))
+    return base
+
+
+@pytest.fixture
+def bucket(tmp_path):
+    return sm.DirectoryBucket(tmp_path / "bucket", name="fake-bucket")
+
+
+def _migrate(base, bucket, direction, journal):
+    return sm.StorageMigration(base, bucket, direction, BASE_URL, workers=2, journal_path=journal).run()
+
+
+def test_to_gcs_copies_verifies_and_rewrites(project, bucket, tmp_path):
+    stats = _migrate(project, bucket, "to-gcs", tmp_path / "journal.jsonl")
+
+    assert (stats.copied, stats.skipped, stats.failed) == (3, 0, 0)
+    assert stats.urls_rewritten == 1
+
+    # 內容與 checksum（CRC32C 與 MD5）都和來源一致
+    for local, key in (("input/upload.png", "input/upload.png"), ("result/r1.jpg", "result/r1.jpg")):
+        blob = bucket.blob(key)
+        blob.reload()
+        assert (bucket.root / key).read_bytes() == (project / local).read_bytes()
+        crc, md5 = sm.checksums_of_file(project / local)
+        assert blob.md5_hash == md5
+        if crc is not None:
+            assert blob.crc32c == crc
+
+    # session 存到分片路徑，history 的結果 URL 改成 GCS URL，起始場景不變
+    relpath = session_index.session_relpath(SESSION_ID)
+    remote = json.loads((bucket.root / "json" / relpath).read_text())
+    assert remote["history"] == [
+        "/static/img/space.png",
+        "https://storage.googleapis.com/fake-bucket/result/r1.jpg",
+    ]
+    # 本地備份使用改寫後的內容，並從舊的平面路徑搬到分片路徑
+    assert json.loads((project / "sessions" / relpath).read_text()) == remote
+    assert not (project / "sessions" / f"{SESSION_ID}.json").exists()
+
+
+def test_rerun_skips_finished_work_from_journal(project, bucket, tmp_path, monkeypatch):
+    journal = tmp_path / "journal.jsonl"
+    _migrate(project, bucket, "to-gcs", journal)
+
+    recorded = journal.read_text()
+
+    # journal 記錄的項目不應再上傳，也不會重新比對 checksum 後再記錄一次
+    def fail(*args, **kwargs):
+        raise AssertionError("finished item was uploaded again")
+
+    monkeypatch.setattr(sm._DirectoryBlob, "upload_from_string", fail)
+    monkeypatch.setattr(sm._DirectoryBlob, "upload_from_filename", fail)
+    stats = _migrate(project, bucket, "to-gcs", journal)
+
+    assert journal.read_text() == recorded
+    assert (stats.copied, stats.skipped, stats.failed) == (0, 3, 0)
+
+
+def test_existing_identical_objects_are_skipped_without_journal(project, bucket, tmp_path):
+    _migrate(project, bucket, "to-gcs", tmp_path / "first.jsonl")
+    stats = _migrate(project, bucket, "to-gcs", tmp_path / "second.jsonl")
+
+    assert (stats.copied, stats.skipped, stats.failed) == (0, 3, 0)
+
+
+def test_round_trip_back_to_local(project, bucket, tmp_path):
+    _migrate(project, bucket, "to-gcs", tmp_path / "up.jsonl")
+
+    restored = tmp_path / "restored"
+    stats = _migrate(restored, bucket, "to-local", tmp_path / "down.jsonl")
+
+    assert (stats.copied, stats.failed) == (3, 0)
+    assert stats.urls_rewritten == 1
+    assert (restored / "result" / "r1.jpg").read_bytes() == (project / "result" / "r1.jpg").read_bytes()
+    assert (restored / "input" / "upload.png").read_bytes() == (project / "input" / "upload.png").read_bytes()
+    session = json.loads((restored / "sessions" / session_index.session_relpath(SESSION_ID)).read_text())
+    assert session["history"] == ["/static/img/space.png", f"{BASE_URL}/images/r1.jpg"]
+
+
+def test_checksum_mismatch_after_upload_fails_item(project, bucket, tmp_path, monkeypatch):
+    original = sm._DirectoryBlob.upload_from_filename
+
+    def corrupt(self, filename, content_type=None):
+        original(self, filename, content_type=content_type)
+        self._path.write_bytes(self._path.read_bytes() + b"corrupted")
+
+    monkeypatch.setattr(sm._DirectoryBlob, "upload_from_filename", corrupt)
+    journal = tmp_path / "journal.jsonl"
+    stats = _migrate(project, bucket, "to-gcs", journal)
+
+    assert stats.failed == 2
+    assert all("checksum mismatch" in error for error in stats.errors)
+    # 失敗的項目沒有記錄在 journal，下次會重試
+    keys = {json.loads(line)["key"] for line in journal.read_text().splitlines()}
+    assert keys == {f"json/{session_index.session_relpath(SESSION_ID)}"}
@@ -0,0 +1,167 @@
+"""
+TieredCache：fresh 時間、generation 驗證、負面快取、write-through 與各層的容量上限
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+import tiered_cache
+from tiered_cache import TieredCache
+
+
+class Origin:
+    """假的 GCS：key -> (資料, generation)，記錄呼叫次數"""
+
+    def __init__(self):
+        self.objects = {}
+        self.fetches = 0
+        self.stats = 0
+        self.stat_error = None
+
+    def fetch(self, key):
+        self.fetches += 1
+        return self.objects.get(key)
+
+    def stat(self, key):
+        self.stats += 1
+        if self.stat_error is not None:
+            raise self.stat_error
+        entry = self.objects.get(key)
+        return entry[1] if entry else None
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(tiered_cache, "time", SimpleNamespace(time=lambda: now[0]))
+    return now
+
+
+def _cache(tmp_path, origin, mutable=True, **kwargs):
+    return TieredCache("test", tmp_path / "cache", origin.fetch, origin.stat if mutable else None, **kwargs)
+
+
+def test_fresh_window_skips_the_origin(tmp_path, clock):
+    origin = Origin()
+    origin.objects["s1"] = (b"v1", 1)
+    cache = _cache(tmp_path, origin, fresh_seconds=10)
+
+    assert cache.get_versioned("s1") == (b"v1", 1)
+    clock[0] += 5
+    assert cache.get("s1") == b"v1"
+
+    assert (origin.fetches, origin.stats) == (1, 0)
+    assert cache.stats()["memory_hits"] == 1
+
+
+def test_stale_copy_is_revalidated_by_generation(tmp_path, clock):
+    origin = Origin()
+    origin.objects["s1"] = (b"v1", 1)
+    cache = _cache(tmp_path, origin, fresh_seconds=10)
+    cache.get("s1")
+
+    clock[0] += 11
+    assert cache.get("s1") == b"v1"  # generation 相同：不重新下載
+    assert (origin.fetches, origin.stats) == (1, 1)
+    assert cache.stats()["revalidated"] == 1
+
+    origin.objects["s1"] = (b"v2", 2)
+    clock[0] += 11
+    assert cache.get_versioned("s1") == (b"v2", 2)
+    assert origin.fetches == 2
+
+
+def test_revalidate_ignores_fresh_window_and_raises_when_stat_fails(tmp_path, clock):
+    origin = Origin()
+    origin.objects["s1"] = (b"v1", 1)
+    cache = _cache(tmp_path, origin, fresh_seconds=60)
+    cache.get("s1")
+
+    origin.objects["s1"] = (b"v2", 2)  # 其他 worker 寫入
+    assert cache.get("s1") == b"v1"  # 一般讀取：fresh 時間內用本地副本
+    assert cache.get_versioned("s1", revalidate=True) == (b"v2", 2)
+
+    origin.stat_error = ConnectionError("gcs down")
+    with pytest.raises(ConnectionError):
+        cache.get_versioned("s1", revalidate=True)
+    clock[0] += 61
+    assert cache.get("s1") == b"v2"  # 一般讀取：查不到就先用舊副本
+    assert cache.stats()["stale_served"] == 1
+
+
+def test_negative_cache_expires(tmp_path, clock):
+    origin = Origin()
+    cache = _cache(tmp_path, origin, negative_ttl=10)
+
+    assert cache.get("missing") is None
+    assert cache.get("missing") is None
+    assert origin.fetches == 1
+
+    origin.objects["missing"] = (b"now here", 3)
+    assert cache.get_versioned("missing", revalidate=True) == (b"now here", 3)
+    cache.invalidate("missing")
+    del origin.objects["missing"]
+    cache.get("missing")
+    origin.objects["missing"] = (b"back", 4)
+    clock[0] += 11
+    assert cache.get("missing") == b"back"
+
+
+def test_put_writes_through_both_layers(tmp_path, clock):
+    origin = Origin()
+    cache = _cache(tmp_path, origin)
+    cache.get("s1")  # 負面快取
+
+    cache.put("s1", b"written", generation=7)
+    assert cache.get_versioned("s1") == (b"written", 7)
+    assert origin.fetches == 1
+
+    # 另一個 process（新的 instance）從磁碟讀到
+    other = _cache(tmp_path, origin)
+    assert other.get_versioned("s1") == (b"written", 7)
+    assert other.stats()["disk_hits"] == 1
+
+    cache.put("s2", b"memory only", disk=False)
+    assert not cache._disk_path("s2").exists()
+    path = cache.get_path("s2")
+    assert path.read_bytes() == b"memory only"
+
+
+def test_immutable_data_is_never_revalidated(tmp_path, clock):
+    origin = Origin()
+    origin.objects["img.png"] = (b"pixels", 1)
+    cache = _cache(tmp_path, origin, mutable=False)
+    cache.get("img.png")
+
+    clock[0] += 10 ** 6
+    assert cache.get_versioned("img.png", revalidate=True) == (b"pixels", 1)
+    assert (origin.fetches, origin.stats) == (1, 0)
+
+
+def test_memory_and_disk_evict_least_recently_used(tmp_path, clock):
+    origin = Origin()
+    for key in "abcde":
+        origin.objects[key] = (key.encode() * 100, 1)
+    cache = _cache(tmp_path, origin, memory_max_bytes=400, disk_max_bytes=300)
+
+    for key in "abc":
+        cache.get(key)
+    cache.get("a")  # a 變成最近使用
+    cache.get("d")
+    cache.get("e")
+
+    stats = cache.stats()
+    assert list(cache._memory) == ["c", "a", "d", "e"]  # b 最久沒用
+    assert stats["memory_bytes"] == 400 and stats["memory_evictions"] == 1
+    assert [k for k in "abcde" if cache._disk_path(k).exists()] == ["c", "d", "e"]
+    assert stats["disk_bytes"] == 300 and stats["disk_evictions"] == 2
+
+    # 大於記憶體上限 1/4 的資料只放磁碟
+    origin.objects["big"] = (b"x" * 200, 1)
+    cache.get("big")
+    assert "big" not in cache._memory
+
+    # 重新啟動時由磁碟上的檔案重建容量估算
+    restarted = _cache(tmp_path, origin, memory_max_bytes=400, disk_max_bytes=300)
+    assert restarted.stats()["disk_bytes"] == cache.stats()["disk_bytes"]
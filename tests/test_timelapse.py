@@ -0,0 +1,80 @@
+"""
+縮時動畫的 frame 快取：容量上限與最久沒用到的先刪、多個 process 同時產生
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from PIL import Image
+
+import timelapse
+
+
+def _sources(tmp_path, count):
+    paths = []
+    for index in range(count):
+        path = tmp_path / f"img{index}.png"
+        Image.new("RGB", (64, 48), (index * 40, 0, 0)).save(path)
+        paths.append(path)
+    return paths
+
+
+def test_frame_cache_is_trimmed_to_cap(tmp_path):
+    frames_dir = tmp_path / "frames"
+    old, new = _sources(tmp_path, 4)[:2], _sources(tmp_path, 4)[2:]
+
+    timelapse.render_timelapse([str(p) for p in old], str(tmp_path / "a.gif"), "gif", str(frames_dir))
+    for path in frames_dir.iterdir():
+        os.utime(path, (1, 1))
+    frame_size = max(p.stat().st_size for p in frames_dir.iterdir())
+
+    timelapse.render_timelapse([str(p) for p in new], str(tmp_path / "b.gif"), "gif", str(frames_dir),
+                               max_frame_bytes=frame_size * 2)
+
+    assert sorted(p.name for p in frames_dir.iterdir()) == sorted(
+        timelapse._frame_path(frames_dir, p).name for p in new
+    )
+
+
+def test_cached_frame_use_refreshes_mtime(tmp_path):
+    frames_dir = tmp_path / "frames"
+    frames_dir.mkdir()
+    source = _sources(tmp_path, 1)[0]
+
+    timelapse._load_frame(source, frames_dir)
+    cached = timelapse._frame_path(frames_dir, source)
+    os.utime(cached, (1, 1))
+    timelapse._load_frame(source, frames_dir)
+
+    assert cached.stat().st_mtime > 1
+
+
+def test_concurrent_renders_use_per_process_temp_files(tmp_path):
+    frames_dir = tmp_path / "frames"
+    sources = [str(p) for p in _sources(tmp_path, 6)]
+    output = tmp_path / "out.gif"
+
+    # 多個 worker process 同時產生同一個 session 的動畫（同樣的 frame 與輸出路徑）
+    with ProcessPoolExecutor(max_workers=4) as pool:
+        futures = [
+            pool.submit(timelapse.render_timelapse, sources, str(output), "gif", str(frames_dir))
+            for _ in range(8)
+        ]
+        assert all(f.result() == str(output) for f in futures)
+
+    reference = timelapse.render_timelapse(sources, str(tmp_path / "ref.gif"), "gif", str(frames_dir))
+    assert output.read_bytes() == Path(reference).read_bytes()
+    assert not list(tmp_path.rglob("*.tmp"))
+
+
+def test_trim_skips_files_being_written(tmp_path):
+    frames_dir = tmp_path / "frames"
+    frames_dir.mkdir()
+    timelapse._load_frame(_sources(tmp_path, 1)[0], frames_dir)
+    writing = frames_dir / "other.png.99999.tmp"  # 其他 process 寫到一半
+    writing.write_bytes(b"x" * 10000)
+
+    timelapse._trim_frames(frames_dir, 0, keep=set())
+
+    assert [p.name for p in frames_dir.iterdir()] == [writing.name]
@@ -0,0 +1,82 @@
+"""
+串流 ZIP 匯出：輸出可被 zipfile 讀回、檔名與 CRC 正確、缺少的檔案被略過
+"""
+
+import asyncio
+import io
+import os
+import threading
+import zipfile
+import zlib
+from types import SimpleNamespace
+
+import zip_export
+
+
+def _collect(entries, **kwargs):
+    async def run():
+        return [chunk async for chunk in zip_export.stream_zip(entries, **kwargs)]
+    return asyncio.run(run())
+
+
+def test_streamed_zip_reads_back(tmp_path, monkeypatch):
+    logged = []
+    monkeypatch.setattr(zip_export, "jsonlog", SimpleNamespace(log=lambda event, *a, **kw: logged.append(event)))
+    files = {
+        "images/001.png": os.urandom(200_000),
+        "images/002.jpg": os.urandom(50_000),
+        "session.json": b'{"history": []}' * 100,
+    }
+
+    def failing():
+        raise FileNotFoundError("gone")
+
+    entries = [
+        ("images/001.png", lambda: files["images/001.png"]),
+        ("images/missing.png", lambda: None),
+        ("images/002.jpg", lambda: files["images/002.jpg"]),
+        ("images/broken.png", failing),
+        ("session.json", lambda: files["session.json"]),
+    ]
+
+    chunks = _collect(entries, prefetch=2)
+
+    assert len(chunks) > 1  # 邊讀邊送，不是一次送出整個檔案
+    with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as archive:
+        assert archive.testzip() is None
+        assert archive.namelist() == list(files)
+        for info in archive.infolist():
+            assert info.CRC == zlib.crc32(files[info.filename])
+            assert archive.read(info.filename) == files[info.filename]
+        assert archive.getinfo("images/001.png").compress_type == zipfile.ZIP_STORED
+        assert archive.getinfo("session.json").compress_type == zipfile.ZIP_DEFLATED
+    assert logged == ["export_skipped"]
+
+
+def test_prefetch_limits_concurrent_loads():
+    active, peak = [0], [0]
+    lock = threading.Lock()
+
+    def loader(data):
+        def load():
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            try:
+                return data
+            finally:
+                with lock:
+                    active[0] -= 1
+        return load
+
+    entries = [(f"{i}.png", loader(bytes([i]) * 1000)) for i in range(20)]
+    chunks = _collect(entries, prefetch=3)
+
+    assert peak[0] <= 3
+    with zipfile.ZipFile(io.BytesIO(b"".join(chunks))) as archive:
+        assert len(archive.namelist()) == 20
+
+
+def test_empty_export_is_a_valid_zip():
+    with zipfile.ZipFile(io.BytesIO(b"".join(_collect([])))) as archive:
+        assert archive.namelist() == []
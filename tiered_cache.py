@@ -0,0 +1,338 @@
+"""
+GCS 前面的多層讀取快取（read-through）
+
+    記憶體 LRU  ->  本地磁碟（大小上限）  ->  GCS
+
+- 每筆資料記錄 GCS 的 generation 號碼
+- 不可變的資料（結果圖片，檔名是 uuid）永遠不需要驗證
+- 可變的資料（session JSON）在 fresh 秒數內直接使用；
+  過了之後只向 GCS 查 metadata 比對 generation，一樣就繼續用本地副本，不重新下載
+- 不存在的 key 做負面快取（negative_ttl 秒），不會每次都打 GCS
+- 讀取後要改寫（read-modify-write）的呼叫端用 get_versioned(revalidate=True)：
+  不使用 fresh 時間內的副本，一定先比對 generation，並取得寫入時的前置條件
+- 本機寫入 GCS 後呼叫 put() 直接寫入快取（write-through），
+  熱門的 session / 圖片重複讀取不會離開這台機器
+
+磁碟層多個 worker 可以共用同一個目錄（寫入是原子的），大小上限由各 process 各自估算。
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+# (資料, generation)，不存在時回傳 None
+Fetch = Callable[[str], Optional[Tuple[bytes, Optional[int]]]]
+# 目前的 generation，不存在時回傳 None
+Stat = Callable[[str], Optional[int]]
+
+
+class _MemoryEntry:
+    __slots__ = ("data", "generation", "checked_at")
+
+    def __init__(self, data: bytes, generation: Optional[int], checked_at: float):
+        self.data = data
+        self.generation = generation
+        self.checked_at = checked_at
+
+
+class TieredCache:
+    """
+    Args:
+        name: 名稱（統計用）
+        disk_dir: 磁碟快取目錄
+        fetch: 從來源讀取 key
+        stat: 查詢來源的 generation（可變資料的驗證用；None 表示資料不可變）
+        memory_max_bytes: 記憶體層上限
+        disk_max_bytes: 磁碟層上限
+        fresh_seconds: 可變資料在這段時間內不驗證
+        negative_ttl: 不存在的 key 快取秒數
+    """
+
+    def __init__(self, name: str, disk_dir: Path, fetch: Fetch, stat: Optional[Stat] = None,
+                 memory_max_bytes: int = 32 * 1024 * 1024, disk_max_bytes: int = 512 * 1024 * 1024,
+                 fresh_seconds: float = 10.0, negative_ttl: float = 10.0):
+        self.name = name
+        self.disk_dir = disk_dir
+        self._fetch = fetch
+        self._stat = stat
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self.fresh_seconds = fresh_seconds
+        self.negative_ttl = negative_ttl
+
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, _MemoryEntry]" = OrderedDict()
+        self._memory_bytes = 0
+        self._disk: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_bytes = 0
+        self._negative: Dict[str, float] = {}
+
+        self.counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "negative_hits": 0,
+            "revalidated": 0,
+            "origin_fetches": 0,
+            "origin_misses": 0,
+            "stale_served": 0,
+            "memory_evictions": 0,
+            "disk_evictions": 0,
+        }
+        self._scan_disk()
+
+    # -- 磁碟層 --
+
+    def _disk_path(self, key: str) -> Path:
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return self.disk_dir / digest[:2] / digest
+
+    def _scan_disk(self):
+        """啟動時載入既有的磁碟快取（依修改時間排序，舊的先淘汰）"""
+        if not self.disk_dir.exists():
+            return
+        files = []
+        for path in self.disk_dir.glob("*/*"):
+            if path.suffix or not path.is_file():
+                continue
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, path.name, stat.st_size))
+        for _, digest, size in sorted(files):
+            self._disk[digest] = size
+            self._disk_bytes += size
+
+    def _read_disk(self, key: str) -> Optional[Tuple[bytes, Optional[int], float]]:
+        path = self._disk_path(key)
+        try:
+            with open(path.with_suffix(".meta"), "r") as f:
+                meta = json.load(f)
+            if meta.get("key") != key:
+                return None
+            data = path.read_bytes()
+        except (OSError, ValueError):
+            return None
+        with self._lock:
+            if path.name in self._disk:
+                self._disk.move_to_end(path.name)
+        return data, meta.get("generation"), meta.get("checked_at", 0.0)
+
+    def _write_disk(self, key: str, data: bytes, generation: Optional[int], checked_at: float):
+        path = self._disk_path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+            self._write_meta(key, generation, checked_at)
+        except OSError:
+            return
+
+        evict = []
+        with self._lock:
+            self._disk_bytes -= self._disk.pop(path.name, 0)
+            self._disk[path.name] = len(data)
+            self._disk_bytes += len(data)
+            while self._disk_bytes > self.disk_max_bytes and len(self._disk) > 1:
+                digest, size = self._disk.popitem(last=False)
+                self._disk_bytes -= size
+                self.counters["disk_evictions"] += 1
+                evict.append(digest)
+        for digest in evict:
+            old = self.disk_dir / digest[:2] / digest
+            old.unlink(missing_ok=True)
+            old.with_suffix(".meta").unlink(missing_ok=True)
+
+    def _write_meta(self, key: str, generation: Optional[int], checked_at: float):
+        meta_path = self._disk_path(key).with_suffix(".meta")
+        tmp = meta_path.with_name(f"{meta_path.name}.{os.getpid()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump({"key": key, "generation": generation, "checked_at": checked_at}, f)
+        os.replace(tmp, meta_path)
+
+    def _drop_disk(self, key: str):
+        path = self._disk_path(key)
+        with self._lock:
+            self._disk_bytes -= self._disk.pop(path.name, 0)
+        path.unlink(missing_ok=True)
+        path.with_suffix(".meta").unlink(missing_ok=True)
+
+    # -- 記憶體層 --
+
+    def _remember(self, key: str, data: bytes, generation: Optional[int], checked_at: float):
+        if len(data) > self.memory_max_bytes // 4:
+            return
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_bytes -= len(old.data)
+            self._memory[key] = _MemoryEntry(data, generation, checked_at)
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.memory_max_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted.data)
+                self.counters["memory_evictions"] += 1
+
+    def _fresh(self, checked_at: float) -> bool:
+        return self._stat is None or time.time() - checked_at < self.fresh_seconds
+
+    # -- 讀取 --
+
+    def get(self, key: str) -> Optional[bytes]:
+        """
+        讀取 key（記憶體 -> 磁碟 -> 來源）
+
+        Returns:
+            Optional[bytes]: 資料，不存在時回傳 None
+        """
+        result = self.get_versioned(key)
+        return result[0] if result is not None else None
+
+    def get_versioned(self, key: str, revalidate: bool = False) -> Optional[Tuple[bytes, Optional[int]]]:
+        """
+        讀取 key 與它的 generation
+
+        Args:
+            key: key
+            revalidate: 忽略 fresh 時間，一定向來源比對 generation（read-modify-write 用）
+
+        Returns:
+            Optional[Tuple[bytes, Optional[int]]]: (資料, generation)，不存在時回傳 None
+        """
+        now = time.time()
+        revalidate = revalidate and self._stat is not None
+        cached = None
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                if self._fresh(entry.checked_at) and not revalidate:
+                    self.counters["memory_hits"] += 1
+                    return entry.data, entry.generation
+                cached = (entry.data, entry.generation, entry.checked_at)
+            elif self._negative.get(key, 0) > now and not revalidate:
+                self.counters["negative_hits"] += 1
+                return None
+
+        if cached is None:
+            cached = self._read_disk(key)
+            if cached is not None and self._fresh(cached[2]) and not revalidate:
+                with self._lock:
+                    self.counters["disk_hits"] += 1
+                self._remember(key, *cached)
+                return cached[0], cached[1]
+
+        if cached is not None:
+            # 本地副本過期：只比對 generation
+            data, generation, _ = cached
+            try:
+                current = self._stat(key)
+            except Exception:
+                if revalidate:
+                    raise
+                with self._lock:
+                    self.counters["stale_served"] += 1
+                return data, generation
+            if current is not None and current == generation:
+                with self._lock:
+                    self.counters["revalidated"] += 1
+                self._remember(key, data, generation, now)
+                try:
+                    self._write_meta(key, generation, now)
+                except OSError:
+                    pass
+                return data, generation
+            if current is None:
+                self.invalidate(key)
+                self._mark_missing(key)
+                return None
+
+        return self._load(key)
+
+    def _load(self, key: str) -> Optional[Tuple[bytes, Optional[int]]]:
+        result = self._fetch(key)
+        now = time.time()
+        if result is None:
+            with self._lock:
+                self.counters["origin_misses"] += 1
+            self.invalidate(key)
+            self._mark_missing(key)
+            return None
+        data, generation = result
+        with self._lock:
+            self.counters["origin_fetches"] += 1
+        self._write_disk(key, data, generation, now)
+        self._remember(key, data, generation, now)
+        return data, generation
+
+    def get_path(self, key: str) -> Optional[Path]:
+        """
+        取得磁碟層的檔案路徑（不在磁碟上時從來源讀取），給需要檔案路徑的呼叫端使用
+
+        Returns:
+            Optional[Path]: 檔案路徑，不存在時回傳 None
+        """
+        if self.get(key) is None:
+            return None
+        path = self._disk_path(key)
+        if not path.exists():
+            # 只在記憶體層（例如 put 時沒有寫入磁碟）：補寫磁碟
+            with self._lock:
+                entry = self._memory.get(key)
+            if entry is None:
+                return None
+            self._write_disk(key, entry.data, entry.generation, entry.checked_at)
+        return path
+
+    # -- 寫入 / 失效 --
+
+    def put(self, key: str, data: bytes, generation: Optional[int] = None, disk: bool = True):
+        """本機寫入來源後呼叫（write-through）"""
+        now = time.time()
+        with self._lock:
+            self._negative.pop(key, None)
+        if disk:
+            self._write_disk(key, data, generation, now)
+        else:
+            self._drop_disk(key)
+        self._remember(key, data, generation, now)
+
+    def invalidate(self, key: str):
+        with self._lock:
+            entry = self._memory.pop(key, None)
+            if entry is not None:
+                self._memory_bytes -= len(entry.data)
+            self._negative.pop(key, None)
+        self._drop_disk(key)
+
+    def _mark_missing(self, key: str):
+        if self.negative_ttl <= 0:
+            return
+        now = time.time()
+        with self._lock:
+            if len(self._negative) > 10000:
+                self._negative = {k: t for k, t in self._negative.items() if t > now}
+            self._negative[key] = now + self.negative_ttl
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = sum(self.counters[k] for k in (
+                "memory_hits", "disk_hits", "negative_hits", "revalidated", "origin_fetches", "origin_misses"
+            ))
+            local = lookups - self.counters["origin_fetches"] - self.counters["origin_misses"]
+            return {
+                "name": self.name,
+                "memory_items": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_items": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+                "negative_items": len(self._negative),
+                "local_ratio": round(local / lookups, 4) if lookups else None,
+                **self.counters,
+            }
@@ -0,0 +1,246 @@
+"""
+Session 縮時動畫 (GIF / WebP / MP4)
+
+- 每張 history 圖片先縮成小 frame 並快取在磁碟（以檔名為 key），
+  history 新增圖片時只需處理新的 frame，再重新組合動畫
+- frame 快取有容量上限，超過時從最久沒用到的 frame 開始刪除
+- 動畫以 history 版本（URL 列表的 hash）快取，同一版本只產生一次
+- 組合動畫在 process pool 中執行，不佔用 web worker 的 GIL
+- MP4 需要系統上有 ffmpeg，沒有時不提供
+"""
+
+import asyncio
+import hashlib
+import io
+import os
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+from PIL import Image
+
+FORMATS = {
+    "gif": "image/gif",
+    "webp": "image/webp",
+    "mp4": "video/mp4",
+}
+
+# frame 大小（保持 1184x864 的比例）
+FRAME_SIZE = (480, 350)
+# 與 share.html 的播放節奏一致：每張 500ms，最後一張停 3 秒
+HOLD_MS = 500
+LAST_HOLD_MS = 3000
+# 淡入淡出的過場 frame 數與每格時間
+FADE_FRAMES = 3
+FADE_MS = 60
+MP4_FPS = 25
+# frame 快取的預設容量上限
+DEFAULT_FRAME_CACHE_BYTES = 512 * 1024 * 1024
+
+
+def history_version(history: List[str]) -> str:
+    """history 版本：URL 列表的 hash"""
+    digest = hashlib.sha1("\n".join(history).encode("utf-8")).hexdigest()
+    return f"{len(history)}-{digest[:12]}"
+
+
+def mp4_available() -> bool:
+    return shutil.which("ffmpeg") is not None
+
+
+def _frame_path(frames_dir: Path, source: Path) -> Path:
+    key = hashlib.sha1(str(source).encode("utf-8")).hexdigest()[:16]
+    return frames_dir / f"{source.stem}-{key}.png"
+
+
+def _load_frame(source: Path, frames_dir: Path) -> Image.Image:
+    """取得縮小後的 frame，已快取的直接讀取"""
+    cached = _frame_path(frames_dir, source)
+    try:
+        with Image.open(cached) as img:
+            frame = img.convert("RGB")
+        os.utime(cached)  # 以 mtime 記錄最近使用時間
+        return frame
+    except FileNotFoundError:
+        pass
+
+    with Image.open(source) as img:
+        frame = img.convert("RGB")
+        frame.thumbnail((FRAME_SIZE[0] * 2, FRAME_SIZE[1] * 2))
+        frame = frame.resize(FRAME_SIZE, Image.Resampling.LANCZOS)
+
+    tmp = cached.with_name(f"{cached.name}.{os.getpid()}.tmp")
+    frame.save(tmp, format="PNG")
+    os.replace(tmp, cached)
+    return frame
+
+
+def _trim_frames(frames_dir: Path, max_bytes: int, keep: set):
+    """frame 快取超過 max_bytes 時，從最久沒用到的開始刪除（這次用到的、其他 process 寫到一半的不刪）"""
+    entries = []
+    total = 0
+    with os.scandir(frames_dir) as it:
+        for entry in it:
+            if entry.name.endswith(".tmp"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+            total += stat.st_size
+    if total <= max_bytes:
+        return
+    for _, name, size in sorted(entries):
+        if name in keep:
+            continue
+        try:
+            (frames_dir / name).unlink()
+        except FileNotFoundError:
+            pass
+        total -= size
+        if total <= max_bytes:
+            return
+
+
+def _sequence(frames: List[Image.Image]):
+    """產生 (frame, 毫秒) 序列，包含淡入淡出過場"""
+    for index, frame in enumerate(frames):
+        last = index == len(frames) - 1
+        yield frame, LAST_HOLD_MS if last else HOLD_MS
+        following = frames[0] if last else frames[index + 1]
+        if len(frames) > 1:
+            for step in range(1, FADE_FRAMES + 1):
+                yield Image.blend(frame, following, step / (FADE_FRAMES + 1)), FADE_MS
+
+
+def _write_mp4(sequence, output: Path):
+    """以 ffmpeg 從 raw RGB frame 串流編碼 MP4"""
+    command = [
+        "ffmpeg", "-y", "-loglevel", "error",
+        "-f", "rawvideo", "-pix_fmt", "rgb24",
+        "-s", f"{FRAME_SIZE[0]}x{FRAME_SIZE[1]}", "-r", str(MP4_FPS),
+        "-i", "-",
+        "-c:v", "libx264", "-pix_fmt", "yuv420p", "-movflags", "+faststart",
+        "-f", "mp4", str(output)
+    ]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE)
+    frame_ms = 1000 / MP4_FPS
+    for frame, duration in sequence:
+        data = frame.tobytes()
+        for _ in range(max(1, round(duration / frame_ms))):
+            process.stdin.write(data)
+    process.stdin.close()
+    if process.wait() != 0:
+        raise RuntimeError("ffmpeg failed")
+
+
+def render_timelapse(sources: List[str], output: str, fmt: str, frames_dir: str,
+                     max_frame_bytes: Optional[int] = None) -> str:
+    """
+    產生縮時動畫（在 process pool 中執行）
+
+    Args:
+        sources: history 圖片的本地路徑（依順序）
+        output: 輸出路徑
+        fmt: gif / webp / mp4
+        frames_dir: frame 快取目錄
+        max_frame_bytes: frame 快取容量上限（None 表示不限制）
+
+    Returns:
+        str: 輸出路徑
+    """
+    frames_path = Path(frames_dir)
+    frames_path.mkdir(parents=True, exist_ok=True)
+    frames = [_load_frame(Path(source), frames_path) for source in sources]
+    if max_frame_bytes is not None:
+        _trim_frames(frames_path, max_frame_bytes, {_frame_path(frames_path, Path(s)).name for s in sources})
+    output_path = Path(output)
+    tmp = output_path.with_name(f"{output_path.name}.{os.getpid()}.tmp")
+
+    if fmt == "mp4":
+        _write_mp4(_sequence(frames), tmp)
+    else:
+        sequence = list(_sequence(frames))
+        images = [frame for frame, _ in sequence]
+        durations = [duration for _, duration in sequence]
+        buffer = io.BytesIO()
+        if fmt == "gif":
+            images = [img.quantize(colors=256, method=Image.Quantize.MEDIANCUT) for img in images]
+            images[0].save(buffer, format="GIF", save_all=True, append_images=images[1:],
+                           duration=durations, loop=0, optimize=True)
+        else:
+            images[0].save(buffer, format="WEBP", save_all=True, append_images=images[1:],
+                           duration=durations, loop=0, quality=70, method=4)
+        tmp.write_bytes(buffer.getvalue())
+
+    os.replace(tmp, output_path)
+    return str(output_path)
+
+
+class TimelapseRenderer:
+    """
+    縮時動畫快取 + process pool
+
+    快取路徑：{cache_dir}/{session_id}/{version}.{fmt}，同一 session 只保留最新版本；
+    frame 快取 {cache_dir}/.frames 最多 max_frame_bytes
+    """
+
+    def __init__(self, cache_dir: Path, max_workers: int = 1,
+                 max_frame_bytes: Optional[int] = DEFAULT_FRAME_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.frames_dir = cache_dir / ".frames"
+        self.max_workers = max_workers
+        self.max_frame_bytes = max_frame_bytes
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._inflight = {}
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._pool
+
+    def cached_path(self, session_id: str, version: str, fmt: str) -> Path:
+        return self.cache_dir / session_id / f"{version}.{fmt}"
+
+    def _prune(self, session_id: str, keep: Path):
+        """刪除同一 session 同格式的舊版本"""
+        for old in keep.parent.glob(f"*.{keep.suffix.lstrip('.')}"):
+            if old != keep:
+                old.unlink(missing_ok=True)
+
+    async def render(self, session_id: str, version: str, fmt: str, sources: List[Path]) -> Path:
+        """
+        取得（必要時產生）縮時動畫，同一版本同時只會產生一次
+        """
+        output = self.cached_path(session_id, version, fmt)
+        if output.exists():
+            return output
+
+        key = (session_id, version, fmt)
+        future = self._inflight.get(key)
+        if future is None:
+            output.parent.mkdir(parents=True, exist_ok=True)
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(
+                self._executor(),
+                render_timelapse,
+                [str(s) for s in sources],
+                str(output),
+                fmt,
+                str(self.frames_dir),
+                self.max_frame_bytes
+            )
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        await asyncio.shield(future)
+        self._prune(session_id, output)
+        return output
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
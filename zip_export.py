@@ -0,0 +1,99 @@
+"""
+串流 ZIP 匯出
+
+- 邊讀邊寫：ZIP 直接寫進回應串流，不需要先在記憶體或磁碟組好整個檔案
+- 寫入目前的檔案時，後面幾個檔案已經在 thread pool 中並行讀取（本地或 GCS）
+- 圖片本身已壓縮，以 stored（不再壓縮）寫入；其他檔案（例如 session.json）用 deflate
+- 記憶體用量只與預讀數量有關，與 history 長度無關
+"""
+
+import asyncio
+import io
+import time
+import zipfile
+from collections import deque
+from typing import AsyncIterator, Callable, Iterable, Optional, Tuple
+
+import jsonlog
+
+# 已壓縮的格式，不再壓縮
+STORED_SUFFIXES = {".png", ".jpg", ".jpeg", ".webp", ".gif", ".mp4"}
+
+# 預設同時預讀的檔案數
+DEFAULT_PREFETCH = 4
+
+
+class _StreamBuffer(io.RawIOBase):
+    """不可 seek 的寫入緩衝，zipfile 會改用 data descriptor 記錄大小與 CRC"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _compress_type(name: str) -> int:
+    suffix = name[name.rfind("."):].lower() if "." in name else ""
+    return zipfile.ZIP_STORED if suffix in STORED_SUFFIXES else zipfile.ZIP_DEFLATED
+
+
+async def stream_zip(entries: Iterable[Tuple[str, Callable[[], Optional[bytes]]]],
+                     prefetch: int = DEFAULT_PREFETCH) -> AsyncIterator[bytes]:
+    """
+    產生 ZIP 串流
+
+    Args:
+        entries: (檔名, loader) 列表，loader 是同步函式，回傳檔案內容或 None（略過）
+        prefetch: 同時預讀的檔案數
+
+    Yields:
+        bytes: ZIP 資料
+    """
+    entries = iter(entries)
+    pending = deque()
+
+    def schedule():
+        while len(pending) < max(1, prefetch):
+            entry = next(entries, None)
+            if entry is None:
+                return
+            name, loader = entry
+            pending.append((name, asyncio.ensure_future(asyncio.to_thread(loader))))
+
+    buffer = _StreamBuffer()
+    date_time = time.localtime()[:6]
+    try:
+        with zipfile.ZipFile(buffer, mode="w", allowZip64=True) as archive:
+            schedule()
+            while pending:
+                name, task = pending.popleft()
+                try:
+                    data = await task
+                except Exception as e:
+                    jsonlog.log("export_skipped", f"Export skipped {name}: {e}", severity="WARNING", file=name)
+                    data = None
+                schedule()
+                if data is None:
+                    continue
+
+                info = zipfile.ZipInfo(name, date_time=date_time)
+                info.compress_type = _compress_type(name)
+                info.external_attr = 0o644 << 16
+                archive.writestr(info, data)
+                yield buffer.drain()
+
+        # central directory
+        yield buffer.drain()
+    finally:
+        for _, task in pending:
+            task.cancel()